@@ -1,12 +1,15 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 from froms import LoginForm, SignupForm, ServiceForm, TodoForm
 import os
 from datetime import datetime
 from config import Config
+from images import media, save_upload, ImageUploadError
+from jobs import task
+from events import stream_response
+from serving import health
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -14,9 +17,18 @@ app.config.from_object(Config)
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'log_in'
+app.register_blueprint(media)
+app.register_blueprint(health)
 
 # Import models after db initialization to avoid circular imports
 from models import Provider, Company, Service, Bookings, Comments, TODOO  # Changed User to Provider
+from dashboard import get_dashboard
+from booking_search import parse_filters, search_bookings, booking_calendar, ensure_search_indexes, SearchError, CursorError
+
+# Search indexes at setup, so they exist under gunicorn too (a no-op until the tables do)
+with app.app_context():
+    ensure_search_indexes(db.engine)
+    db.engine.dispose()  # don't hand the setup connection to forked workers
 
 @app.route('/provider/signup/')
 def index():
@@ -69,16 +81,29 @@ def log_in():
 @app.route('/home/')
 @login_required
 def home():
-    company = Company.query.filter_by(provider_id=current_user.id).order_by(Company.date.desc()).first()  # Changed user_id to provider_id
-    services = Service.query.filter_by(company_id=company.id).all() if company else []
+    dashboard = get_dashboard(db.session, current_user.id)
+    if not dashboard:
+        return render_template('home.html', company=None, services=[])
     
-    # Calculate average rating
-    if services:
-        mean_rating = sum(service.rating for service in services if service.rating) / len(services)
-        company.rating = mean_rating
-        db.session.commit()
+    # Show the fresh average right away; the job worker persists it (the snapshot stays untouched)
+    company = dashboard.company
+    rating = company.rating
+    if dashboard.mean_rating is not None and company.rating != dashboard.mean_rating:
+        recompute_company_rating.delay(company.id)
+        rating = dashboard.mean_rating
     
-    return render_template('home.html', company=company, services=services)
+    return render_template('home.html', company=company, rating=rating, services=dashboard.services)
+
+
+# Runs against the portal's own app and database, so it goes to the 'portal'
+# queue, which only portal_worker.py consumes (the main workers don't know it)
+@task('provider.recompute_company_rating', queue='portal')
+def recompute_company_rating(company_id):
+    company = db.session.get(Company, company_id)
+    services = Service.query.filter_by(company_id=company_id).all()
+    if company and services:
+        company.rating = sum(service.rating for service in services if service.rating) / len(services)
+        db.session.commit()
 
 @app.route('/todopage/', methods=['GET', 'POST'])
 @login_required
@@ -125,60 +150,71 @@ def delete_todo(srno):
 @app.route('/bookings/')
 @login_required
 def bookings():
-    company = Company.query.filter_by(provider_id=current_user.id).order_by(Company.date.desc()).first()  # Changed user_id to provider_id
-    if not company:
+    dashboard = get_dashboard(db.session, current_user.id)
+    if not dashboard:
         return redirect(url_for('home'))
     
-    services = Service.query.filter_by(company_id=company.id).all()
-    service_ids = [service.id for service in services]
-    
-    bookings_query = Bookings.query.filter(Bookings.service_id.in_(service_ids))
+    try:
+        filters = parse_filters(request.args)
+    except CursorError as e:
+        abort(400, description=str(e))
+    except SearchError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('bookings'))
     
-    # Search functionality
-    search_query = request.args.get('search', '')
-    if search_query:
-        bookings_query = bookings_query.filter(
-            Bookings.time.like(f'%{search_query}%') |
-            Bookings.location.like(f'%{search_query}%') |
-            Bookings.booker.like(f'%{search_query}%')
-        )
+    bookings, next_cursor = search_bookings(db.session, dashboard.services, filters)
+    return render_template('bookings.html', bookings=bookings, services=dashboard.services,
+                           next_cursor=next_cursor)
+
+# Live feed of new bookings for the provider's company (Server-Sent Events)
+@app.route('/bookings/stream/')
+@login_required
+def bookings_stream():
+    dashboard = get_dashboard(db.session, current_user.id)
+    if not dashboard:
+        abort(404)
+    return stream_response([f"company:{dashboard.company.id}"])
+
+@app.route('/bookings/calendar/')
+@login_required
+def bookings_calendar():
+    dashboard = get_dashboard(db.session, current_user.id)
+    if not dashboard:
+        return jsonify([])
     
-    # Sorting
-    sort_by = request.args.get('sort_by', 'time')
-    if sort_by == 'service':
-        bookings_query = bookings_query.join(Service).order_by(Service.name)
-    elif sort_by == 'location':
-        bookings_query = bookings_query.order_by(Bookings.location)
-    elif sort_by == 'booker':
-        bookings_query = bookings_query.order_by(Bookings.booker)
-    else:
-        bookings_query = bookings_query.order_by(Bookings.time)
+    try:
+        filters = parse_filters(request.args)
+    except SearchError as e:
+        return jsonify({'message': str(e)}), 400
+    granularity = 'week' if request.args.get('granularity') == 'week' else 'day'
     
-    bookings = bookings_query.all()
-    return render_template('bookings.html', bookings=bookings)
+    return jsonify(booking_calendar(db.session, dashboard.service_ids, filters['date_from'],
+                                    filters['date_to'], granularity))
 
 @app.route('/add_service/', methods=['GET', 'POST'])
 @login_required
 def add_service():
     form = ServiceForm()
     if form.validate_on_submit():
-        company = Company.query.filter_by(provider_id=current_user.id).first()  # Changed user_id to provider_id
-        if not company:
+        dashboard = get_dashboard(db.session, current_user.id)
+        if not dashboard:
             flash('You need to create a company first', 'error')
             return redirect(url_for('home'))
         
         service = Service(
             name=form.name.data,
             description=form.desc.data,
-            company_id=company.id
+            company_id=dashboard.company.id
         )
 
         
-        # Handle file upload
+        # Handle file upload (streamed and stored by content hash)
         if form.logo.data:
-            filename = secure_filename(form.logo.data.filename)
-            form.logo.data.save(os.path.join(app.config['UPLOAD_FOLDER'], 'logos', filename))
-            service.logo = filename
+            try:
+                service.logo = save_upload(form.logo.data)
+            except ImageUploadError as e:
+                flash(str(e), 'error')
+                return render_template('add_service.html', form=form)
         
         db.session.add(service)
         db.session.commit()
@@ -190,12 +226,12 @@ def add_service():
 @app.route('/comments/')
 @login_required
 def comments():
-    company = Company.query.filter_by(provider_id=current_user.id).order_by(Company.date.desc()).first()  # Changed user_id to provider_id
-    if not company:
+    dashboard = get_dashboard(db.session, current_user.id)
+    if not dashboard:
         return redirect(url_for('home'))
     
-    comments = Comments.query.filter_by(company_id=company.id).all()
-    return render_template('comments.html', comments=comments)
+    return render_template('comments.html', comments=dashboard.recent_comments,
+                           comment_count=dashboard.comment_count)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -204,4 +240,5 @@ def load_user(user_id):
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        ensure_search_indexes(db.engine)
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,292 @@
+# booking_search.py
+"""
+Booking search for the provider portal.
+
+Filters are typed (date range, status, service), free text goes through a
+trigram index (pg_trgm on Postgres, FTS5 on SQLite), and results are paged
+with a keyset cursor on (sort key, id) so page 50 costs the same as page 1.
+Every sort order is served by an index: the text sorts by expression
+indexes on coalesce(column, ''), the service sort by walking the
+provider's services in name order, one (service_id, id) range at a time.
+"""
+import base64
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, inspect, literal_column, or_, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from models import Bookings
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SORT_KEYS = ('time', 'location', 'booker', 'service')
+MIN_TRIGRAM_LENGTH = 3
+
+
+class SearchError(ValueError):
+    pass
+
+
+class CursorError(SearchError):
+    """The `after` cursor was tampered with or belongs to another sort order."""
+
+
+def _parse_date(value, name):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise SearchError(f"{name} must be YYYY-MM-DD")
+
+
+def parse_filters(args):
+    """Reads the typed filters from request.args."""
+    date_from = _parse_date(args.get('date_from'), 'date_from')
+    date_to = _parse_date(args.get('date_to'), 'date_to')
+    sort_by = args.get('sort_by', 'time')
+    if sort_by not in SORT_KEYS:
+        raise SearchError(f"sort_by must be one of {', '.join(SORT_KEYS)}")
+    return {
+        'date_from': date_from,
+        'date_to': date_to + timedelta(days=1) if date_to else None,  # inclusive end date
+        'status': args.get('status') or None,
+        'service_id': args.get('service_id', type=int),
+        'search': (args.get('search') or '').strip(),
+        'sort_by': sort_by,
+        'after': _parse_cursor(args.get('after'), sort_by),
+        'limit': max(1, min(args.get('limit', PAGE_SIZE, type=int) or PAGE_SIZE, MAX_PAGE_SIZE)),
+    }
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise CursorError("Invalid cursor")
+
+
+def _parse_cursor(cursor, sort_by):
+    """Decodes an `after` cursor into (last sort value, last id), checking its shape for the sort order."""
+    if not cursor:
+        return None
+    decoded = decode_cursor(cursor)
+    if not isinstance(decoded, list) or len(decoded) != 2:
+        raise CursorError("Invalid cursor")
+    last_value, last_id = decoded
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise CursorError("Invalid cursor")
+    if sort_by == 'service':
+        valid = isinstance(last_value, int) and not isinstance(last_value, bool)
+    elif sort_by == 'time':
+        valid = last_value is None or isinstance(last_value, str)
+        if valid and last_value is not None:
+            try:
+                last_value = datetime.fromisoformat(last_value)
+            except ValueError:
+                valid = False
+    else:
+        valid = isinstance(last_value, str)
+    if not valid:
+        raise CursorError("Invalid cursor")
+    return last_value, last_id
+
+
+def _text_filter(session, search):
+    dialect = session.get_bind().dialect.name
+    escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    pattern = f"%{escaped}%"
+
+    if dialect == 'sqlite' and len(search) >= MIN_TRIGRAM_LENGTH:
+        phrase = '"' + search.replace('"', '""') + '"'
+        matches = text(
+            f"SELECT rowid FROM {Bookings.__tablename__}_fts WHERE {Bookings.__tablename__}_fts MATCH :phrase"
+        ).bindparams(phrase=phrase).columns(Bookings.id)
+        return Bookings.id.in_(matches)
+
+    # On Postgres the pg_trgm GIN indexes serve these ILIKEs
+    return or_(
+        Bookings.booker.ilike(pattern, escape='\\'),
+        Bookings.location.ilike(pattern, escape='\\'),
+    )
+
+
+def _service_ranks(services):
+    ordered = sorted(services, key=lambda s: (s.name or '').lower())
+    return {s.id: rank for rank, s in enumerate(ordered)}
+
+
+def _sort_expression(sort_by):
+    # '' inline (not a bound parameter), so the expression matches the index's
+    if sort_by in ('location', 'booker'):
+        return func.coalesce(getattr(Bookings, sort_by), literal_column("''"))
+    return Bookings.time
+
+
+def _by_service(query, services, service_ids, after, limit):
+    """
+    One page in service-name order: each service's bookings by id, services in
+    name order. Ranks come from the provider's (already cached) service names,
+    so there is no join and each service is an index range scan.
+    """
+    ranks = _service_ranks(services)
+    last_rank, last_id = after or (-1, 0)
+    rows = []
+    for service_id in sorted(service_ids, key=ranks.get):
+        rank = ranks[service_id]
+        if rank < last_rank:
+            continue
+        page = query.filter(Bookings.service_id == service_id)
+        if rank == last_rank:
+            page = page.filter(Bookings.id > last_id)
+        rows += page.order_by(Bookings.id).limit(limit + 1 - len(rows)).all()
+        if len(rows) > limit:
+            break
+    return rows
+
+
+def search_bookings(session, services, filters):
+    """
+    Runs one page of a provider's booking search.
+
+    Args:
+        session: The SQLAlchemy session.
+        services: The provider's services (from the dashboard read model).
+        filters: Output of parse_filters().
+
+    Returns:
+        tuple: (bookings, next_cursor or None)
+    """
+    service_ids = [s.id for s in services]
+    if filters['service_id'] is not None:
+        service_ids = [i for i in service_ids if i == filters['service_id']]
+    if not service_ids:
+        return [], None
+
+    query = session.query(Bookings).options(joinedload(Bookings.service)).filter(
+        Bookings.service_id.in_(service_ids)
+    )
+    if filters['date_from']:
+        query = query.filter(Bookings.time >= filters['date_from'])
+    if filters['date_to']:
+        query = query.filter(Bookings.time < filters['date_to'])
+    if filters['status']:
+        query = query.filter(Bookings.status == filters['status'])
+    if filters['search']:
+        query = query.filter(_text_filter(session, filters['search']))
+
+    if filters['sort_by'] == 'service':
+        rows = _by_service(query, services, service_ids, filters['after'], filters['limit'])
+    else:
+        sort_key = _sort_expression(filters['sort_by'])
+        if filters['after']:
+            query = query.filter(tuple_(sort_key, Bookings.id) > tuple_(*filters['after']))
+        rows = query.order_by(sort_key, Bookings.id).limit(filters['limit'] + 1).all()
+    next_cursor = None
+    if len(rows) > filters['limit']:
+        rows = rows[:filters['limit']]
+        last = rows[-1]
+        if filters['sort_by'] == 'service':
+            ranks = _service_ranks(services)
+            last_value = ranks.get(last.service_id, len(ranks))
+        elif filters['sort_by'] == 'time':
+            last_value = last.time.isoformat() if last.time else None
+        else:
+            last_value = getattr(last, filters['sort_by']) or ''
+        next_cursor = encode_cursor([last_value, last.id])
+    return rows, next_cursor
+
+
+def booking_calendar(session, service_ids, date_from, date_to, granularity='day'):
+    """
+    Counts bookings per day or week, aggregated in the database.
+
+    Returns:
+        list: [{"period": "2025-03-10", "count": 12}, ...] ordered by period.
+    """
+    if not service_ids:
+        return []
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        period = func.to_char(func.date_trunc(granularity, Bookings.time), 'YYYY-MM-DD')
+    elif granularity == 'week':
+        # SQLite: Monday of the booking's week
+        period = func.date(Bookings.time, '-6 days', 'weekday 1')
+    else:
+        period = func.date(Bookings.time)
+
+    conditions = [Bookings.service_id.in_(service_ids)]
+    if date_from:
+        conditions.append(Bookings.time >= date_from)
+    if date_to:
+        conditions.append(Bookings.time < date_to)
+
+    rows = (
+        session.query(period.label('period'), func.count(Bookings.id))
+        .filter(and_(*conditions))
+        .group_by('period')
+        .order_by('period')
+        .all()
+    )
+    return [{"period": p, "count": n} for p, n in rows]
+
+
+def ensure_search_indexes(engine):
+    """
+    Creates the composite, sort and trigram/FTS indexes used by the search.
+
+    Idempotent, and a no-op until the bookings table exists. Returns True
+    if the indexes are in place.
+    """
+    table = Bookings.__tablename__
+    if not inspect(engine).has_table(table):
+        return False
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_service_time ON {table} (service_id, time, id)"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_service_status_time ON {table} (service_id, status, time)"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_service_id ON {table} (service_id, id)"))
+        for column in ('booker', 'location'):
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_sort ON {table} ((coalesce({column}, '')), id)"
+            ))
+
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for column in ('booker', 'location'):
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)"
+                ))
+        elif engine.dialect.name == 'sqlite':
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": f"{table}_fts"}
+            ).first()
+            if exists:
+                return True
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE {table}_fts USING fts5("
+                f"booker, location, content='{table}', content_rowid='id', tokenize='trigram')"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER {table}_fts_ai AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {table}_fts(rowid, booker, location) VALUES (new.id, new.booker, new.location); END"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER {table}_fts_ad AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {table}_fts({table}_fts, rowid, booker, location) "
+                f"VALUES ('delete', old.id, old.booker, old.location); END"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER {table}_fts_au AFTER UPDATE ON {table} BEGIN "
+                f"INSERT INTO {table}_fts({table}_fts, rowid, booker, location) "
+                f"VALUES ('delete', old.id, old.booker, old.location); "
+                f"INSERT INTO {table}_fts(rowid, booker, location) VALUES (new.id, new.booker, new.location); END"
+            ))
+            conn.execute(text(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')"))
+    return True
@@ -0,0 +1,142 @@
+# dashboard.py
+"""
+Provider dashboard read model.
+
+Everything the provider pages need about "my company" is loaded with a
+fixed number of queries (company + services + counts in one pre-joined
+query, then the latest comments) and cached per provider until one of
+their writes invalidates it.
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import func, inspect, select
+
+from bus import on_commit
+from models import Company, Service, Bookings, Comments
+
+CACHE_TTL = 30  # seconds; bounds staleness for writes made outside the portal
+RECENT_COMMENTS_LIMIT = 50
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _snapshot(obj, **extra):
+    """Copies column values into a plain object so it can outlive the session."""
+    values = {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+    values.update(extra)
+    return SimpleNamespace(**values)
+
+
+def _load(session, provider_id):
+    latest_company = (
+        select(Company.id)
+        .where(Company.provider_id == provider_id)
+        .order_by(Company.date.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    # Counts only this company's bookings, not the whole table
+    booking_counts = (
+        select(Bookings.service_id, func.count(Bookings.id).label('booking_count'))
+        .where(Bookings.service_id.in_(select(Service.id).where(Service.company_id == latest_company)))
+        .group_by(Bookings.service_id)
+        .subquery()
+    )
+    comment_count = (
+        select(func.count(Comments.id))
+        .where(Comments.company_id == Company.id)
+        .correlate(Company)
+        .scalar_subquery()
+    )
+
+    # One query: the company, each of its services and their booking counts
+    rows = (
+        session.query(Company, Service, booking_counts.c.booking_count, comment_count)
+        .outerjoin(Service, Service.company_id == Company.id)
+        .outerjoin(booking_counts, booking_counts.c.service_id == Service.id)
+        .filter(Company.id == latest_company)
+        .order_by(Service.id)
+        .all()
+    )
+    if not rows:
+        return None
+
+    company_row, _, _, total_comments = rows[0]
+    services = [
+        _snapshot(service, booking_count=count or 0)
+        for _, service, count, _ in rows
+        if service is not None
+    ]
+    service_ids = [s.id for s in services]
+    ratings = [s.rating for s in services if s.rating]
+
+    recent_comments = [
+        _snapshot(c)
+        for c in session.query(Comments)
+        .filter_by(company_id=company_row.id)
+        .order_by(Comments.id.desc())
+        .limit(RECENT_COMMENTS_LIMIT)
+    ]
+
+    return SimpleNamespace(
+        company=_snapshot(company_row),
+        services=services,
+        service_ids=service_ids,
+        booking_count=sum(s.booking_count for s in services),
+        comment_count=total_comments or 0,
+        mean_rating=sum(ratings) / len(services) if services else None,
+        recent_comments=recent_comments,
+        loaded_at=time.time(),
+    )
+
+
+def get_dashboard(session, provider_id):
+    """
+    Returns the cached read model for a provider, loading it on a miss.
+
+    The returned objects are detached snapshots: treat them as read-only and
+    query the ORM models when a page needs to write.
+    """
+    now = time.monotonic()
+    with _lock:
+        cached = _cache.get(provider_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    dashboard = _load(session, provider_id)
+    if dashboard is not None:
+        with _lock:
+            _cache[provider_id] = (now + CACHE_TTL, dashboard)
+    return dashboard
+
+
+def invalidate(provider_id):
+    """Drops a provider's cached read model; call after any of their writes."""
+    with _lock:
+        _cache.pop(provider_id, None)
+
+
+@on_commit(Company, Service, Bookings, Comments)
+def _invalidate_changed(changes):
+    """Drops the read model of every provider whose data changed in the commit, in two lookups at most."""
+    def touched(model, key):
+        return {v for c in changes if c.model is model for v in (c.values.get(key), c.previous.get(key))}
+
+    providers = touched(Company, 'provider_id')
+    company_ids = touched(Service, 'company_id') | touched(Comments, 'company_id')
+    service_ids = touched(Bookings, 'service_id') - {None}
+    with changes.bind.connect() as connection:
+        if service_ids:
+            company_ids |= set(connection.execute(
+                select(Service.company_id).where(Service.id.in_(service_ids))
+            ).scalars())
+        company_ids.discard(None)
+        if company_ids:
+            providers |= set(connection.execute(
+                select(Company.provider_id).where(Company.id.in_(company_ids))
+            ).scalars())
+    for provider_id in providers - {None}:
+        invalidate(provider_id)
@@ -0,0 +1,20 @@
+# portal_worker.py
+"""
+Job worker for the provider portal.
+
+    cd Asliddin && PYTHONPATH=.. python portal_worker.py --processes 1
+
+The portal's tasks use the portal's app and database, so they are queued on
+'portal' and run here, with app.py as both the app and the task module. The
+main workers (worker.py at the repo root) never consume that queue. Extra
+arguments are passed on to worker.py, e.g. --processes.
+"""
+import sys
+
+import worker
+
+PORTAL_ARGS = ['--app', 'app:app', '--tasks', 'app', '--queues', 'portal', '--no-scheduler']
+
+if __name__ == '__main__':
+    sys.argv[1:1] = PORTAL_ARGS
+    worker.main()
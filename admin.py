@@ -1,14 +1,73 @@
 # admin.py (Fixed)
+import base64
+import json
+import time
+from datetime import date, datetime
+
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import Column, Date, DateTime, Integer, text, tuple_
+from sqlalchemy.orm import joinedload, load_only, selectinload
 from extensions import db, admin
 from models import User, Service, Category, Review, Transaction
 from flask import redirect, url_for, flash, session, render_template, request, jsonify
 from auth import role_required, decode_jwt_token
+from sessions import current_principal
 from application import app
+import sharding
+
+APPROX_COUNT_THRESHOLD = 100000  # rows; above this list pages show an estimated total
+COUNT_CACHE_TTL = 60  # seconds an exact count is reused where no estimate is available
+
+_count_cache = {}
+
+
+def _encode_cursor(values):
+    raw = json.dumps(values, default=lambda v: v.isoformat()).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
 
-# ✅ Custom ModelView with token check
+def _decode_cursor(cursor):
+    """A `[sort value, primary key]` pair, or None for anything that is not one."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    scalar = (str, int, float, type(None))
+    if (not isinstance(values, list) or len(values) != 2
+            or not all(isinstance(v, scalar) and not isinstance(v, bool) for v in values)
+            or values[1] is None):
+        return None
+    return values
+
+
+def _coerce(column, value):
+    """Turns a cursor value back into the column's Python type."""
+    if value is None:
+        return None
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return date.fromisoformat(value)
+    if isinstance(column.type, Integer):
+        return int(value)
+    return value
+
+
+# ✅ Custom ModelView with token check, keyset paging and estimated counts
 class AdminModelView(ModelView):
+    """
+    List pages page by (sort column, primary key) instead of OFFSET, load only
+    the listed columns, eager-load listed relationships, and estimate the row
+    count on large tables, so the 500th page costs the same as the first.
+    """
+    list_template = 'admin/model/keyset_list.html'
+
     def is_accessible(self):
+        # ✅ Signed-in admins are known from the session snapshot, no token decode needed
+        principal = current_principal()
+        if principal and principal['kind'] == 'admin':
+            return True
+
         token = request.cookies.get('admin_token')  # ✅ Check for cookie token
         if not token:
             flash('Missing admin token', 'danger')
@@ -20,9 +79,223 @@ class AdminModelView(ModelView):
             flash(f'Invalid token: {str(e)}', 'danger')
             return False
 
+    #--------------------- Counts
+    def estimate_count(self, count_query):
+        """Exact below APPROX_COUNT_THRESHOLD; pg_class.reltuples or a cached count above it."""
+        table = self.model.__table__.name
+        if self.session.get_bind().dialect.name == 'postgresql':
+            estimate = self.session.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                {"table": table},
+            ).scalar()
+            if estimate and estimate >= APPROX_COUNT_THRESHOLD:
+                return int(estimate)
+            return count_query.scalar()
+
+        cached = _count_cache.get(table)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        count = count_query.scalar()
+        if count >= APPROX_COUNT_THRESHOLD:
+            _count_cache[table] = (time.monotonic() + COUNT_CACHE_TTL, count)
+        return count
+
+    #--------------------- Loading
+    def _list_load_options(self, sort_attr):
+        mapper = self.model.__mapper__
+        columns = {mapper.get_property_by_column(column).key for column in mapper.primary_key}
+        options = []
+        for name, _ in self._list_columns:
+            key = name.split('.')[0]
+            if key in mapper.column_attrs:
+                columns.add(key)
+            elif key in mapper.relationships:
+                relationship = getattr(self.model, key)
+                if relationship in self._auto_joins:
+                    continue
+                options.append(selectinload(relationship) if mapper.relationships[key].uselist
+                               else joinedload(relationship))
+        if sort_attr is not None:
+            columns.add(sort_attr.key)
+        return [load_only(*(getattr(self.model, c) for c in columns))] + options
+
+    def _model_attr(self, field):
+        """Maps a sortable field (attribute or table Column) to this model's column attribute."""
+        mapper = self.model.__mapper__
+        if isinstance(field, Column):
+            if field.table is not self.model.__table__:
+                return None
+            field = getattr(self.model, mapper.get_property_by_column(field).key)
+        key = getattr(field, 'key', None)
+        if key not in mapper.column_attrs or getattr(field, 'class_', None) is not self.model:
+            return None
+        return field
+
+    def _keyset_attr(self, sort_column, sort_desc):
+        """The (attribute, descending) pair to page on, or None if the sort needs a join."""
+        primary_key = self.model.__mapper__.primary_key
+        if len(primary_key) != 1:
+            return None
+        if sort_column is None:
+            order = list(self._get_default_order())
+            if not order:
+                return getattr(self.model, primary_key[0].key), False
+            if len(order) != 1 or order[0][1]:
+                return None
+            attr, _, sort_desc = order[0]
+        else:
+            attr = self._sortable_columns.get(sort_column)
+            if self._sortable_joins.get(sort_column) or isinstance(attr, list):
+                return None
+        attr = self._model_attr(attr)
+        if attr is None:
+            return None
+        column = attr.property.columns[0]
+        # Row-value comparisons don't order NULLs; page those lists with OFFSET
+        if column.nullable and not column.primary_key:
+            return None
+        return attr, bool(sort_desc)
+
+    def _count(self, count_query, filtered):
+        return count_query.scalar() if filtered else self.estimate_count(count_query)
+
+    def _fetch(self, query, limit, sort_key, reverse):
+        """The first `limit` rows of the ordered keyset query; sort_key and reverse describe that order."""
+        return query.limit(limit).all()
+
+    def _keyset_url(self, **cursor):
+        args = request.args.to_dict()
+        for name in ('page', 'after', 'before'):
+            args.pop(name, None)
+        args.update(cursor)
+        return self.get_url('.index_view', **args)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        keyset = self._keyset_attr(sort_column, sort_desc) if execute else None
+        if keyset is None or page:
+            # Numbered pages, exports and join-sorted lists keep Flask-Admin's OFFSET paging
+            return super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+
+        joins, count_joins = {}, {}
+        query = self.get_query()
+        count_query = self.get_count_query()
+        filtered = False
+        if self._search_supported and search:
+            query, count_query, joins, count_joins = self._apply_search(query, count_query, joins, count_joins, search)
+            filtered = True
+        if filters and self._filters:
+            query, count_query, joins, count_joins = self._apply_filters(query, count_query, joins, count_joins, filters)
+            filtered = True
+        count = self._count(count_query, filtered)
+
+        for relationship in self._auto_joins:
+            query = query.options(joinedload(relationship))
+        attr, descending = keyset
+        query = query.options(*self._list_load_options(attr))
+
+        pk = getattr(self.model, self.model.__mapper__.primary_key[0].key)
+        page_size = page_size or self.page_size
+        after = _decode_cursor(request.args.get('after', ''))
+        before = _decode_cursor(request.args.get('before', ''))
+        backwards = before is not None and after is None
+        cursor = before if backwards else after
+
+        if cursor:
+            try:
+                cursor = [_coerce(attr.property.columns[0], cursor[0]), _coerce(pk.property.columns[0], cursor[1])]
+            except (ValueError, TypeError):
+                # A cursor that does not fit the sort column falls back to the first page
+                cursor, backwards = None, False
+
+        reverse = descending != backwards
+        if cursor:
+            if attr.key == pk.key:
+                key, value = pk, cursor[1]
+            else:
+                key = tuple_(attr, pk)
+                value = tuple_(cursor[0], cursor[1])
+            query = query.filter(key < value if reverse else key > value)
+        order = [attr] if attr.key == pk.key else [attr, pk]
+        query = query.order_by(*(column.desc() if reverse else column for column in order))
+
+        rows = self._fetch(query, page_size + 1, lambda row: tuple(getattr(row, c.key) for c in order), reverse)
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backwards:
+            rows.reverse()
+
+        links = {'first_url': self._keyset_url() if cursor else None, 'prev_url': None, 'next_url': None}
+        if rows:
+            first = _encode_cursor([getattr(rows[0], attr.key), getattr(rows[0], pk.key)])
+            last = _encode_cursor([getattr(rows[-1], attr.key), getattr(rows[-1], pk.key)])
+            # Walking backwards, `has_more` means there is an earlier page; forwards, a later one
+            if (backwards and has_more) or (not backwards and cursor):
+                links['prev_url'] = self._keyset_url(before=first)
+            if backwards or has_more:
+                links['next_url'] = self._keyset_url(after=last)
+        self._template_args['keyset'] = links
+        return count, rows
+
+
+class CategoryAdminView(AdminModelView):
+    # Kept by categories.py; editing them by hand would desync the counts
+    form_excluded_columns = ('path', 'depth', 'service_count', 'total_services', 'services', 'children')
+    column_exclude_list = ('path',)
+
+
 # ✅ Register Admin Views
 admin.add_view(AdminModelView(User, db.session, endpoint='users_admin'))
 admin.add_view(AdminModelView(Service, db.session, endpoint='services_admin'))
-admin.add_view(AdminModelView(Category, db.session, endpoint='categories_admin'))
+admin.add_view(CategoryAdminView(Category, db.session, endpoint='categories_admin'))
 admin.add_view(AdminModelView(Review, db.session, endpoint='reviews_admin'))
-admin.add_view(AdminModelView(Transaction, db.session, endpoint='transactions_admin'))
+
+
+class TransactionAdminView(AdminModelView):
+    """
+    With sharding on, transactions live on every shard: the list pages all of
+    them by scatter-gather, rows open from their own shard, and editing is
+    off (a write has to run in the row's shard context).
+    """
+    column_default_sort = ('id', True)
+
+    def __init__(self, *args, **kwargs):
+        if sharding.enabled():
+            self.can_create = self.can_edit = self.can_delete = False
+            self.can_view_details = True
+        super().__init__(*args, **kwargs)
+
+    def _keyset_attr(self, sort_column, sort_desc):
+        keyset = super()._keyset_attr(sort_column, sort_desc)
+        if keyset is None and sharding.enabled():
+            # OFFSET paging can't be merged across shards; such sorts fall back to newest first
+            return Transaction.id, True
+        return keyset
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        if sharding.enabled():
+            page = None
+        return super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+
+    def _count(self, count_query, filtered):
+        if not sharding.enabled():
+            return super()._count(count_query, filtered)
+        return sum(sharding.scatter(count_query.scalar).values())
+
+    def _fetch(self, query, limit, sort_key, reverse):
+        if not sharding.enabled():
+            return super()._fetch(query, limit, sort_key, reverse)
+        # Each shard's first `limit` rows, merged: the overall first `limit` are among them
+        rows = sharding.gather(sharding.scatter(lambda: query.limit(limit).all()))
+        return sorted(rows, key=sort_key, reverse=reverse)[:limit]
+
+    def get_one(self, id):
+        if not sharding.enabled():
+            return super().get_one(id)
+        try:
+            with sharding.use_shard_of(id):
+                return super().get_one(id)
+        except (sharding.ShardingError, ValueError):
+            return None
+
+
+admin.add_view(TransactionAdminView(Transaction, db.session, endpoint='transactions_admin'))
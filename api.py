@@ -0,0 +1,282 @@
+# api.py
+from collections import namedtuple
+
+from flask import Blueprint, Response, request, session
+
+from extensions import db
+import cache
+import reads
+import devices
+import facets
+import categories
+from ratelimit import rate_limit, by_user
+from models import Service, Category, Review, Company
+from serializers import (
+    json_response, FieldError,
+    service_serializer, category_serializer, review_serializer, company_serializer,
+)
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+MAX_BATCH_IDS = 200
+SERVICES_PAGE_SIZE = 50
+MAX_SERVICES_PAGE_SIZE = 200
+
+# name -> how to load it: one IN query on `key`, optionally grouped into lists per key
+Resource = namedtuple('Resource', 'model key serializer many criteria')
+
+RESOURCES = {
+    'services': Resource(Service, Service.id, service_serializer, False, ()),
+    'categories': Resource(Category, Category.id, category_serializer, False, ()),
+    'companies': Resource(Company, Company.id, company_serializer, False, ()),
+    # Pending and rejected reviews are for admins only (routes.get_review)
+    'reviews': Resource(Review, Review.id, review_serializer, False, (Review.status == 'approved',)),
+    'service_reviews': Resource(Review, Review.service_id, review_serializer, True,
+                                (Review.status == 'approved',)),
+}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _parse_ids(values):
+    if isinstance(values, str):
+        values = values.split(',')
+    try:
+        ids = sorted({int(v) for v in values if str(v).strip()})
+    except (TypeError, ValueError):
+        raise BadRequest("ids must be integers")
+    if len(ids) > MAX_BATCH_IDS:
+        raise BadRequest(f"At most {MAX_BATCH_IDS} ids per resource")
+    return ids
+
+
+def load_resource(name, ids, fields=None):
+    """
+    Loads every id of a resource with a single IN query.
+
+    Returns:
+        dict: id -> serialized row (or list of rows for grouped resources).
+    """
+    resource = RESOURCES[name]
+    if not ids:
+        return {}
+    region = cache.REGIONS.get(name)
+    if region is not None and not resource.many:
+        fieldset = resource.serializer.parse_fields(fields)
+        return {i: {f: row[f] for f in fieldset} for i, row in region.get_many(ids).items()}
+    rows = db.session.query(resource.model).filter(resource.key.in_(ids), *resource.criteria).all()
+    key_attr = resource.key.key
+    fieldset = resource.serializer.parse_fields(fields)
+
+    if resource.many:
+        result = {i: [] for i in ids}
+        for row in rows:
+            result[getattr(row, key_attr)].append(resource.serializer.dump(row, fieldset))
+        return result
+    return {getattr(row, key_attr): resource.serializer.dump(row, fieldset) for row in rows}
+
+
+@api.errorhandler(BadRequest)
+@api.errorhandler(FieldError)
+def handle_bad_request(error):
+    return json_response({"message": str(error)}, 400)
+
+
+#--------------------- Services
+@api.route('/services', methods=['GET'])
+def list_services():
+    """Services in id order, a page at a time: ?after=<last service id>&limit= (plus ?ids= and ?category_id=)."""
+    fields = service_serializer.parse_fields(request.args.get('fields'))
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', SERVICES_PAGE_SIZE, type=int), 1), MAX_SERVICES_PAGE_SIZE)
+    query = db.session.query(Service).filter(Service.id > after)
+    if request.args.get('ids'):
+        query = query.filter(Service.id.in_(_parse_ids(request.args['ids'])))
+    if request.args.get('category_id', type=int):
+        query = query.filter(Service.category_id == request.args.get('category_id', type=int))
+    rows = query.order_by(Service.id).limit(limit + 1).all()
+    page = rows[:limit]
+    return json_response({
+        "services": service_serializer.dump_many(page, fields),
+        "next_after": page[-1].id if len(rows) > limit else None,
+    })
+
+
+@api.route('/services/search', methods=['GET'])
+def search_services():
+    """Faceted search: ?query=&category=&price=&city=&rating=&company=&page= (facets repeat for OR)."""
+    fields = service_serializer.parse_fields(request.args.get('fields'))
+    results = facets.search(facets.parse_filters(request.args), text=request.args.get('query') or None,
+                            page=request.args.get('page', 1, type=int))
+    return json_response({
+        "services": service_serializer.dump_many(results['services'], fields),
+        "total": results['total'],
+        "page": results['page'],
+        "pages": results['pages'],
+        "facets": {
+            facet: [{"value": v, "label": label, "count": count, "selected": selected}
+                    for v, label, count, selected in entries]
+            for facet, entries in results['facets'].items()
+        },
+    })
+
+
+@api.route('/services/<int:service_id>', methods=['GET'])
+def get_service(service_id):
+    fields = service_serializer.parse_fields(request.args.get('fields'))
+    service = cache.services.get(service_id)
+    if not service:
+        return json_response({"message": "Service not found"}, 404)
+    return json_response({f: service[f] for f in fields})
+
+
+@api.route('/services/<int:service_id>/reviews', methods=['GET'])
+def list_service_reviews(service_id):
+    reviews = load_resource('service_reviews', [service_id], request.args.get('fields'))
+    return json_response(reviews[service_id])
+
+
+#--------------------- Categories
+@api.route('/categories', methods=['GET'])
+def list_categories():
+    fields = category_serializer.parse_fields(request.args.get('fields'))
+    rows = cache.category_list.get('all')
+    return json_response([{f: row[f] for f in fields} for row in rows])
+
+
+@api.route('/categories/tree', methods=['GET'])
+def category_tree():
+    """The nested tree with service counts; the tree version is the ETag."""
+    version, raw, _ = categories.category_tree()
+    if version is None:
+        return Response(raw, mimetype='application/json')
+    etag = f"tree-{version}"
+    response = Response(raw, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers={'Cache-Control': 'no-cache'})
+    response.set_etag(etag)
+    return response
+
+
+#--------------------- Reviews
+@api.route('/reviews/<int:review_id>', methods=['GET'])
+def get_review(review_id):
+    fields = review_serializer.parse_fields(request.args.get('fields'))
+    review = reads.review(review_id)
+    if not review or review.status != 'approved':
+        return json_response({"message": "Review not found"}, 404)
+    return json_response(review_serializer.dump(review, fields))
+
+
+@api.route('/reviews', methods=['POST'])
+@rate_limit(10, 60, key=by_user)
+def create_review():
+    user_id = session.get('user_id')
+    if not user_id:
+        return json_response({"message": "Login required"}, 401)
+
+    data = request.get_json(silent=True) or {}
+    service_id = data.get('service_id')
+    content = data.get('content')
+    rating = data.get('rating')
+    if not service_id or not content or rating not in (1, 2, 3, 4, 5):
+        return json_response({"message": "service_id, content and a rating of 1-5 are required"}, 400)
+    if not db.session.get(Service, service_id):
+        return json_response({"message": "Service not found"}, 404)
+
+    review = Review(user_id=user_id, service_id=service_id, content=content, rating=rating, status='pending')
+    db.session.add(review)
+    db.session.commit()
+    return json_response(review_serializer.dump(review), 201)
+
+
+#--------------------- Devices
+@api.route('/devices', methods=['POST'])
+@rate_limit(10, 60, key=by_user)
+def register_device():
+    """Registers (or refreshes) this install's FCM token; apps call it on every start."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return json_response({"message": "Login required"}, 401)
+
+    data = request.get_json(silent=True) or {}
+    token = data.get('token')
+    platform = data.get('platform', 'android')
+    if not token or len(token) > 255 or platform not in devices.PLATFORMS:
+        return json_response({"message": f"token and a platform of {', '.join(devices.PLATFORMS)} are required"}, 400)
+    device = devices.register_device(user_id, token, platform)
+    return json_response({"id": device.id, "platform": device.platform}, 200)
+
+
+@api.route('/devices', methods=['DELETE'])
+def unregister_device():
+    user_id = session.get('user_id')
+    if not user_id:
+        return json_response({"message": "Login required"}, 401)
+    token = (request.get_json(silent=True) or {}).get('token')
+    if not token or not devices.unregister_device(user_id, token):
+        return json_response({"message": "Device not found"}, 404)
+    return json_response({"message": "Device removed"})
+
+
+#--------------------- Batch
+@api.route('/batch', methods=['POST'])
+def batch():
+    """
+    Resolves several resources in one round trip.
+
+    Body:
+        {
+            "services": {"ids": [1, 2], "fields": "id,name,price"},
+            "service_reviews": {"ids": [1]},
+            "requests": [{"resource": "categories", "id": 3}]
+        }
+
+    Ids from the resource maps and from "requests" are merged so that each
+    resource is loaded with exactly one IN query.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise BadRequest("JSON object body is required")
+
+    sub_requests = data.pop('requests', []) or []
+    if not isinstance(sub_requests, list):
+        raise BadRequest("requests must be a list")
+    if len(sub_requests) > MAX_BATCH_IDS:
+        raise BadRequest(f"At most {MAX_BATCH_IDS} requests per batch")
+
+    wanted = {}
+    for name, spec in data.items():
+        if name not in RESOURCES or not isinstance(spec, dict):
+            raise BadRequest(f"Unknown resource: {name}")
+        wanted[name] = {'ids': set(_parse_ids(spec.get('ids', []))), 'fields': spec.get('fields')}
+
+    for sub in sub_requests:
+        name = sub.get('resource') if isinstance(sub, dict) else None
+        if name not in RESOURCES:
+            raise BadRequest(f"Unknown resource: {name}")
+        entry = wanted.setdefault(name, {'ids': set(), 'fields': None})
+        entry['ids'].update(_parse_ids([sub.get('id')]))
+
+    # The cap applies to each resource's merged IN list, not to each part of it
+    for entry in wanted.values():
+        if len(entry['ids']) > MAX_BATCH_IDS:
+            raise BadRequest(f"At most {MAX_BATCH_IDS} ids per resource")
+
+    loaded = {}
+    for name, entry in wanted.items():
+        loaded[name] = load_resource(name, sorted(entry['ids']), entry['fields'])
+
+    result = {name: loaded[name] for name in data}
+    if sub_requests:
+        responses = []
+        for sub in sub_requests:
+            body = loaded[sub['resource']].get(int(sub['id']))
+            if body is None:
+                responses.append({"status": 404, "body": {"message": "Not found"}})
+            else:
+                responses.append({"status": 200, "body": body})
+        result['responses'] = responses
+    return json_response(result)
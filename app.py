@@ -1,7 +1,23 @@
+import os
+
 from application import app
 from routes import routes
+from images import media
+from api import api
+from metrics import metrics
+from events import events
+from serving import health
+from mailer import mail_hooks
+import admin  # noqa: F401  registers the Flask-Admin views
 
 app.register_blueprint(routes)
+app.register_blueprint(media)
+app.register_blueprint(api)
+app.register_blueprint(metrics)
+app.register_blueprint(events)
+app.register_blueprint(health)
+app.register_blueprint(mail_hooks)
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=os.getenv("FLASK_DEBUG", "1") == "1")
\ No newline at end of file
@@ -1,25 +1,50 @@
 from flask import Flask
 from flask_migrate import Migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
 from extensions import db, admin
 import redis
 import sentry_sdk
 import os
 from dotenv import load_dotenv
+from sessions import ServerSessionInterface, current_principal
+from resilience import SentryTransport
+import sharding
 
 load_dotenv()
 
-# ✅ Initialize Sentry first
-sentry_sdk.init(
-    dsn=os.getenv("SENTRY_DSN"),
-    send_default_pii=True,
-    traces_sample_rate=1.0,
-    _experiments={"continuous_profiling_auto_start": True}
-)
+# ✅ Initialize Sentry first (called again in each forked server process)
+def init_sentry():
+    sentry_sdk.init(
+        dsn=os.getenv("SENTRY_DSN"),
+        send_default_pii=True,
+        traces_sample_rate=1.0,
+        _experiments={"continuous_profiling_auto_start": True},
+        transport=SentryTransport,  # timeouts, and a breaker so a slow Sentry can't back up the app
+        shutdown_timeout=2,
+    )
+
+init_sentry()
 
 # ✅ Create Flask app
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL")
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
+app.config['UPLOAD_FOLDER'] = os.getenv("UPLOAD_FOLDER", os.path.join(app.root_path, 'uploads'))
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['LEDGER_ARCHIVE_DIR'] = os.getenv("LEDGER_ARCHIVE_DIR", os.path.join(app.root_path, 'archive', 'ledger'))
+app.config['CDC_EXPORT_DIR'] = os.getenv("CDC_EXPORT_DIR", os.path.join(app.root_path, 'archive', 'cdc'))
+# ✅ Bookings and transactions can live on per-company shards (off unless SHARD_URLS is set)
+app.config['SQLALCHEMY_BINDS'] = sharding.binds()
+
+# ✅ Behind the balancer: take the client address (and scheme) from the X-Forwarded-* entries our own
+# proxies add. Set TRUSTED_PROXY_HOPS=0 when clients connect directly, or they could spoof their address.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 1))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
+# ✅ Sessions live server-side; the cookie only holds the session id
+app.session_interface = ServerSessionInterface()
+app.context_processor(lambda: {'current_principal': current_principal()})
 
 # ✅ Initialize extensions
 db.init_app(app)
@@ -27,4 +52,9 @@ admin.init_app(app)
 migrate = Migrate(app, db)
 
 # ✅ Redis (if needed)
-redis_client = redis.StrictRedis(host='localhost', port=6379, decode_responses=True)
\ No newline at end of file
+redis_client = redis.StrictRedis.from_url(
+    os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+    decode_responses=True,
+    socket_connect_timeout=1,
+    socket_timeout=5
+)
\ No newline at end of file
@@ -0,0 +1,134 @@
+# bench_reads.py
+"""
+Micro-benchmark of the read fast path (reads.py) against the ORM queries it
+replaced, per endpoint, without HTTP in the way.
+
+    python bench_reads.py --iterations 2000
+    python bench_reads.py --scratch --services 500 --reviews 2000
+
+Each iteration runs one request's worth of work and then drops the session,
+as the app does at the end of a request, so the ORM side pays for a fresh
+identity map every time. CPU is process time per call; allocations are
+the peak traced by tracemalloc within one call, measured on a separate
+(slower) pass. Without --scratch it reads whatever DATABASE_URL points at.
+--scratch seeds a throwaway SQLite file instead.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--scratch', action='store_true', help='seed a temporary SQLite database')
+    parser.add_argument('--services', type=int, default=200)
+    parser.add_argument('--reviews', type=int, default=1000)
+    return parser.parse_args()
+
+
+def _seed(db, models, services, reviews):
+    db.create_all()
+    db.session.add(models.Company(id=1, name='Bench', phone='0', location='Tashkent'))
+    db.session.add(models.User(id=1, username='bench', password_hash=b'x', email='bench@example.com', phone_number='0'))
+    for i in range(1, 21):
+        db.session.add(models.Category(id=i, name=f'Category {i}'))
+    db.session.flush()
+    for i in range(1, services + 1):
+        db.session.add(models.Service(id=i, name=f'Service {i}', price=i % 500, category_id=i % 20 + 1,
+                                      company_id=1, location='Tashkent', description='x' * 200))
+    db.session.flush()
+    for i in range(1, reviews + 1):
+        db.session.add(models.Review(user_id=1, service_id=i % services + 1, content='Good work ' * 10,
+                                     rating=i % 5 + 1, status='approved'))
+    db.session.commit()
+
+
+def _cases(db, models, reads, serializers):
+    Service, Category, Review = models.Service, models.Category, models.Review
+    review_serializer, category_serializer = serializers.review_serializer, serializers.category_serializer
+
+    def orm_service(service_id):
+        service = db.session.query(Service).filter_by(id=service_id).first()
+        return {"id": service.id, "name": service.name, "price": service.price,
+                "category": service.category.name if service.category else None,
+                "description": service.description}
+
+    def fast_service(service_id):
+        return reads.service_summary(service_id)._asdict()
+
+    return [
+        ('get_service', orm_service, fast_service),
+        ('list_categories',
+         lambda _: [c.to_dict() for c in db.session.query(Category).all()],
+         lambda _: category_serializer.dump_many(reads.categories())),
+        ('get_review',
+         lambda i: review_serializer.dump(db.session.get(Review, i)),
+         lambda i: review_serializer.dump(reads.review(i))),
+        ('get_reviews',
+         lambda _: review_serializer.dump_many(db.session.query(Review).order_by(Review.id).limit(50).all()),
+         lambda _: review_serializer.dump_many(reads.reviews(0, 50))),
+    ]
+
+
+def _cpu_per_call(fn, ids, db, iterations):
+    samples = []
+    for n in range(iterations):
+        started = time.process_time()
+        fn(ids[n % len(ids)])
+        db.session.remove()
+        samples.append(time.process_time() - started)
+    return statistics.mean(samples) * 1e6
+
+
+def _peak_alloc_per_call(fn, ids, db, iterations):
+    peaks = []
+    tracemalloc.start()
+    for n in range(iterations):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn(ids[n % len(ids)])
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        db.session.remove()
+    tracemalloc.stop()
+    return statistics.mean(peaks) / 1024
+
+
+def main():
+    args = _parse_args()
+    if args.scratch:
+        path = os.path.join(tempfile.mkdtemp(), 'bench_reads.db')
+        os.environ['DATABASE_URL'] = f"sqlite:///{path}"
+
+    from application import app, db
+    import models
+    import reads
+    import serializers
+
+    with app.app_context():
+        if args.scratch:
+            _seed(db, models, args.services, args.reviews)
+        service_ids = [i for (i,) in db.session.query(models.Service.id).limit(100)]
+        review_ids = [i for (i,) in db.session.query(models.Review.id).limit(100)]
+        if not service_ids or not review_ids:
+            sys.exit("No services or reviews to read; point DATABASE_URL at real data or pass --scratch")
+        ids = {'get_service': service_ids, 'get_review': review_ids}
+
+        print(f"{'endpoint':<16} {'orm µs':>9} {'fast µs':>9} {'cpu':>6}   {'orm KiB':>8} {'fast KiB':>8} {'alloc':>6}")
+        for name, orm, fast in _cases(db, models, reads, serializers):
+            keys = ids.get(name, [None])
+            for fn in (orm, fast):  # warm up: statement caches, connection pool
+                _cpu_per_call(fn, keys, db, 20)
+            orm_cpu, fast_cpu = (_cpu_per_call(fn, keys, db, args.iterations) for fn in (orm, fast))
+            rounds = max(args.iterations // 10, 10)
+            orm_kib, fast_kib = (_peak_alloc_per_call(fn, keys, db, rounds) for fn in (orm, fast))
+            print(f"{name:<16} {orm_cpu:>9.1f} {fast_cpu:>9.1f} {fast_cpu / orm_cpu:>6.2f}x"
+                  f"  {orm_kib:>8.1f} {fast_kib:>8.1f} {fast_kib / orm_kib:>6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# bench_workers.py
+"""
+Compares gunicorn worker classes on the site's usual route mix.
+
+    python bench_workers.py --duration 15 --clients 32 --streams 20
+
+For each worker class, starts gunicorn with gunicorn.conf.py on a local
+port, waits for /readyz, optionally opens --streams idle /events/stream
+connections (as logged-in browsers would; pass a session cookie with
+--cookie, since the stream needs a login), then runs --clients keep-alive
+clients over ROUTE_MIX and prints throughput and latency percentiles.
+Point DATABASE_URL / REDIS_URL at a realistic copy of the data first.
+"""
+import argparse
+import http.client
+import itertools
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# (path, weight) - roughly what the access log shows
+ROUTE_MIX = [
+    ('/', 3),
+    ('/api/v1/services', 4),
+    ('/api/v1/services/1', 2),
+    ('/api/v1/services/1/reviews', 1),
+    ('/api/v1/categories', 2),
+    ('/services/1', 2),
+    ('/healthz', 1),
+]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/readyz')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _open_stream(port, cookie):
+    """An idle SSE stream; the benchmark just keeps it open."""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.request('GET', '/events/stream', headers={'Accept': 'text/event-stream', 'Cookie': cookie})
+    return connection
+
+
+def _client(port, stop, latencies, errors):
+    paths = [path for path, weight in ROUTE_MIX for _ in range(weight)]
+    random.shuffle(paths)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    for path in itertools.cycle(paths):
+        if stop.is_set():
+            break
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors.append(path)
+            latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException):
+            errors.append(path)
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.close()
+
+
+def run(worker_class, args):
+    port = _free_port()
+    env = dict(os.environ, WEB_WORKER_CLASS=worker_class, BIND=f"127.0.0.1:{port}", WEB_ACCESS_LOG='')
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', args.app],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    streams = []
+    try:
+        if not _wait_ready(port):
+            return {'class': worker_class, 'error': 'not ready'}
+
+        for _ in range(args.streams):
+            try:
+                streams.append(_open_stream(port, args.cookie))
+            except OSError:
+                break
+
+        stop = threading.Event()
+        latencies, errors = [], []
+        clients = [
+            threading.Thread(target=_client, args=(port, stop, latencies, errors), daemon=True)
+            for _ in range(args.clients)
+        ]
+        started = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in clients:
+            thread.join(timeout=15)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'class': worker_class,
+            'requests': len(latencies),
+            'rps': len(latencies) / elapsed,
+            'p50': _percentile(latencies, 0.50) * 1000,
+            'p95': _percentile(latencies, 0.95) * 1000,
+            'p99': _percentile(latencies, 0.99) * 1000,
+            'errors': len(errors),
+        }
+    finally:
+        for connection in streams:
+            connection.close()
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='app:app')
+    parser.add_argument('--classes', default='sync,gthread,gevent')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per worker class')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent keep-alive clients')
+    parser.add_argument('--streams', type=int, default=0, help='idle /events/stream connections held open')
+    parser.add_argument('--cookie', default='', help='Cookie header for the streams, e.g. session=<sid>')
+    parser.add_argument('--workers', type=int, default=0, help='override WEB_CONCURRENCY')
+    args = parser.parse_args()
+
+    print(f"{'class':<8} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for worker_class in args.classes.split(','):
+        result = run(worker_class.strip(), args)
+        if 'error' in result:
+            print(f"{result['class']:<8} {result['error']}")
+            continue
+        print(f"{result['class']:<8} {result['requests']:>9} {result['rps']:>9.1f} {result['p50']:>8.1f} "
+              f"{result['p95']:>8.1f} {result['p99']:>8.1f} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
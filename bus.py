@@ -0,0 +1,208 @@
+# bus.py
+"""
+In-process domain event bus.
+
+Writes don't call the code that keeps derived data (live events, session
+snapshots, cached counts ...) in step. Instead, every flush records which
+entities changed, the changes are coalesced per entity for the whole
+transaction, and once it commits each registered handler gets one batch:
+
+    @on_commit(Review, fields={'status'})
+    def moderated(changes):
+        for change in changes: ...
+
+Sync handlers run in the committing process right after COMMIT and see the
+column values as they were flushed. The session can no longer run SQL at
+that point, so they read through `changes.bind` if they must. Queued
+handlers (queued=True) run in a job worker and only get each entity's
+identity and changed field names - they load what they need themselves.
+Nothing is dispatched for a rolled-back transaction.
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from jobs import task
+from metrics import inc, observe
+
+logger = logging.getLogger(__name__)
+
+CREATED, UPDATED, DELETED = 'created', 'updated', 'deleted'
+
+HANDLERS = {}
+_watched = set()  # model classes at least one handler cares about
+
+
+@dataclass
+class Change:
+    """
+    One entity's net change in a transaction.
+
+    `values` are the columns that were loaded when it was flushed, `changed`
+    the updated column names and `previous` their old values where those had
+    been loaded.
+    """
+    model: type
+    id: object
+    kind: str
+    changed: set = field(default_factory=set)
+    values: dict = field(default_factory=dict)
+    previous: dict = field(default_factory=dict)
+
+    def merge(self, later):
+        """Folds a later change to the same entity into this one; None if they cancel out."""
+        if self.kind == CREATED and later.kind == DELETED:
+            return None
+        if later.kind == DELETED:
+            kind = DELETED
+        elif self.kind == DELETED:
+            kind = UPDATED  # deleted and re-inserted under the same key
+        else:
+            kind = self.kind
+        values = dict(self.values, **later.values)
+        if kind == CREATED:
+            return Change(self.model, self.id, kind, values=values)
+        # Keep the value from before the transaction; a later flush only knows an intermediate one
+        previous = {k: v for k, v in later.previous.items() if k not in self.changed}
+        previous.update(self.previous)
+        return Change(self.model, self.id, kind, self.changed | later.changed, values, previous)
+
+    def to_job(self):
+        return [self.model.__name__, self.id, self.kind, sorted(self.changed)]
+
+
+class ChangeSet(list):
+    """One handler's share of a commit; `bind` is the engine the transaction ran on."""
+
+    def __init__(self, changes=(), bind=None):
+        super().__init__(changes)
+        self.bind = bind
+
+    def ids(self, model, *kinds):
+        return {c.id for c in self if issubclass(c.model, model) and (not kinds or c.kind in kinds)}
+
+
+@dataclass
+class Handler:
+    fn: object
+    name: str
+    models: tuple
+    fields: frozenset = None
+    kinds: tuple = (CREATED, UPDATED, DELETED)
+    queued: bool = False
+
+    def wants(self, change):
+        if not issubclass(change.model, self.models) or change.kind not in self.kinds:
+            return False
+        return change.kind != UPDATED or self.fields is None or bool(self.fields & change.changed)
+
+
+def on_commit(*models, fields=None, kinds=(CREATED, UPDATED, DELETED), queued=False, name=None):
+    """Registers a handler for committed changes to `models`; `fields` limits which updates count."""
+    def decorator(fn):
+        handler = Handler(fn, name or f"{fn.__module__}.{fn.__name__}", models,
+                          frozenset(fields) if fields else None, tuple(kinds), queued)
+        HANDLERS[handler.name] = handler
+        _watched.update(models)
+        return fn
+    return decorator
+
+
+#--------------------- Collecting
+def _is_watched(obj):
+    return isinstance(obj, tuple(_watched))
+
+
+def _change(obj, kind):
+    state = inspect(obj)
+    mapper = state.mapper
+    key = mapper.primary_key_from_instance(obj)
+    changed, previous = set(), {}
+    if kind == UPDATED:
+        for attr in mapper.column_attrs:
+            history = state.attrs[attr.key].history
+            if history.has_changes():
+                changed.add(attr.key)
+                if history.deleted:
+                    previous[attr.key] = history.deleted[0]
+        if not changed:
+            return None
+    # Only what is already loaded - collecting must never trigger a query
+    values = {attr.key: state.dict[attr.key] for attr in mapper.column_attrs if attr.key in state.dict}
+    return Change(mapper.class_, key[0] if len(key) == 1 else tuple(key), kind, changed, values, previous)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    if not _watched:
+        return
+    pending = session.info.setdefault('bus_changes', {})
+    for objects, kind in ((session.new, CREATED), (session.dirty, UPDATED), (session.deleted, DELETED)):
+        for obj in objects:
+            if not _is_watched(obj):
+                continue
+            change = _change(obj, kind)
+            if change is None:
+                continue
+            key = (change.model, change.id)
+            merged = pending[key].merge(change) if key in pending else change
+            if merged is None:
+                del pending[key]
+            else:
+                pending[key] = merged
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('bus_changes', None)
+
+
+#--------------------- Dispatching
+def _run(handler, changes):
+    started = time.perf_counter()
+    try:
+        handler.fn(changes)
+    except Exception:
+        # The data is already committed; a broken handler must not fail the request
+        logger.exception(f"Commit handler {handler.name} failed")
+        inc('bus_handler_errors_total', handler=handler.name)
+    observe('bus_handler_seconds', time.perf_counter() - started, handler=handler.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch(session):
+    pending = session.info.pop('bus_changes', None)
+    if not pending:
+        return
+    changes = list(pending.values())
+    bind = session.get_bind()
+    for handler in list(HANDLERS.values()):
+        batch = [c for c in changes if handler.wants(c)]
+        if not batch:
+            continue
+        inc('bus_changes_dispatched_total', len(batch), handler=handler.name)
+        if handler.queued:
+            try:
+                dispatch_queued.delay(handler.name, [c.to_job() for c in batch])
+            except Exception as e:
+                logger.error(f"Could not queue commit handler {handler.name}: {e}")
+                inc('bus_handler_errors_total', handler=handler.name)
+        else:
+            _run(handler, ChangeSet(batch, bind))
+
+
+@task('bus.dispatch', queue='default')
+def dispatch_queued(handler_name, changes):
+    handler = HANDLERS.get(handler_name)
+    if handler is None:
+        logger.warning(f"No commit handler named {handler_name}")
+        return
+    models = {model.__name__: model for model in handler.models}
+    batch = ChangeSet(
+        Change(models[name], tuple(pk) if isinstance(pk, list) else pk, kind, set(changed))
+        for name, pk, kind, changed in changes if name in models
+    )
+    handler.fn(batch)
@@ -0,0 +1,238 @@
+# cache.py
+"""
+Two-tier cache for hot rows (services, companies, the category list).
+
+Tier 1 is a small LRU (with a TTL) in each process, tier 2 is Redis, shared
+by all of them. Every key has a version counter in Redis. An entry is
+stamped with the version it was loaded under, and a reader only accepts it
+while that stamp is still the current version, so a value read from the
+database just before a write is never served after it.
+
+Invalidating bumps the versions and broadcasts them on one pub/sub channel.
+Each process drops its local copies when the message arrives. The local TTL
+bounds staleness should a message be lost while the listener reconnects.
+
+    services.get_many([5, 6])   # {5: {...}, 6: {...}}
+    services.invalidate(5)
+"""
+import json
+import logging
+import threading
+import time
+
+import redis
+from cachetools import TTLCache
+
+from application import redis_client
+from bus import CREATED, DELETED, on_commit
+from metrics import inc, register_collector
+import reads
+from models import Category, Company, Service
+from serializers import category_serializer, company_serializer, dumps, service_serializer
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+
+REGIONS = {}
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class Region:
+    """
+    One kind of cached value. `loader(keys)` returns {key: value} for the keys
+    it found; values must be JSON-serializable.
+    """
+
+    def __init__(self, name, loader, ttl=3600, local_ttl=30, local_size=2048):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=local_size, ttl=local_ttl)
+        # Newest version announced per key; a load that started earlier must not refill the local tier
+        self.announced = TTLCache(maxsize=local_size, ttl=local_ttl)
+        self.lock = threading.Lock()
+        REGIONS[name] = self
+
+    def _key(self, key):
+        return f"cache:{self.name}:{key}"
+
+    def _version_key(self, key):
+        return f"cache:{self.name}:{key}:v"
+
+    def _remember(self, key, version, value):
+        with self.lock:
+            if self.announced.get(key, -1) <= version:
+                self.local[key] = (version, value)
+
+    def drop(self, key, version=None):
+        """Forgets the local copy of `key` if it is older than `version` (any copy when None)."""
+        key = str(key)
+        with self.lock:
+            if version is not None and self.announced.get(key, -1) < version:
+                self.announced[key] = version
+            entry = self.local.get(key)
+            if entry is not None and (version is None or entry[0] < version):
+                del self.local[key]
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+
+    def _count(self, tier, result, value):
+        if value:
+            inc('cache_requests_total', value, region=self.name, tier=tier, result=result)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        _ensure_listener()
+        found, missing = {}, []
+        with self.lock:
+            for key in keys:
+                entry = self.local.get(str(key))
+                if entry is None:
+                    missing.append(key)
+                else:
+                    found[key] = entry[1]
+        self._count('local', 'hit', len(found))
+        self._count('local', 'miss', len(missing))
+        if not missing:
+            return found
+
+        versions = {}
+        try:
+            raw = redis_client.mget([self._key(k) for k in missing] + [self._version_key(k) for k in missing])
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Cache {self.name} unavailable, reading through: {e}")
+            inc('cache_errors_total', region=self.name)
+            raw = None
+        if raw is not None:
+            still_missing = []
+            for key, entry, version in zip(missing, raw[:len(missing)], raw[len(missing):]):
+                versions[key] = version = int(version or 0)
+                if entry is not None:
+                    stamp, value = json.loads(entry)
+                    if stamp == version:
+                        found[key] = value
+                        self._remember(str(key), version, value)
+                        continue
+                still_missing.append(key)
+            self._count('redis', 'hit', len(missing) - len(still_missing))
+            self._count('redis', 'miss', len(still_missing))
+            missing = still_missing
+        if not missing:
+            return found
+
+        loaded = self.loader(missing)
+        found.update(loaded)
+        if versions:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for key, value in loaded.items():
+                    pipe.set(self._key(key), dumps([versions[key], value]), ex=self.ttl)
+                pipe.execute()
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Could not fill cache {self.name}: {e}")
+            for key, value in loaded.items():
+                self._remember(str(key), versions[key], value)
+        return found
+
+    def invalidate(self, *keys):
+        """Bumps the keys' versions and tells every process to drop its copies."""
+        if not keys:
+            return
+        versions = {}
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.incr(self._version_key(key))
+            pipe.delete(*(self._key(k) for k in keys))
+            versions = dict(zip((str(k) for k in keys), pipe.execute()))
+            redis_client.publish(INVALIDATION_CHANNEL, json.dumps([self.name, versions]))
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not invalidate cache {self.name}: {e}")
+            inc('cache_errors_total', region=self.name)
+        for key in keys:
+            self.drop(key, versions.get(str(key)))
+        inc('cache_invalidations_total', len(keys), region=self.name)
+
+
+#--------------------- Cross-process invalidation
+def _apply(message):
+    name, versions = json.loads(message)
+    region = REGIONS.get(name)
+    if region is not None:
+        for key, version in versions.items():
+            region.drop(key, version)
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Whatever was published while we weren't subscribed is lost; start clean
+            for region in REGIONS.values():
+                region.clear_local()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message:
+                    _apply(message['data'])
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Cache invalidation listener lost Redis, reconnecting: {e}")
+            time.sleep(1)
+
+
+def _ensure_listener():
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = threading.Thread(target=_listen, name='cache-invalidation', daemon=True)
+                _listener.start()
+
+
+def reset():
+    """After fork: the listener thread stayed in the parent and its local copies may be stale."""
+    global _listener
+    _listener = None
+    for region in REGIONS.values():
+        region.clear_local()
+
+
+@register_collector
+def _collect_cache_metrics():
+    for region in REGIONS.values():
+        yield 'cache_local_entries', {'region': region.name}, len(region.local)
+
+
+#--------------------- Regions
+def _load_services(ids):
+    return {row.id: service_serializer.dump(row) for row in reads.services(ids)}
+
+
+def _load_companies(ids):
+    return {c.id: company_serializer.dump(c) for c in Company.query.filter(Company.id.in_(ids))}
+
+
+def _load_category_list(keys):
+    return {'all': category_serializer.dump_many(reads.categories())}
+
+
+services = Region('services', _load_services)
+companies = Region('companies', _load_companies)
+category_list = Region('category_list', _load_category_list, local_size=1)
+
+
+@on_commit(Service, Company, Category)
+def _invalidate_changed(changes):
+    services.invalidate(*changes.ids(Service))
+    companies.invalidate(*changes.ids(Company))
+    # The list carries total_services, so placing or removing a service changes it too
+    moved = any(c.model is Service and (c.kind in (CREATED, DELETED) or 'category_id' in c.changed) for c in changes)
+    if changes.ids(Category) or moved:
+        category_list.invalidate('all')
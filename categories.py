@@ -0,0 +1,281 @@
+# categories.py
+"""
+Category tree.
+
+Categories nest through parent_id and carry a materialized `path` of ids
+("/1/4/9/"). Each category counts its own services (service_count) and those
+of its whole subtree (total_services). Both counts are updated in the same
+transaction as the Service insert, move or delete, with one UPDATE over the
+ancestor ids read off the path.
+
+The tree is served as one JSON document cached in Redis under a version
+number. A commit handler bumps the version only when categories or service
+placement change, so clients can revalidate with the version as an ETag.
+"""
+import json
+import logging
+import threading
+
+import redis
+from sqlalchemy import case, event, func, inspect, literal, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from application import redis_client
+from bus import on_commit
+from extensions import db
+from jobs import task
+from metrics import inc
+from models import Category, Service
+from serializers import dumps
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'categories:tree:version'
+DOCUMENT_TTL = 24 * 3600
+
+_local = None  # (version, raw document, parsed document) last served by this process
+_local_lock = threading.Lock()
+
+
+class CategoryTreeError(ValueError):
+    pass
+
+
+def ancestor_ids(path):
+    """'/1/4/9/' -> [1, 4, 9] (the category itself is last)."""
+    return [int(part) for part in (path or '').split('/') if part]
+
+
+def _path_of(connection, category_id):
+    if category_id is None:
+        return '/'
+    table = Category.__table__
+    return connection.execute(select(table.c.path).where(table.c.id == category_id)).scalar() or '/'
+
+
+def subtree_ids(category):
+    """Ids of the category and everything below it (one indexed prefix scan)."""
+    if not category.path:
+        return {category.id}
+    return set(db.session.execute(select(Category.id).where(Category.path.like(f"{category.path}%"))).scalars())
+
+
+#--------------------- Counts
+def _bump(connection, category_id, delta):
+    table = Category.__table__
+    ids = ancestor_ids(_path_of(connection, category_id)) or [category_id]
+    connection.execute(
+        table.update()
+        .where(table.c.id.in_(ids))
+        .values(
+            total_services=table.c.total_services + delta,
+            service_count=table.c.service_count + case((table.c.id == category_id, delta), else_=0),
+        )
+    )
+
+
+def _service_inserted(mapper, connection, target):
+    _bump(connection, target.category_id, 1)
+
+
+def _service_updated(mapper, connection, target):
+    history = inspect(target).attrs.category_id.history
+    if history.deleted and history.added and history.deleted[0] != history.added[0]:
+        _bump(connection, history.deleted[0], -1)
+        _bump(connection, history.added[0], 1)
+
+
+def _service_deleted(mapper, connection, target):
+    _bump(connection, target.category_id, -1)
+
+
+event.listen(Service, 'after_insert', _service_inserted)
+event.listen(Service, 'after_update', _service_updated)
+event.listen(Service, 'after_delete', _service_deleted)
+
+
+#--------------------- Paths
+def _category_inserted(mapper, connection, target):
+    path = f"{_path_of(connection, target.parent_id)}{target.id}/"
+    depth = len(ancestor_ids(path)) - 1
+    table = Category.__table__
+    connection.execute(table.update().where(table.c.id == target.id).values(path=path, depth=depth))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+
+def _category_updating(mapper, connection, target):
+    history = inspect(target).attrs.parent_id.history
+    if not history.has_changes():
+        return
+    new_parent = history.added[0] if history.added else None
+    if new_parent is not None and f"/{target.id}/" in _path_of(connection, new_parent):
+        raise CategoryTreeError("A category can't be moved under itself or one of its subcategories")
+
+
+def _category_updated(mapper, connection, target):
+    """Re-roots the subtree under the new parent and moves its counts with it."""
+    history = inspect(target).attrs.parent_id.history
+    if not history.has_changes():
+        return
+    table = Category.__table__
+    old_path, subtree_total = connection.execute(
+        select(table.c.path, table.c.total_services).where(table.c.id == target.id)
+    ).one()
+    parent_path = _path_of(connection, target.parent_id)
+    new_path = f"{parent_path}{target.id}/"
+    depth_change = len(ancestor_ids(new_path)) - len(ancestor_ids(old_path))
+
+    connection.execute(
+        table.update()
+        .where(table.c.path.like(f"{old_path}%"))
+        .values(
+            path=literal(new_path) + func.substr(table.c.path, len(old_path) + 1),
+            depth=table.c.depth + depth_change,
+        )
+    )
+    if subtree_total:
+        old_ancestors = ancestor_ids(old_path)[:-1]
+        new_ancestors = ancestor_ids(parent_path)
+        if old_ancestors:
+            connection.execute(table.update().where(table.c.id.in_(old_ancestors))
+                               .values(total_services=table.c.total_services - subtree_total))
+        if new_ancestors:
+            connection.execute(table.update().where(table.c.id.in_(new_ancestors))
+                               .values(total_services=table.c.total_services + subtree_total))
+    set_committed_value(target, 'path', new_path)
+    set_committed_value(target, 'depth', len(ancestor_ids(new_path)) - 1)
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_deletes(session, flush_context, instances):
+    """Refuses to delete a non-empty category before the flush would orphan its services."""
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Category)]
+    if not deleted:
+        return
+    table = Category.__table__
+    connection = session.connection()
+    busy = connection.execute(
+        select(table.c.id).where(table.c.id.in_(deleted), table.c.service_count > 0)
+        .union(select(table.c.parent_id).where(table.c.parent_id.in_(deleted)))
+        .limit(1)
+    ).first()
+    if busy:
+        raise CategoryTreeError("Only empty categories without subcategories can be deleted")
+
+
+event.listen(Category, 'after_insert', _category_inserted)
+event.listen(Category, 'before_update', _category_updating)
+event.listen(Category, 'after_update', _category_updated)
+
+
+@task('categories.rebuild')
+def rebuild_tree():
+    """Recomputes every path, depth and count from scratch (after a bulk import or schema change)."""
+    rows = db.session.execute(select(Category.id, Category.parent_id)).all()
+    parents = dict(rows)
+    direct = dict(db.session.execute(select(Service.category_id, func.count(Service.id)).group_by(Service.category_id)).all())
+
+    paths = {}
+
+    def path_of(category_id, seen=()):
+        if category_id not in paths:
+            parent = parents.get(category_id)
+            if parent is None or parent in seen or parent not in parents:
+                paths[category_id] = f"/{category_id}/"
+            else:
+                paths[category_id] = f"{path_of(parent, seen + (category_id,))}{category_id}/"
+        return paths[category_id]
+
+    totals = dict.fromkeys(parents, 0)
+    for category_id in parents:
+        for ancestor in ancestor_ids(path_of(category_id)):
+            totals[ancestor] += direct.get(category_id, 0)
+
+    if parents:
+        # Bulk UPDATE by primary key; skips the mapper events above
+        db.session.execute(update(Category), [
+            {'id': category_id, 'path': paths[category_id], 'depth': len(ancestor_ids(paths[category_id])) - 1,
+             'service_count': direct.get(category_id, 0), 'total_services': totals[category_id]}
+            for category_id in parents
+        ])
+    db.session.commit()
+    _bump_version()
+    return len(parents)
+
+
+#--------------------- Cached tree document
+def tree_version():
+    try:
+        return int(redis_client.get(VERSION_KEY) or 0)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Category tree version unavailable: {e}")
+        return None
+
+
+def _bump_version():
+    try:
+        redis_client.incr(VERSION_KEY)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not bump category tree version: {e}")
+
+
+@on_commit(Category)
+def _categories_changed(changes):
+    _bump_version()
+
+
+@on_commit(Service, fields={'category_id'})
+def _services_moved(changes):
+    _bump_version()
+
+
+def build_tree():
+    """The whole tree as nested dicts, children ordered by name; one query."""
+    rows = db.session.execute(
+        select(Category.id, Category.name, Category.parent_id, Category.service_count, Category.total_services)
+        .order_by(Category.depth, Category.name)
+    ).all()
+    nodes, roots = {}, []
+    for category_id, name, parent_id, service_count, total_services in rows:
+        node = {'id': category_id, 'name': name, 'service_count': service_count,
+                'total_services': total_services, 'children': []}
+        nodes[category_id] = node
+        (nodes[parent_id]['children'] if parent_id in nodes else roots).append(node)
+    return roots
+
+
+def category_tree():
+    """
+    Returns (version, raw JSON bytes, parsed document) for the current tree.
+
+    A process reuses its last document while the version is unchanged, so the
+    steady-state cost is one Redis GET. Without Redis the tree is rebuilt on
+    every call and the version is None.
+    """
+    global _local
+    version = tree_version()
+    if version is not None and _local and _local[0] == version:
+        return _local
+
+    raw = None
+    if version is not None:
+        try:
+            raw = redis_client.get(f"{VERSION_KEY}:{version}")
+        except redis.exceptions.RedisError:
+            pass
+    if raw is None:
+        inc('category_tree_builds_total')
+        raw = dumps({'version': version, 'categories': build_tree()})
+        if version is not None:
+            try:
+                redis_client.set(f"{VERSION_KEY}:{version}", raw, ex=DOCUMENT_TTL)
+            except redis.exceptions.RedisError:
+                pass
+
+    document = (version, raw, json.loads(raw))
+    if version is not None:
+        with _local_lock:
+            _local = document
+    return document
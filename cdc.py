@@ -0,0 +1,277 @@
+# cdc.py
+"""
+Incremental change export for analytics.
+
+Analysts read files, not the primary. Every EXPORT_INTERVAL, cdc.export
+copies the rows of TABLES that changed since the last run into
+
+    <CDC_EXPORT_DIR>/<table>/dt=YYYY-MM-DD/part-<run>-<n>-<uuid>.parquet
+
+partitioned by the date of the change. Files are Parquet when pyarrow is
+installed and gzipped NDJSON otherwise. With sharding on, bookings and
+transactions are exported from every shard, each with its own watermark
+('<table>@<shard>'), into the same partitions.
+
+- Changes are found through the updated_at index, resuming from the
+  (updated_at, id) watermark of the last run. A run never reads more than
+  what changed. Rows changed in the last SETTLE seconds are left for the
+  next run, so transactions still in flight at that time are not skipped.
+- Each record carries _op ('upsert' or 'delete'), _version and _changed_at.
+  Deletes come from cdc_tombstones, written in the deleting transaction.
+- Delivery is at-least-once. A run that dies after writing a file exports
+  the same rows again, so readers keep the highest _version per id.
+- cdc.compact rewrites each closed partition into a single file holding
+  only the latest record per id, and prunes tombstones every table has
+  exported.
+
+Secrets and contact details of users are never exported (EXCLUDED_COLUMNS).
+"""
+import gzip
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, delete, event, insert, literal, or_, select
+
+from extensions import SHARDED_TABLES, db
+from jobs import periodic
+from metrics import inc, set_gauge
+from models import Booking, CdcTombstone, CdcWatermark, Review, Transaction, User
+from serializers import dumps
+import sharding
+
+# ✅ Parquet when pyarrow is installed, gzipped NDJSON otherwise (as ledger archives)
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+TABLES = {model.__tablename__: model for model in (Transaction, Booking, Review, User)}
+EXCLUDED_COLUMNS = {'users': {'password_hash', 'email', 'phone_number', 'stripe_customer_id'}}
+SETTLE = timedelta(seconds=int(os.getenv('CDC_SETTLE_SECONDS', 60)))
+TOMBSTONE_RETENTION = timedelta(days=30)
+EXPORT_INTERVAL = 300
+COMPACT_INTERVAL = 24 * 3600
+EXPORT_BATCH = 10000
+
+
+#--------------------- Tombstones
+def _record_tombstone(mapper, connection, target):
+    # Copies the row's id and next version while the row still exists
+    table = mapper.local_table
+    connection.execute(
+        insert(CdcTombstone.__table__).from_select(
+            ['table_name', 'row_id', 'version', 'deleted_at'],
+            select(literal(table.name), table.c.id, table.c.version + 1, literal(datetime.utcnow()))
+            .where(table.c.id == target.id),
+        )
+    )
+
+
+for _model in TABLES.values():
+    event.listen(_model, 'before_delete', _record_tombstone)
+
+
+#--------------------- Files
+def extension():
+    return 'parquet' if pyarrow is not None else 'ndjson.gz'
+
+
+def write_records(records, path):
+    """Writes to path.partial and renames, so readers never see half a file."""
+    partial = path + '.partial'
+    try:
+        if pyarrow is not None:
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records), partial, compression='zstd')
+        else:
+            with gzip.open(partial, 'wb') as f:
+                for record in records:
+                    f.write(dumps(record) + b'\n')
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def read_records(path):
+    if path.endswith('.parquet'):
+        return pyarrow.parquet.read_table(path).to_pylist()
+    with gzip.open(path, 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+def _partition(table_name, changed_at):
+    return os.path.join(current_app.config['CDC_EXPORT_DIR'], table_name, f"dt={changed_at:%Y-%m-%d}")
+
+
+def _write_partitions(table_name, records, run, sequence):
+    by_day = defaultdict(list)
+    for record in records:
+        by_day[_partition(table_name, record['_changed_at'])].append(record)
+    shard = sharding.current_shard()
+    prefix = f"part-{run}" if shard == sharding.PRIMARY else f"part-{run}-s{shard}"
+    for directory, chunk in by_day.items():
+        os.makedirs(directory, exist_ok=True)
+        # The uuid keeps two exports of the same run second (overlapping workers, a retry) from overwriting each other
+        write_records(chunk, os.path.join(directory, f"{prefix}-{sequence:04d}-{uuid.uuid4().hex}.{extension()}"))
+        inc('cdc_files_written_total', table=table_name)
+
+
+#--------------------- Export
+def _shards(table_name):
+    return sharding.shard_names() if table_name in SHARDED_TABLES else [sharding.PRIMARY]
+
+
+def _watermark_key(table_name):
+    # Watermarks live on the primary; each shard of a table has its own
+    shard = sharding.current_shard()
+    return table_name if shard == sharding.PRIMARY else f"{table_name}@{shard}"
+
+
+def _columns(table_name):
+    excluded = EXCLUDED_COLUMNS.get(table_name, set())
+    return [c for c in TABLES[table_name].__table__.columns if c.name not in excluded]
+
+
+def _changed_rows(table_name, watermark, cutoff):
+    table = TABLES[table_name].__table__
+    query = select(*_columns(table_name)).where(table.c.updated_at <= cutoff)
+    if watermark.updated_at is not None:
+        query = query.where(or_(
+            table.c.updated_at > watermark.updated_at,
+            and_(table.c.updated_at == watermark.updated_at, table.c.id > watermark.row_id),
+        ))
+    return db.session.execute(query.order_by(table.c.updated_at, table.c.id).limit(EXPORT_BATCH)).all()
+
+
+def _tombstones(table_name, watermark, cutoff):
+    return db.session.execute(
+        select(CdcTombstone)
+        .where(CdcTombstone.table_name == table_name, CdcTombstone.id > watermark.tombstone_id,
+               CdcTombstone.deleted_at <= cutoff)
+        .order_by(CdcTombstone.id)
+        .limit(EXPORT_BATCH)
+    ).scalars().all()
+
+
+def export_table(table_name, now=None):
+    """Writes what changed in one table, on the shard in context, since its watermark; returns the record count."""
+    now = now or datetime.utcnow()
+    cutoff = now - SETTLE
+    run = f"{now:%Y%m%dT%H%M%S}"
+    key = _watermark_key(table_name)
+    watermark = db.session.get(CdcWatermark, key) or CdcWatermark(table_name=key, row_id=0, tombstone_id=0)
+    db.session.add(watermark)
+    total, sequence = 0, 0
+
+    # Keyset batches; the watermark is committed after each batch's files are in place
+    while True:
+        rows = _changed_rows(table_name, watermark, cutoff)
+        if not rows:
+            break
+        records = [dict(row._mapping, _op='upsert', _version=row.version, _changed_at=row.updated_at) for row in rows]
+        _write_partitions(table_name, records, run, sequence)
+        watermark.updated_at, watermark.row_id = rows[-1].updated_at, rows[-1].id
+        db.session.commit()
+        inc('cdc_rows_exported_total', len(rows), table=table_name, op='upsert')
+        total, sequence = total + len(rows), sequence + 1
+        if len(rows) < EXPORT_BATCH:
+            break
+
+    while True:
+        tombstones = _tombstones(table_name, watermark, cutoff)
+        if not tombstones:
+            break
+        records = [{'id': t.row_id, '_op': 'delete', '_version': t.version, '_changed_at': t.deleted_at}
+                   for t in tombstones]
+        _write_partitions(table_name, records, run, sequence)
+        watermark.tombstone_id = tombstones[-1].id
+        db.session.commit()
+        inc('cdc_rows_exported_total', len(tombstones), table=table_name, op='delete')
+        total, sequence = total + len(tombstones), sequence + 1
+        if len(tombstones) < EXPORT_BATCH:
+            break
+
+    watermark.exported_at = now
+    db.session.commit()
+    if watermark.updated_at is not None:
+        set_gauge('cdc_export_lag_seconds', (now - watermark.updated_at).total_seconds(),
+                  table=table_name, shard=sharding.current_shard())
+    return total
+
+
+@periodic(EXPORT_INTERVAL, name='cdc.export', max_retries=0)
+def export_changes():
+    now = datetime.utcnow()
+    totals = {}
+    for table_name in TABLES:
+        for shard in _shards(table_name):
+            with sharding.use_shard(shard):
+                totals[table_name] = totals.get(table_name, 0) + export_table(table_name, now)
+    return totals
+
+
+#--------------------- Compaction
+def _newer(record, current):
+    # A delete outranks an upsert of the same version
+    return current is None or (record['_version'] or 0, record['_op'] == 'delete') >= \
+        (current['_version'] or 0, current['_op'] == 'delete')
+
+
+def compact_partition(directory):
+    """Rewrites a partition's part files as one, keeping the latest record per id; returns the record count."""
+    parts = sorted(name for name in os.listdir(directory) if name.startswith('part-') and not name.endswith('.partial'))
+    if len(parts) < 2:
+        return None
+    latest = {}
+    for name in parts:
+        for record in read_records(os.path.join(directory, name)):
+            if _newer(record, latest.get(record['id'])):
+                latest[record['id']] = record
+
+    # If we die before the deletes below, the next run folds the leftovers in again
+    path = os.path.join(directory, f"part-{datetime.utcnow():%Y%m%dT%H%M%S}-compacted-{uuid.uuid4().hex}.{extension()}")
+    write_records(sorted(latest.values(), key=lambda r: r['id']), path)
+    for name in parts:
+        os.remove(os.path.join(directory, name))
+    inc('cdc_partitions_compacted_total')
+    return len(latest)
+
+
+@periodic(COMPACT_INTERVAL, name='cdc.compact', max_retries=0)
+def compact(now=None):
+    """Compacts every partition before today and drops tombstones all tables have exported."""
+    now = now or datetime.utcnow()
+    today = f"dt={now:%Y-%m-%d}"
+    root = current_app.config['CDC_EXPORT_DIR']
+    compacted = 0
+    for table_name in TABLES:
+        table_dir = os.path.join(root, table_name)
+        if not os.path.isdir(table_dir):
+            continue
+        for partition in sorted(os.listdir(table_dir)):
+            if partition.startswith('dt=') and partition < today:
+                if compact_partition(os.path.join(table_dir, partition)) is not None:
+                    compacted += 1
+
+    watermarks = dict(db.session.execute(select(CdcWatermark.table_name, CdcWatermark.tombstone_id)).all())
+    for table_name in TABLES:
+        for shard in _shards(table_name):
+            with sharding.use_shard(shard):
+                tombstone_id = watermarks.get(_watermark_key(table_name))
+                if tombstone_id is None:
+                    continue
+                db.session.execute(delete(CdcTombstone).where(
+                    CdcTombstone.table_name == table_name, CdcTombstone.id <= tombstone_id,
+                    CdcTombstone.deleted_at < now - TOMBSTONE_RETENTION,
+                ))
+                db.session.commit()
+    logger.info(f"Compacted {compacted} CDC partitions")
+    return compacted
@@ -0,0 +1,257 @@
+# devices.py
+"""
+Device tokens and FCM topic segments.
+
+Every app install registers its FCM token here. A token is subscribed to
+the topics that match its user:
+- 'default-topic' (everyone);
+- one topic per city the user has an address in ('city-tashkent');
+- one topic per category the user has booked ('category-3').
+
+A segment broadcast is then a single send to a topic, or to a condition
+over two topics, and FCM does the fan-out.
+
+Topic membership is stored per token, so a sync only subscribes and
+unsubscribes the difference, at most 1,000 tokens per FCM call. A token is
+deleted as soon as FCM reports it unregistered or invalid. That can come
+from topic management, multicast sends or single sends.
+"""
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from firebase_admin import messaging
+from sqlalchemy import delete, select
+from sqlalchemy.orm import selectinload
+
+from bus import CREATED, on_commit
+from extensions import db
+from jobs import periodic, task
+from metrics import inc
+from models import Address, Booking, DeviceToken, DeviceTopic, Service
+from resilience import firebase
+import sharding
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_TOPIC = 'default-topic'
+PLATFORMS = ('android', 'ios', 'web')
+TOPIC_BATCH = 1000  # FCM limit per subscribe/unsubscribe call
+MULTICAST_BATCH = 500  # FCM limit per multicast send
+STALE_AFTER = timedelta(days=60)
+PRUNE_INTERVAL = 24 * 3600
+
+# Topic management error reasons that mean the token itself is dead
+DEAD_TOKEN_REASONS = {'NOT_FOUND', 'INVALID_ARGUMENT'}
+# Send errors that mean the same
+DEAD_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
+
+def category_topic(category_id):
+    return f"category-{category_id}"
+
+
+def city_topic(city):
+    """'Tashkent' -> 'city-tashkent'; other scripts are percent-encoded (allowed in topic names)."""
+    slug = re.sub(r'\s+', '-', (city or '').strip().lower())
+    return f"city-{quote(slug, safe='')}" if slug else None
+
+
+def user_topics(user_id):
+    cities = db.session.execute(select(Address.city).where(Address.user_id == user_id).distinct()).scalars()
+    # Bookings may sit on any shard; the services they point at are on the primary
+    service_ids = set(sharding.gather(sharding.scatter(lambda: db.session.execute(
+        select(Booking.service_id).where(Booking.user_id == user_id).distinct()
+    ).scalars().all())))
+    categories = db.session.execute(
+        select(Service.category_id).where(Service.id.in_(service_ids)).distinct()
+    ).scalars() if service_ids else ()
+    topics = {BROADCAST_TOPIC} | {city_topic(c) for c in cities} | {category_topic(c) for c in categories}
+    topics.discard(None)
+    return topics
+
+
+#--------------------- Registry
+def register_device(user_id, token, platform):
+    """Records the install's token (moving it if another account had it) and queues a topic sync."""
+    device = DeviceToken.query.filter_by(token=token).first()
+    if device is None:
+        device = DeviceToken(user_id=user_id, token=token)
+        db.session.add(device)
+    device.user_id = user_id
+    device.platform = platform
+    device.last_seen_at = datetime.utcnow()
+    db.session.commit()
+    sync_user_topics.delay(user_id)
+    return device
+
+
+def unregister_device(user_id, token):
+    """Forgets a token on sign-out; it stays valid at FCM, so it also leaves its topics."""
+    device = DeviceToken.query.filter_by(token=token, user_id=user_id).first()
+    if device is None:
+        return False
+    topics = [t.topic for t in device.topics]
+    db.session.delete(device)
+    db.session.commit()
+    for topic in topics:
+        unsubscribe_token.delay(token, topic)
+    return True
+
+
+def prune_tokens(tokens):
+    """Deletes dead tokens and their topic rows."""
+    if not tokens:
+        return 0
+    ids = db.session.execute(select(DeviceToken.id).where(DeviceToken.token.in_(tokens))).scalars().all()
+    if ids:
+        db.session.execute(delete(DeviceTopic).where(DeviceTopic.device_id.in_(ids)))
+        db.session.execute(delete(DeviceToken).where(DeviceToken.id.in_(ids)))
+        db.session.commit()
+        inc('fcm_tokens_pruned_total', len(ids))
+    return len(ids)
+
+
+#--------------------- Topic management
+def _record(tokens, topic, subscribed):
+    if not tokens:
+        return
+    ids = set(db.session.execute(select(DeviceToken.id).where(DeviceToken.token.in_(tokens))).scalars())
+    if subscribed:
+        existing = set(db.session.execute(
+            select(DeviceTopic.device_id).where(DeviceTopic.topic == topic, DeviceTopic.device_id.in_(ids))
+        ).scalars())
+        db.session.add_all(DeviceTopic(device_id=i, topic=topic) for i in ids - existing)
+    else:
+        db.session.execute(delete(DeviceTopic).where(DeviceTopic.topic == topic, DeviceTopic.device_id.in_(ids)))
+    db.session.commit()
+
+
+def _manage(tokens, topic, subscribe):
+    call = messaging.subscribe_to_topic if subscribe else messaging.unsubscribe_from_topic
+    action = 'subscribe' if subscribe else 'unsubscribe'
+    done, dead = [], []
+    for start in range(0, len(tokens), TOPIC_BATCH):
+        batch = tokens[start:start + TOPIC_BATCH]
+        response = firebase.call(call, batch, topic)
+        failed = {error.index: error.reason for error in response.errors}
+        for index, token in enumerate(batch):
+            reason = failed.get(index)
+            if reason is None:
+                done.append(token)
+            elif reason in DEAD_TOKEN_REASONS:
+                dead.append(token)
+            else:
+                logger.warning(f"FCM could not {action} a token to {topic}: {reason}")
+        inc('fcm_topic_calls_total', action=action)
+        inc('fcm_topic_tokens_total', response.success_count, action=action, result='ok')
+        inc('fcm_topic_tokens_total', response.failure_count, action=action, result='failed')
+    _record(done, topic, subscribe)
+    prune_tokens(dead)
+    return len(done)
+
+
+def subscribe(tokens, topic):
+    """Subscribes tokens to a topic in batches of TOPIC_BATCH; returns how many succeeded."""
+    return _manage(list(tokens), topic, True)
+
+
+def unsubscribe(tokens, topic):
+    return _manage(list(tokens), topic, False)
+
+
+@task('devices.unsubscribe_token', queue='notifications')
+def unsubscribe_token(token, topic):
+    firebase.call(messaging.unsubscribe_from_topic, [token], topic)
+
+
+@task('devices.sync_user_topics', queue='notifications')
+def sync_user_topics(user_id):
+    """Brings every token of the user to exactly user_topics(), sending one call per topic that changed."""
+    devices = DeviceToken.query.options(selectinload(DeviceToken.topics)).filter_by(user_id=user_id).all()
+    if not devices:
+        return
+    wanted = user_topics(user_id)
+    to_add, to_remove = defaultdict(list), defaultdict(list)
+    for device in devices:
+        current = {t.topic for t in device.topics}
+        for topic in wanted - current:
+            to_add[topic].append(device.token)
+        for topic in current - wanted:
+            to_remove[topic].append(device.token)
+    for topic, tokens in to_add.items():
+        subscribe(tokens, topic)
+    for topic, tokens in to_remove.items():
+        unsubscribe(tokens, topic)
+
+
+@on_commit(Address)
+@on_commit(Booking, kinds=(CREATED,), name='devices._resync_booked')
+def _resync_topics(changes):
+    # A new city or a first booking in a category changes the user's segments
+    user_ids = {v for c in changes for v in (c.values.get('user_id'), c.previous.get('user_id')) if v}
+    for user_id in user_ids:
+        sync_user_topics.delay(user_id)
+
+
+@periodic(PRUNE_INTERVAL, name='devices.prune_stale')
+def prune_stale_tokens():
+    """Forgets installs that haven't checked in for STALE_AFTER; FCM expires such tokens too."""
+    cutoff = datetime.utcnow() - STALE_AFTER
+    tokens = db.session.execute(select(DeviceToken.token).where(DeviceToken.last_seen_at < cutoff)).scalars().all()
+    return prune_tokens(tokens)
+
+
+#--------------------- Sending
+def _multicast(message):
+    # Each token is its own request, so an outage shows up as per-token errors, not an exception
+    response = messaging.send_each_for_multicast(message)
+    errors = [r.exception for r in response.responses if not r.success]
+    if errors and not response.success_count and all(isinstance(e, firebase.failures) for e in errors):
+        raise errors[0]
+    return response
+
+
+@task('devices.send_to_user', queue='notifications')
+def send_to_user(user_id, title, body, data=None):
+    """Pushes to every install of one user; returns how many were delivered."""
+    tokens = db.session.execute(select(DeviceToken.token).where(DeviceToken.user_id == user_id)).scalars().all()
+    delivered, dead = 0, []
+    for start in range(0, len(tokens), MULTICAST_BATCH):
+        batch = tokens[start:start + MULTICAST_BATCH]
+        response = firebase.call(_multicast, messaging.MulticastMessage(
+            tokens=batch,
+            notification=messaging.Notification(title=title, body=body),
+            data=data,
+        ))
+        delivered += response.success_count
+        for token, result in zip(batch, response.responses):
+            if not result.success and isinstance(result.exception, DEAD_TOKEN_ERRORS):
+                dead.append(token)
+    prune_tokens(dead)
+    inc('fcm_messages_sent_total', delivered, target='user')
+    return delivered
+
+
+def segment_target(category_id=None, city=None):
+    """topic or condition kwargs for a messaging.Message aimed at a segment (everyone when both are None)."""
+    topics = [t for t in (category_topic(category_id) if category_id else None, city_topic(city)) if t]
+    if not topics:
+        return {'topic': BROADCAST_TOPIC}
+    if len(topics) == 1:
+        return {'topic': topics[0]}
+    return {'condition': ' && '.join(f"'{t}' in topics" for t in topics)}
+
+
+@task('notifications.broadcast_segment', queue='notifications')
+def broadcast_to_segment(title, body, category_id=None, city=None):
+    """One send; FCM delivers it to every token in the segment's topics."""
+    message = messaging.Message(
+        notification=messaging.Notification(title=title, body=body),
+        **segment_target(category_id, city),
+    )
+    response = firebase.call(messaging.send, message)
+    inc('fcm_messages_sent_total', target='segment')
+    logger.info(f"Broadcast to {segment_target(category_id, city)}: {response}")
@@ -0,0 +1,246 @@
+# events.py
+"""
+Live updates over Server-Sent Events.
+
+Booking, Notification and review moderation changes are published to
+per-user / per-company channels by a commit handler on the domain event
+bus (bus.py), so nothing goes out for a rolled-back transaction. Each process holds a single broker connection
+(Redis pub/sub, or an in-process broker for development) and fans messages
+out to its open streams, so an idle stream costs one queue and no queries.
+
+Run the web app with an async worker so idle streams don't pin a thread each:
+
+    WEB_WORKER_CLASS=gevent gunicorn app:app
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+import redis
+from flask import Blueprint, Response, jsonify, session, stream_with_context
+from sqlalchemy import select
+
+from bus import CREATED, UPDATED, on_commit
+from metrics import inc, register_collector
+from models import Booking, Notification, Review, Service
+from serializers import Serializer, dumps
+
+logger = logging.getLogger(__name__)
+
+events = Blueprint("events", __name__)
+
+CHANNEL_PREFIX = 'events:'
+HEARTBEAT_INTERVAL = 20  # seconds; keeps proxies from closing idle streams
+RETRY_MS = 5000
+MAX_PENDING = 100  # per stream; a client that falls this far behind loses events
+
+booking_event_serializer = Serializer('id', 'user_id', 'service_id', 'date', 'time', 'status')
+notification_event_serializer = Serializer('id', 'title', 'message', 'timestamp')
+review_event_serializer = Serializer('id', 'user_id', 'service_id', 'rating', 'status')
+
+
+def format_event(name, data):
+    """Renders one SSE frame; done once at publish time, not once per client."""
+    return f"id: {uuid.uuid4().hex}\nevent: {name}\ndata: {dumps(data).decode('utf-8')}\n\n"
+
+
+#--------------------- Brokers
+class Subscription:
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = tuple(channels)
+        self.queue = queue.Queue(maxsize=MAX_PENDING)
+        self._recent = deque(maxlen=16)
+
+    def put(self, message):
+        # An event published to two of this stream's channels arrives twice
+        if message in self._recent:
+            return
+        self._recent.append(message)
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            inc('sse_events_dropped_total')
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class MemoryBroker:
+    """Delivers to streams in this process only; for development and tests."""
+
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, channels)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].discard(subscription)
+                if not self._subscriptions[channel]:
+                    del self._subscriptions[channel]
+
+    def deliver(self, channel, message):
+        with self._lock:
+            targets = list(self._subscriptions.get(channel, ()))
+        for subscription in targets:
+            subscription.put(message)
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+    def stream_count(self):
+        with self._lock:
+            return len({s for subs in self._subscriptions.values() for s in subs})
+
+
+class RedisBroker(MemoryBroker):
+    """
+    Publishes through Redis so every web process sees every event.
+
+    One listener thread per process pattern-subscribes to all channels and
+    hands messages to the local streams that want them.
+    """
+
+    def __init__(self, client):
+        super().__init__()
+        self.redis = client
+        self._listener = None
+
+    def subscribe(self, channels):
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(target=self._listen, name='sse-listener', daemon=True)
+                    self._listener.start()
+        return super().subscribe(channels)
+
+    def publish(self, channel, message):
+        try:
+            self.redis.publish(CHANNEL_PREFIX + channel, message)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Dropped live event for {channel}: {e}")
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(CHANNEL_PREFIX + '*')
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self.deliver(message['channel'][len(CHANNEL_PREFIX):], message['data'])
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Live event listener lost Redis, reconnecting: {e}")
+                time.sleep(1)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Process-wide broker; EVENT_BROKER_URL=memory:// selects the in-process one."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                if os.getenv('EVENT_BROKER_URL', '').startswith('memory://'):
+                    _broker = MemoryBroker()
+                else:
+                    from application import redis_client
+                    _broker = RedisBroker(redis_client)
+    return _broker
+
+
+def publish(channels, name, data):
+    message = format_event(name, data)
+    broker = get_broker()
+    for channel in channels:
+        broker.publish(channel, message)
+    inc('sse_events_published_total', event=name)
+
+
+@register_collector
+def _collect_stream_metrics():
+    if _broker is not None:
+        yield 'sse_open_streams', {}, _broker.stream_count()
+
+
+#--------------------- Publishing committed changes
+def _company_ids(bind, service_ids):
+    if not service_ids:
+        return {}
+    with bind.connect() as connection:
+        rows = connection.execute(select(Service.id, Service.company_id).where(Service.id.in_(service_ids)))
+        return dict(rows.all())
+
+
+@on_commit(Booking, Notification, Review, kinds=(CREATED, UPDATED))
+def _publish_changes(changes):
+    live = []
+    for change in changes:
+        if change.model is Booking and (change.kind == CREATED or 'status' in change.changed):
+            name = 'booking.created' if change.kind == CREATED else 'booking.updated'
+            live.append((change, name, booking_event_serializer))
+        elif change.model is Notification and change.kind == CREATED:
+            live.append((change, 'notification', notification_event_serializer))
+        elif change.model is Review and change.kind == UPDATED and 'status' in change.changed:
+            live.append((change, 'review.moderated', review_event_serializer))
+    if not live:
+        return
+
+    # One lookup for every booking/review in the commit
+    companies = _company_ids(changes.bind, {
+        change.values.get('service_id') for change, _, _ in live if change.model is not Notification
+    } - {None})
+    for change, name, serializer in live:
+        values = change.values
+        channels = [f"user:{values.get('user_id')}"]
+        if change.model is Booking or (change.model is Review and values.get('status') == 'approved'):
+            channels.append(f"company:{companies.get(values.get('service_id'))}")
+        publish(channels, name, {field: values.get(field) for field in serializer.fields})
+
+
+#--------------------- Stream endpoint
+def stream_response(channels):
+    """An SSE response for the given channels; call from any app's view."""
+    subscription = get_broker().subscribe(channels)
+
+    def generate():
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                try:
+                    yield subscription.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # let nginx pass events through unbuffered
+    })
+
+
+@events.route('/events/stream', methods=['GET'])
+def stream():
+    # Company channels are streamed by the provider portal (Asliddin/app.py), where providers sign in
+    if not session.get('user_id'):
+        return jsonify({"message": "Login required"}), 401
+    return stream_response([f"user:{session['user_id']}"])
@@ -1,9 +1,38 @@
 # extensions.py
+from contextvars import ContextVar
+
+import sqlalchemy as sa
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_admin import Admin
+from sqlalchemy.sql.util import find_tables
+
+# ✅ Tables whose rows live on the shard of their company (see sharding.py)
+SHARDED_TABLES = frozenset({'bookings', 'transactions', 'reminders', 'cdc_tombstones'})
+# Bind key of the shard in context; None is the primary database
+current_shard_bind = ContextVar('current_shard_bind', default=None)
+
+
+class RoutingSession(Session):
+    """Sends statements on SHARDED_TABLES to the shard in context; everything else to its usual bind."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = current_shard_bind.get()
+        if key is not None and bind is None and _touches_shard(mapper, clause):
+            return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _touches_shard(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in SHARDED_TABLES
+    if clause is not None:
+        return any(table.name in SHARDED_TABLES for table in find_tables(clause, check_columns=True, include_crud=True))
+    return False
+
 
 # Shared Extensions
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 # ✅ Single Flask-Admin instance shared across modules
-admin = Admin(name='Admin Panel', template_mode='bootstrap3', url='/admin_dashboard')
\ No newline at end of file
+admin = Admin(name='Admin Panel', template_mode='bootstrap3', url='/admin_dashboard')
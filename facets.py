@@ -0,0 +1,384 @@
+# facets.py
+"""
+Faceted service search.
+
+Each process keeps a bitmap index of the service catalogue: for every facet
+value (a category, a price bucket, a city, a rating band, a company) one
+bitmap whose bit n is set when service id n has that value. Filtering is
+AND-ing / OR-ing bitmaps and every facet count is a popcount, so a page with
+"Plumbing (132) · $50–100 (41)" costs no COUNT queries at all.
+
+Bitmaps are compressed Roaring bitmaps when pyroaring is installed. Without
+it they are plain Python ints, which take highest id / 8 bytes per value; a
+long tail of cities or companies then costs memory, so install pyroaring for
+large catalogues. Either way a facet with more values than there are
+matching services is counted from those services instead of value by value.
+
+The index is built with three queries and then kept current by a commit
+handler that re-reads only the services a commit touched. Other processes
+pick the change up when their copy is older than INDEX_TTL.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+
+from flask import url_for
+from sqlalchemy import func, select
+
+from bus import on_commit
+from extensions import db
+from metrics import inc, observe, register_collector
+from models import Category, Company, Review, Service
+
+# ✅ Roaring bitmaps when pyroaring is installed, Python ints otherwise
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_TTL = 300  # seconds; bounds staleness for writes made in other processes
+PAGE_SIZE = 24
+
+# (value, label, low, high) - low inclusive, high exclusive
+PRICE_BUCKETS = (
+    ('0-50', 'Under $50', 0, 50),
+    ('50-100', '$50–100', 50, 100),
+    ('100-250', '$100–250', 100, 250),
+    ('250-500', '$250–500', 250, 500),
+    ('500+', '$500+', 500, None),
+)
+RATING_BANDS = (
+    ('4+', '4★ & up', 4, None),
+    ('3-4', '3–4★', 3, 4),
+    ('under-3', 'Under 3★', 0, 3),
+)
+UNRATED = ('unrated', 'Not rated yet')
+
+FACETS = ('category', 'price', 'city', 'rating', 'company')
+# Bucketed facets keep their natural order; the rest are listed by count
+FIXED_ORDER = {
+    'price': [bucket[0] for bucket in PRICE_BUCKETS],
+    'rating': [band[0] for band in RATING_BANDS] + [UNRATED[0]],
+}
+FACET_TITLES = {'category': 'Category', 'price': 'Price', 'city': 'City', 'rating': 'Rating', 'company': 'Provider'}
+
+
+def _bucket(value, buckets):
+    for key, _, low, high in buckets:
+        if value >= low and (high is None or value < high):
+            return key
+    return None
+
+
+def price_bucket(price):
+    return _bucket(price or 0, PRICE_BUCKETS)
+
+
+def rating_band(total, count):
+    return _bucket(total / count, RATING_BANDS) if count else UNRATED[0]
+
+
+def city_of(location):
+    """'Tashkent, Chilonzor 5' -> 'Tashkent'; locations are free text, the city comes first."""
+    return (location or '').split(',')[0].strip().title() or None
+
+
+#--------------------- Bitmaps
+def empty_bitmap():
+    return BitMap() if BitMap else 0
+
+
+def iter_bits(bitmap):
+    """Set bit positions (service ids) in ascending order."""
+    if BitMap:
+        yield from bitmap
+        return
+    while bitmap:
+        low = bitmap & -bitmap
+        yield low.bit_length() - 1
+        bitmap ^= low
+
+
+def to_bitmap(ids):
+    if BitMap:
+        return BitMap(ids)
+    bitmap = 0
+    for i in ids:
+        bitmap |= 1 << i
+    return bitmap
+
+
+def cardinality(bitmap):
+    return len(bitmap) if BitMap else bitmap.bit_count()
+
+
+def _overlap(a, b):
+    return a.intersection_cardinality(b) if BitMap else (a & b).bit_count()
+
+
+def _with(bitmap, i):
+    if BitMap:
+        bitmap.add(i)
+        return bitmap
+    return bitmap | 1 << i
+
+
+def _without(bitmap, i):
+    if BitMap:
+        bitmap.discard(i)
+        return bitmap
+    return bitmap & ~(1 << i)
+
+
+def _copy(bitmap):
+    return BitMap(bitmap) if BitMap else bitmap
+
+
+#--------------------- Index
+class FacetIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.all = empty_bitmap()
+        self.bitmaps = {facet: {} for facet in FACETS}
+        self.labels = {facet: {} for facet in FACETS}
+        self.values = {}  # service id -> {facet: value}, to clear its old bits on update
+        self.built_at = 0.0
+        for key, label, _, _ in PRICE_BUCKETS:
+            self.labels['price'][key] = label
+        for key, label, _, _ in RATING_BANDS + (UNRATED + (None, None),):
+            self.labels['rating'][key] = label
+
+    def _remove(self, service_id):
+        for facet, value in self.values.pop(service_id, {}).items():
+            bitmaps = self.bitmaps[facet]
+            if value in bitmaps:
+                bitmap = bitmaps[value] = _without(bitmaps[value], service_id)
+                if not bitmap:
+                    del bitmaps[value]
+        self.all = _without(self.all, service_id)
+
+    def _add(self, service_id, values):
+        for facet, value in values.items():
+            if value is not None:
+                bitmaps = self.bitmaps[facet]
+                bitmaps[value] = _with(bitmaps[value] if value in bitmaps else empty_bitmap(), service_id)
+        self.values[service_id] = values
+        self.all = _with(self.all, service_id)
+
+    def refresh(self, connection, service_ids=None):
+        """Re-reads the given services (all of them when None) and their ratings."""
+        services = select(Service.id, Service.category_id, Service.price, Service.location, Service.company_id)
+        ratings = (
+            select(Review.service_id, func.sum(Review.rating), func.count(Review.id))
+            .where(Review.status == 'approved')
+            .group_by(Review.service_id)
+        )
+        if service_ids is not None:
+            services = services.where(Service.id.in_(service_ids))
+            ratings = ratings.where(Review.service_id.in_(service_ids))
+        rated = {service_id: (total, count) for service_id, total, count in connection.execute(ratings)}
+        rows = connection.execute(services).all()
+
+        with self.lock:
+            for service_id in (service_ids if service_ids is not None else list(self.values)):
+                self._remove(service_id)
+            for service_id, category_id, price, location, company_id in rows:
+                city = city_of(location)
+                self._add(service_id, {
+                    'category': category_id,
+                    'price': price_bucket(price),
+                    'city': city,
+                    'rating': rating_band(*rated.get(service_id, (0, 0))),
+                    'company': company_id,
+                })
+                if city:
+                    self.labels['city'].setdefault(city, city)
+
+    def refresh_labels(self, connection):
+        categories = dict(connection.execute(select(Category.id, Category.name)).all())
+        companies = dict(connection.execute(select(Company.id, Company.name)).all())
+        with self.lock:
+            self.labels['category'] = categories
+            self.labels['company'] = companies
+
+    def build(self, connection):
+        started = time.perf_counter()
+        self.refresh(connection)
+        self.refresh_labels(connection)
+        self.built_at = time.monotonic()
+        observe('facet_index_build_seconds', time.perf_counter() - started)
+        inc('facet_index_builds_total')
+
+    #--------------------- Querying
+    def _facet_mask(self, facet, selected):
+        bitmaps = self.bitmaps[facet]
+        mask = empty_bitmap()
+        for value in selected:
+            if value in bitmaps:
+                mask = mask | bitmaps[value]
+        return mask
+
+    def _counts(self, facet, scope):
+        """{value: services of `scope` with it}, counting whichever of values or services is fewer."""
+        bitmaps = self.bitmaps[facet]
+        if len(bitmaps) > cardinality(scope):
+            tally = Counter(self.values[service_id][facet] for service_id in iter_bits(scope))
+            return {value: count for value, count in tally.items() if value in bitmaps}
+        return {value: _overlap(bitmap, scope) for value, bitmap in bitmaps.items()}
+
+    def query(self, filters, within=None):
+        """
+        Applies facet filters (facet -> set of values; OR within a facet, AND
+        across facets) and counts every facet value.
+
+        A facet's counts ignore that facet's own selection, so picking one
+        category still shows how many results the other categories would give.
+
+        Returns (matching bitmap, {facet: [(value, label, count, selected)]}).
+        """
+        with self.lock:
+            # No in-place &= below: with pyroaring that would modify the index's own bitmaps
+            base = _copy(self.all) if within is None else self.all & within
+            masks = {facet: self._facet_mask(facet, values) for facet, values in filters.items() if values}
+            matching = base
+            for mask in masks.values():
+                matching = matching & mask
+
+            counts = {}
+            for facet in FACETS:
+                scope = base
+                for other, mask in masks.items():
+                    if other != facet:
+                        scope = scope & mask
+                selected = filters.get(facet) or set()
+                tally = self._counts(facet, scope)
+                entries = []
+                for value in tally.keys() | (selected & self.bitmaps[facet].keys()):
+                    count = tally.get(value, 0)
+                    if count or value in selected:
+                        label = self.labels[facet].get(value, value)
+                        entries.append((value, label, count, value in selected))
+                if facet in FIXED_ORDER:
+                    entries.sort(key=lambda e: FIXED_ORDER[facet].index(e[0]))
+                else:
+                    entries.sort(key=lambda e: (-e[2], str(e[1])))
+                counts[facet] = entries
+        return matching, counts
+
+
+_index = FacetIndex()
+_build_lock = threading.Lock()
+
+
+def get_index():
+    """The process index, (re)built on first use and when older than INDEX_TTL."""
+    if time.monotonic() - _index.built_at > INDEX_TTL:
+        with _build_lock:
+            if time.monotonic() - _index.built_at > INDEX_TTL:
+                with db.engine.connect() as connection:
+                    _index.build(connection)
+    return _index
+
+
+@on_commit(Service, Review, Category, Company)
+def _refresh_changed(changes):
+    if not _index.built_at:
+        return  # nothing built in this process yet
+    reviewed = {v for c in changes if c.model is Review for v in (c.values.get('service_id'), c.previous.get('service_id'))}
+    service_ids = (changes.ids(Service) | reviewed) - {None}
+    with changes.bind.connect() as connection:
+        if service_ids:
+            _index.refresh(connection, sorted(service_ids))
+        if changes.ids(Category) or changes.ids(Company):
+            _index.refresh_labels(connection)
+    inc('facet_index_refreshes_total')
+
+
+@register_collector
+def _collect_index_metrics():
+    if _index.built_at:
+        yield 'facet_index_services', {}, cardinality(_index.all)
+
+
+#--------------------- Requests
+def parse_filters(args):
+    """Facet selections from query args (?category=3&price=50-100&price=100-250 ...)."""
+    filters = {}
+    for facet in FACETS:
+        values = set(v for v in args.getlist(facet) if v)
+        if facet in ('category', 'company'):
+            values = {int(v) for v in values if v.isdigit()}
+        if values:
+            filters[facet] = values
+    return filters
+
+
+def search(filters, text=None, page=1, per_page=PAGE_SIZE):
+    """
+    One page of services matching `filters` (and a name substring), plus facet counts.
+
+    Returns a dict with services, total, page, pages and facets.
+    """
+    index = get_index()
+    within = None
+    if text:
+        within = to_bitmap(db.session.execute(select(Service.id).where(Service.name.contains(text))).scalars())
+    matching, counts = index.query(filters, within)
+
+    total = cardinality(matching)
+    start = (max(page, 1) - 1) * per_page
+    page_ids = []
+    for position, service_id in enumerate(iter_bits(matching)):
+        if position >= start + per_page:
+            break
+        if position >= start:
+            page_ids.append(service_id)
+
+    services = []
+    if page_ids:
+        by_id = {s.id: s for s in Service.query.filter(Service.id.in_(page_ids))}
+        services = [by_id[i] for i in page_ids if i in by_id]
+    return {
+        'services': services,
+        'total': total,
+        'page': max(page, 1),
+        'pages': max((total + per_page - 1) // per_page, 1),
+        'facets': counts,
+    }
+
+
+def navigation(args, results, endpoint, skip=(), **view_args):
+    """
+    Links for a results page: the facet sidebar as (title, [(label, count,
+    selected, url)]) pairs, plus previous/next page urls (None at the ends).
+
+    Each facet url toggles that one value in the current query string and
+    goes back to the first page. Only the facets and the search text are
+    carried over; any other argument (an `endpoint`, a view arg) is dropped.
+    """
+    current = {key: args.getlist(key) for key in FACETS + ('query',)
+               if key in args and key not in skip and key not in view_args}
+    sidebar = []
+    for facet in FACETS:
+        if facet in skip or not results['facets'].get(facet):
+            continue
+        links = []
+        for value, label, count, selected in results['facets'][facet]:
+            values = [v for v in current.get(facet, []) if v != str(value)]
+            if not selected:
+                values.append(str(value))
+            links.append((label, count, selected, url_for(endpoint, **view_args, **dict(current, **{facet: values}))))
+        sidebar.append((FACET_TITLES[facet], links))
+
+    def page_url(page):
+        return url_for(endpoint, **view_args, **current, page=page)
+
+    page = results['page']
+    return {
+        'sidebar': sidebar,
+        'prev_url': page_url(page - 1) if page > 1 else None,
+        'next_url': page_url(page + 1) if page < results['pages'] else None,
+    }
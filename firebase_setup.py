@@ -1,12 +1,24 @@
 # firebase_service.py
 import firebase_admin
 from firebase_admin import credentials, messaging
+from jobs import task
+from resilience import firebase
+
+FIREBASE_CREDENTIALS = 'firebase_config/firebase-config.json'
+
+
+def init_firebase():
+    """(Re)creates the default Firebase app; forked server processes call this for their own HTTP clients."""
+    if firebase_admin._apps:
+        firebase_admin.delete_app(firebase_admin.get_app())
+    firebase_admin.initialize_app(credentials.Certificate(FIREBASE_CREDENTIALS), {'httpTimeout': firebase.timeout})
+
 
 # ✅ Load Firebase credentials
 if not firebase_admin._apps:
-    cred = credentials.Certificate('firebase_config/firebase-config.json')
-    firebase_admin.initialize_app(cred)
+    init_firebase()
 
+@task('notifications.send_push', queue='notifications')
 def send_push_notification(fcm_token, title, body):
     """
     Sends a push notification via Firebase Cloud Messaging (FCM).
@@ -16,29 +28,32 @@ def send_push_notification(fcm_token, title, body):
         title (str): The notification title.
         body (str): The notification body.
     """
+    message = messaging.Message(
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        token=fcm_token,
+    )
+    # Errors propagate so the job worker can retry with backoff; a dead token is dropped instead
     try:
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            token=fcm_token,
-        )
-        response = messaging.send(message)
-        print(f'Successfully sent notification: {response}')
-    except Exception as e:
-        print(f'Failed to send notification: {e}')
+        response = firebase.call(messaging.send, message)
+    except (messaging.UnregisteredError, messaging.SenderIdMismatchError):
+        from devices import prune_tokens
+        prune_tokens([fcm_token])
+        return
+    print(f'Successfully sent notification: {response}')
 
 
+@task('notifications.subscribe', queue='notifications')
 def subscribe_user_to_topic(fcm_token, topic='default-topic'):
-    """Subscribes a user's FCM token to a topic."""
-    try:
-        response = messaging.subscribe_to_topic([fcm_token], topic)
-        print(f'Subscribed user to topic {topic}: {response.success_count} success')
-    except Exception as e:
-        print(f'Failed to subscribe user to topic: {e}')
+    """Subscribes a user's FCM token to a topic (recorded and pruned like any batch, see devices.py)."""
+    from devices import subscribe
+    count = subscribe([fcm_token], topic)
+    print(f'Subscribed user to topic {topic}: {count} success')
 
 
+@task('notifications.broadcast', queue='notifications')
 def broadcast_to_topic(title, body, topic='default-topic'):
     """Broadcasts a notification to all users subscribed to a topic."""
     message = messaging.Message(
@@ -48,8 +63,5 @@ def broadcast_to_topic(title, body, topic='default-topic'):
         ),
         topic=topic,
     )
-    try:
-        response = messaging.send(message)
-        print(f'Successfully broadcasted to topic {topic}: {response}')
-    except Exception as e:
-        print(f'Failed to broadcast to topic {topic}: {e}')
\ No newline at end of file
+    response = firebase.call(messaging.send, message)
+    print(f'Successfully broadcasted to topic {topic}: {response}')
\ No newline at end of file
@@ -0,0 +1,67 @@
+# gunicorn.conf.py
+"""
+Gunicorn settings, all taken from the environment.
+
+    gunicorn app:app                                   # main site
+    gunicorn --chdir Asliddin app:app                  # provider portal
+    WEB_WORKER_CLASS=gevent gunicorn app:app           # lots of open SSE streams
+
+Worker classes:
+    sync     one request per process; simplest, but every open /events/stream
+             holds a whole worker until it times out
+    gthread  WEB_THREADS requests per process (default); good for the page and
+             API mix, which mostly waits on Postgres and Redis
+    gevent   WEB_WORKER_CONNECTIONS greenlets per process; use it when many
+             clients keep event streams open
+
+The app is preloaded in the master and forked, so workers start fast and
+share its memory; post_worker_init() gives each worker its own connections.
+
+Graceful reload: `kill -HUP <master>` replaces the workers (in-flight
+requests finish within WEB_GRACEFUL_TIMEOUT). Because of preload_app, HUP
+does not pick up new code - deploy that with `kill -USR2 <master>`, then
+`kill -WINCH <old master>` and `kill -QUIT <old master>` once the new one
+is serving.
+"""
+import multiprocessing
+import os
+
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')
+if worker_class not in WORKER_CLASSES:
+    raise ValueError(f"WEB_WORKER_CLASS must be one of {', '.join(WORKER_CLASSES)}, not {worker_class!r}")
+
+if worker_class == 'gevent':
+    # ✅ Patch before the app is preloaded so its sockets and locks cooperate
+    from gevent import monkey
+    monkey.patch_all()
+
+cpus = multiprocessing.cpu_count()
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', cpus if worker_class == 'gevent' else cpus * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 4 if worker_class == 'gthread' else 1))
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
+
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+
+# Recycle workers now and then so slow leaks don't build up; jitter avoids all restarting at once
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+preload_app = True
+forwarded_allow_ips = os.getenv('FORWARDED_ALLOW_IPS', '127.0.0.1')
+accesslog = os.getenv('WEB_ACCESS_LOG', '-') or None
+errorlog = '-'
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'  # heartbeat file off the disk
+
+
+def post_worker_init(worker):
+    # Runs in the worker after its own signal handlers are installed, before it accepts
+    from serving import init_worker
+    init_worker(worker.wsgi)
+    worker.log.info(f"Worker {worker.pid} ready ({worker_class})")
@@ -0,0 +1,150 @@
+# images.py
+import hashlib
+import os
+import tempfile
+
+from flask import Blueprint, current_app, abort, send_file, url_for
+from PIL import Image, UnidentifiedImageError
+
+from jobs import task
+
+media = Blueprint("media", __name__)
+
+# Bounding boxes for the generated thumbnails, keyed by the size name used in templates
+THUMBNAIL_SIZES = {
+    'sm': (160, 160),
+    'md': (480, 480),
+    'lg': (1024, 1024),
+}
+THUMBNAIL_FORMATS = {'jpg': 'JPEG', 'webp': 'WEBP'}
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class ImageUploadError(ValueError):
+    """Raised when an upload is too large or is not a supported image."""
+
+
+def _media_root():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'images')
+
+
+def key_path(root, key):
+    """Maps a content key like '<sha256>.jpg' to its sharded path on disk."""
+    return os.path.join(root, key[:2], key[2:4], key)
+
+
+def thumbnail_key(key, size, fmt='jpg'):
+    digest = key.rsplit('.', 1)[0]
+    return f"{digest}_{size}.{fmt}"
+
+
+def save_upload(file_storage, root=None, max_bytes=MAX_IMAGE_BYTES):
+    """
+    Streams an uploaded image to disk in chunks and stores it under its SHA-256.
+
+    Identical uploads resolve to the same key, so the file is only kept once.
+    Thumbnail generation is enqueued for the job worker.
+
+    Returns:
+        str: The content key, e.g. '3f2a...9c.png'.
+    """
+    root = root or _media_root()
+    os.makedirs(root, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=root, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageUploadError(f"Image exceeds {max_bytes // (1024 * 1024)} MB limit")
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        try:
+            with Image.open(tmp_path) as img:
+                img_format = img.format
+                img.verify()
+        except (UnidentifiedImageError, OSError):
+            raise ImageUploadError("Uploaded file is not a valid image")
+        if img_format not in ALLOWED_FORMATS:
+            raise ImageUploadError(f"Unsupported image format: {img_format}")
+
+        key = f"{digest.hexdigest()}.{ALLOWED_FORMATS[img_format]}"
+        path = key_path(root, key)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    generate_thumbnails.delay(key, os.path.abspath(root))
+    return key
+
+
+@task('media.generate_thumbnails', queue='media')
+def generate_thumbnails(key, root):
+    """Renders every size in THUMBNAIL_SIZES as JPEG and WebP next to the original."""
+    source = key_path(root, key)
+    with Image.open(source) as original:
+        original.load()
+        for size, box in THUMBNAIL_SIZES.items():
+            thumb = original.copy()
+            thumb.thumbnail(box, Image.LANCZOS)
+            if thumb.mode not in ('RGB', 'L'):
+                thumb = thumb.convert('RGB')
+            for fmt, pil_format in THUMBNAIL_FORMATS.items():
+                target = key_path(root, thumbnail_key(key, size, fmt))
+                if os.path.exists(target):
+                    continue
+                tmp_target = target + '.tmp'
+                thumb.save(tmp_target, pil_format, quality=82, optimize=True)
+                os.replace(tmp_target, target)
+
+
+def _is_digest(value):
+    return len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def _is_content_key(value):
+    return '/' not in value and _is_digest(value.rsplit('.', 1)[0])
+
+
+@media.app_template_filter('thumbnail')
+def thumbnail_url(image_url, size='md', fmt='jpg'):
+    """Template filter: points a stored image at its thumbnail, leaving external URLs untouched."""
+    if not image_url or not _is_content_key(image_url):
+        return image_url
+    return url_for('media.serve_media', filename=thumbnail_key(image_url, size, fmt))
+
+
+@media.route('/media/<filename>')
+def serve_media(filename):
+    root = _media_root()
+    digest = filename.split('_', 1)[0].split('.', 1)[0]
+    if not _is_digest(digest):
+        abort(404)
+
+    path = key_path(root, filename)
+    immutable = True
+    if not os.path.exists(path):
+        # Thumbnail not rendered yet: serve the original briefly so the page still shows an image
+        originals = [key_path(root, f"{digest}.{ext}") for ext in ALLOWED_FORMATS.values()]
+        path = next((p for p in originals if os.path.exists(p)), None)
+        if path is None:
+            abort(404)
+        immutable = False
+
+    response = send_file(path, conditional=True, max_age=IMMUTABLE_MAX_AGE if immutable else 60)
+    response.cache_control.immutable = immutable
+    return response
@@ -0,0 +1,434 @@
+# jobs.py
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+
+from metrics import inc, observe, register_collector
+
+logger = logging.getLogger(__name__)
+
+# Registry of every task by name; worker processes look jobs up here
+TASKS = {}
+# Task name -> interval in seconds, enqueued by the scheduler process
+PERIODIC = {}
+
+
+@dataclass
+class Job:
+    task: str
+    args: list = field(default_factory=list)
+    kwargs: dict = field(default_factory=dict)
+    queue: str = 'default'
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    attempts: int = 0
+    max_retries: int = 3
+    enqueued_at: float = field(default_factory=time.time)
+    run_at: float = 0.0
+    last_error: str = None
+
+    def to_json(self):
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, raw):
+        return cls(**json.loads(raw))
+
+
+class Defer(Exception):
+    """Raised by a task to run again in `countdown` seconds without using up a retry."""
+
+    def __init__(self, message, countdown):
+        super().__init__(message)
+        self.countdown = countdown
+
+
+class Task:
+    """A function that can run inline or be enqueued with .delay() / .apply_async()."""
+
+    def __init__(self, fn, name, queue, max_retries, retry_backoff, max_backoff):
+        self.fn = fn
+        self.name = name
+        self.queue = queue
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.signature = inspect.signature(fn)
+        functools.update_wrapper(self, fn)
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        return self.apply_async(args, kwargs)
+
+    def apply_async(self, args=(), kwargs=None, countdown=0, eta=None):
+        """
+        Enqueues the task and returns the job id immediately.
+
+        Arguments are checked against the task signature and must be JSON
+        serializable, so a bad call fails in the request instead of the worker.
+        """
+        kwargs = kwargs or {}
+        self.signature.bind(*args, **kwargs)
+        job = Job(task=self.name, args=list(args), kwargs=kwargs, queue=self.queue,
+                  max_retries=self.max_retries)
+        job.run_at = eta if eta is not None else job.enqueued_at + countdown
+        json.dumps([job.args, job.kwargs])
+        get_queue().push(job)
+        inc('jobs_enqueued_total', task=self.name)
+        return job.id
+
+    def retry_delay(self, attempts):
+        """Exponential backoff with jitter: backoff, 2x, 4x ... capped at max_backoff."""
+        delay = min(self.retry_backoff * (2 ** (attempts - 1)), self.max_backoff)
+        return delay + random.uniform(0, delay / 4)
+
+
+def task(name=None, queue='default', max_retries=3, retry_backoff=5, max_backoff=600):
+    """Decorator registering a function as a background task."""
+    def decorator(fn):
+        t = Task(fn, name or f"{fn.__module__}.{fn.__name__}", queue, max_retries, retry_backoff, max_backoff)
+        TASKS[t.name] = t
+        return t
+    return decorator
+
+
+def periodic(interval, name=None, **options):
+    """Decorator registering a task that the scheduler enqueues every `interval` seconds."""
+    def decorator(fn):
+        t = task(name, **options)(fn)
+        PERIODIC[t.name] = interval
+        return t
+    return decorator
+
+
+#--------------------- Queue backends
+class RedisQueue:
+    """
+    Durable queue on Redis.
+
+    Ready jobs live in a list per queue, delayed jobs in a sorted set scored by
+    run_at, and in-flight jobs in a per-worker processing list so that a
+    restarted worker can put back whatever it was holding when it died.
+
+    BLMOVE can only block on one list, so every push also drops a token on
+    the queue's signal list. Idle workers BRPOP the signal lists of all
+    their queues and then take a job with LMOVE, so a job never leaves Redis
+    between the ready and processing lists.
+    """
+
+    SIGNAL_CAP = 100  # tokens kept per signal list; a woken worker drains several jobs anyway
+
+    PROMOTE_SCRIPT = """
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, raw in ipairs(due) do
+        redis.call('ZREM', KEYS[1], raw)
+        redis.call('LPUSH', KEYS[2], raw)
+    end
+    return #due
+    """
+
+    def __init__(self, client, prefix='jobs'):
+        self.client = client
+        self.prefix = prefix
+        self._promote = client.register_script(self.PROMOTE_SCRIPT)
+
+    def _ready(self, queue):
+        return f"{self.prefix}:{queue}"
+
+    def _scheduled(self, queue):
+        return f"{self.prefix}:{queue}:scheduled"
+
+    def _processing(self, worker):
+        return f"{self.prefix}:processing:{worker}"
+
+    def _signal(self, queue):
+        return f"{self.prefix}:{queue}:signal"
+
+    def _dead(self):
+        return f"{self.prefix}:dead"
+
+    def push(self, job):
+        if job.run_at > time.time():
+            self.client.zadd(self._scheduled(job.queue), {job.to_json(): job.run_at})
+        else:
+            pipe = self.client.pipeline()
+            pipe.lpush(self._ready(job.queue), job.to_json())
+            pipe.lpush(self._signal(job.queue), 1)
+            pipe.ltrim(self._signal(job.queue), 0, self.SIGNAL_CAP - 1)
+            pipe.execute()
+
+    def _take(self, queues, worker):
+        for queue in queues:
+            raw = self.client.lmove(self._ready(queue), self._processing(worker), 'RIGHT', 'LEFT')
+            if raw:
+                return Job.from_json(raw), raw
+        return None, None
+
+    def pop(self, queues, worker, timeout=1):
+        now = time.time()
+        for queue in queues:
+            self._promote(keys=[self._scheduled(queue), self._ready(queue)], args=[now, 100])
+        job, raw = self._take(queues, worker)
+        if job is None and self.client.brpop([self._signal(queue) for queue in queues], timeout):
+            job, raw = self._take(queues, worker)
+        return job, raw
+
+    def ack(self, raw, worker):
+        self.client.lrem(self._processing(worker), 1, raw)
+
+    def retry(self, job, raw, worker):
+        pipe = self.client.pipeline()
+        pipe.zadd(self._scheduled(job.queue), {job.to_json(): job.run_at})
+        pipe.lrem(self._processing(worker), 1, raw)
+        pipe.execute()
+
+    def dead(self, job, raw, worker):
+        pipe = self.client.pipeline()
+        pipe.lpush(self._dead(), job.to_json())
+        pipe.lrem(self._processing(worker), 1, raw)
+        pipe.execute()
+
+    def recover(self, worker):
+        """Moves jobs left in this worker's processing list back onto their queues."""
+        # Only this worker touches its processing list, so the job peeked at is the one LMOVE moves
+        while True:
+            raw = self.client.lindex(self._processing(worker), -1)
+            if not raw:
+                break
+            self.client.lmove(self._processing(worker), self._ready(Job.from_json(raw).queue), 'RIGHT', 'RIGHT')
+
+    def claim_period(self, name, interval):
+        """True for exactly one caller per interval, across all hosts."""
+        return bool(self.client.set(f"{self.prefix}:periodic:{name}", time.time(), nx=True, ex=int(interval)))
+
+    def depth(self, queue):
+        return self.client.llen(self._ready(queue))
+
+    def scheduled(self, queue):
+        return self.client.zcard(self._scheduled(queue))
+
+    def oldest_age(self, queue):
+        raw = self.client.lindex(self._ready(queue), -1)
+        return max(time.time() - Job.from_json(raw).run_at, 0) if raw else 0
+
+    def dead_letters(self, limit=100):
+        return [Job.from_json(raw) for raw in self.client.lrange(self._dead(), 0, limit - 1)]
+
+    def dead_count(self):
+        return self.client.llen(self._dead())
+
+
+class SQLiteQueue:
+    """
+    SQLite-backed queue with the same interface as RedisQueue.
+
+    Use a file path for a durable single-host queue or ':memory:' in tests.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, queue TEXT NOT NULL, payload TEXT NOT NULL,"
+            " run_at REAL NOT NULL, state TEXT NOT NULL DEFAULT 'ready', worker TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_ready ON jobs (queue, state, run_at)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS periodic (name TEXT PRIMARY KEY, next_run REAL NOT NULL)")
+
+    def push(self, job):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, queue, payload, run_at, state, worker) VALUES (?, ?, ?, ?, 'ready', NULL)",
+                (job.id, job.queue, job.to_json(), job.run_at),
+            )
+
+    def pop(self, queues, worker, timeout=1):
+        placeholders = ','.join('?' * len(queues))
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                f"SELECT id, payload FROM jobs WHERE queue IN ({placeholders}) AND state = 'ready'"
+                " AND run_at <= ? ORDER BY run_at LIMIT 1",
+                (*queues, time.time()),
+            ).fetchone()
+            if row:
+                self.conn.execute("UPDATE jobs SET state = 'running', worker = ? WHERE id = ?", (worker, row[0]))
+            self.conn.execute("COMMIT")
+        if not row:
+            time.sleep(min(timeout, 0.2))
+            return None, None
+        return Job.from_json(row[1]), row[0]
+
+    def ack(self, raw, worker):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (raw,))
+
+    def retry(self, job, raw, worker):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET state = 'ready', worker = NULL, payload = ?, run_at = ? WHERE id = ?",
+                (job.to_json(), job.run_at, raw),
+            )
+
+    def dead(self, job, raw, worker):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET state = 'dead', payload = ? WHERE id = ?", (job.to_json(), raw))
+
+    def recover(self, worker):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET state = 'ready', worker = NULL WHERE state = 'running' AND worker = ?", (worker,))
+
+    def claim_period(self, name, interval):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO periodic (name, next_run) VALUES (?, 0)", (name,))
+            cursor = self.conn.execute(
+                "UPDATE periodic SET next_run = ? WHERE name = ? AND next_run <= ?", (now + interval, name, now)
+            )
+        return cursor.rowcount == 1
+
+    def _count(self, where, params):
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM jobs WHERE {where}", params).fetchone()[0]
+
+    def depth(self, queue):
+        return self._count("queue = ? AND state = 'ready' AND run_at <= ?", (queue, time.time()))
+
+    def scheduled(self, queue):
+        return self._count("queue = ? AND state = 'ready' AND run_at > ?", (queue, time.time()))
+
+    def oldest_age(self, queue):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(run_at) FROM jobs WHERE queue = ? AND state = 'ready' AND run_at <= ?",
+                (queue, time.time()),
+            ).fetchone()
+        return max(time.time() - row[0], 0) if row[0] else 0
+
+    def dead_letters(self, limit=100):
+        with self.lock:
+            rows = self.conn.execute("SELECT payload FROM jobs WHERE state = 'dead' LIMIT ?", (limit,)).fetchall()
+        return [Job.from_json(r[0]) for r in rows]
+
+    def dead_count(self):
+        return self._count("state = 'dead'", ())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    Returns the process-wide queue backend, created lazily so that forked
+    workers open their own connections.
+
+    JOB_QUEUE_URL selects the backend: redis://..., sqlite:///path/to/jobs.db
+    or memory://. Defaults to the application's Redis.
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                url = os.getenv('JOB_QUEUE_URL', '')
+                if url.startswith('memory://'):
+                    _queue = SQLiteQueue(':memory:')
+                elif url.startswith('sqlite:///'):
+                    _queue = SQLiteQueue(url[len('sqlite:///'):])
+                else:
+                    from application import redis_client
+                    _queue = RedisQueue(redis_client)
+    return _queue
+
+
+def set_queue(backend):
+    """Swaps the queue backend, e.g. for a SQLiteQueue in tests."""
+    global _queue
+    _queue = backend
+
+
+#--------------------- Execution
+def execute(job, raw, worker, backend=None):
+    """Runs one job, retrying with backoff or dead-lettering it on failure."""
+    backend = backend or get_queue()
+    observe('job_wait_seconds', max(time.time() - job.run_at, 0), queue=job.queue)
+    t = TASKS.get(job.task)
+    if t is None:
+        job.last_error = f"Unknown task {job.task}"
+        logger.error(f"Dead-lettering job {job.id}: {job.last_error}")
+        backend.dead(job, raw, worker)
+        return
+
+    start = time.time()
+    try:
+        t.fn(*job.args, **job.kwargs)
+    except Defer as e:
+        # e.g. an upstream's circuit is open: park the job until it may have recovered
+        job.last_error = repr(e)
+        job.run_at = time.time() + e.countdown
+        inc('jobs_deferred_total', task=job.task)
+        logger.info(f"Job {job.id} ({job.task}) deferred {e.countdown}s: {e}")
+        backend.retry(job, raw, worker)
+    except Exception as e:
+        job.attempts += 1
+        job.last_error = repr(e)
+        inc('jobs_failed_total', task=job.task)
+        if job.attempts > job.max_retries:
+            logger.error(f"Job {job.id} ({job.task}) failed {job.attempts} times, dead-lettering: {e}")
+            backend.dead(job, raw, worker)
+        else:
+            job.run_at = time.time() + t.retry_delay(job.attempts)
+            logger.warning(f"Job {job.id} ({job.task}) failed, retry {job.attempts} in {job.run_at - time.time():.0f}s: {e}")
+            backend.retry(job, raw, worker)
+    else:
+        inc('jobs_completed_total', task=job.task)
+        backend.ack(raw, worker)
+    finally:
+        observe('job_run_seconds', time.time() - start, task=job.task)
+
+
+def run_worker(app, queues, worker, stop_event=None):
+    """Pulls jobs from `queues` until stop_event is set, one app context per job."""
+    backend = get_queue()
+    backend.recover(worker)
+    logger.info(f"Worker {worker} consuming {', '.join(queues)}")
+    while stop_event is None or not stop_event.is_set():
+        job, raw = backend.pop(queues, worker)
+        if job is None:
+            continue
+        with app.app_context():
+            execute(job, raw, worker, backend)
+
+
+def run_scheduler(stop_event=None, tick=5):
+    """Enqueues each periodic task once per interval; safe to run on several hosts."""
+    backend = get_queue()
+    logger.info(f"Scheduler started for {', '.join(sorted(PERIODIC)) or 'no periodic tasks'}")
+    while stop_event is None or not stop_event.is_set():
+        for name, interval in PERIODIC.items():
+            if backend.claim_period(name, interval):
+                TASKS[name].delay()
+        if stop_event is not None:
+            stop_event.wait(tick)
+        else:
+            time.sleep(tick)
+
+
+@register_collector
+def _collect_queue_metrics():
+    backend = get_queue()
+    for queue in sorted({t.queue for t in TASKS.values()}):
+        yield 'job_queue_depth', {'queue': queue}, backend.depth(queue)
+        yield 'job_queue_scheduled', {'queue': queue}, backend.scheduled(queue)
+        yield 'job_queue_oldest_age_seconds', {'queue': queue}, backend.oldest_age(queue)
+    yield 'job_dead_letters', {}, backend.dead_count()
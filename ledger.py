@@ -0,0 +1,362 @@
+# ledger.py
+"""
+Transaction ledger.
+
+Settled transactions are posted as append-only LedgerEntry rows partitioned
+by month on created_at: natively on Postgres (ledger_entries_YYYYMM are
+partitions of ledger_entries) and as date-sharded ledger_entries_YYYYMM
+tables elsewhere. Posting also bumps the day's RevenueRollup row in the same
+transaction, so revenue and payout reports never read the entries. Months
+older than HOT_MONTHS are archived to compressed files and dropped.
+"""
+import csv
+import gzip
+import logging
+import os
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import MetaData, func, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from jobs import periodic
+from metrics import inc
+from models import LedgerEntry, RevenueRollup, LedgerArchive, Service, Transaction
+import sharding
+
+# ✅ Archives are written as Parquet when pyarrow is installed, gzipped CSV otherwise
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+HOT_MONTHS = int(os.getenv('LEDGER_HOT_MONTHS', 13))
+MONTHS_AHEAD = 2
+ARCHIVE_BATCH = 10000
+MAINTENANCE_INTERVAL = 6 * 3600
+
+_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+_shard_metadata = MetaData()
+# Months this process has seen a native partition for, so post() only checks once per month
+_partition_months = set()
+
+
+#--------------------- Partitions
+def _month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(value):
+    return f"{LedgerEntry.__tablename__}_{value:%Y%m}"
+
+
+def _native(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def partition_table(value):
+    """Core Table for the month containing `value` (a partition or a shard, same columns)."""
+    name = partition_name(value)
+    if name not in _shard_metadata.tables:
+        LedgerEntry.__table__.to_metadata(_shard_metadata, name=name)
+    return _shard_metadata.tables[name]
+
+
+def _exists(connection, name):
+    return connection.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None
+
+
+def ensure_partition(connection, value):
+    """
+    Creates the month's partition (or shard table) if it is missing.
+
+    On Postgres, rows of that month that already landed in the DEFAULT
+    partition are moved into the new partition before it is attached,
+    since attaching fails while DEFAULT holds rows in its range.
+    """
+    start = _month_start(value)
+    if not _native(connection):
+        partition_table(start).create(connection, checkfirst=True)
+        return
+    name = partition_name(start)
+    if start in _partition_months or _exists(connection, name):
+        _partition_months.add(start)
+        return
+
+    parent, default = LedgerEntry.__tablename__, f"{LedgerEntry.__tablename__}_default"
+    bounds = f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{_add_months(start, 1):%Y-%m-%d}')"
+    if not _exists(connection, default):
+        connection.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {parent} {bounds}"))
+    else:
+        connection.execute(text(f"CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        moved = connection.execute(text(
+            f"WITH moved AS (DELETE FROM {default} WHERE created_at >= :start AND created_at < :end RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ), {"start": start, "end": _add_months(start, 1)}).rowcount
+        connection.execute(text(f"ALTER TABLE {parent} ATTACH PARTITION {name} {bounds}"))
+        if moved:
+            logger.info(f"Moved {moved} ledger entries from {default} into {name}")
+    _partition_months.add(start)
+
+
+def existing_months(connection):
+    """Months (YYYYMM) that currently have a partition or shard table."""
+    prefix = f"{LedgerEntry.__tablename__}_"
+    if _native(connection):
+        names = connection.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:parent AS regclass)"
+        ), {"parent": LedgerEntry.__tablename__}).scalars()
+    else:
+        names = inspect(connection).get_table_names()
+    return sorted(n[len(prefix):] for n in names if n.startswith(prefix) and n[len(prefix):].isdigit())
+
+
+#--------------------- Posting
+def _insert_ignore(connection, table, values):
+    dialect = connection.dialect.name
+    if dialect in _UPSERT:
+        statement = _UPSERT[dialect](table).values(**values).on_conflict_do_nothing()
+    else:
+        statement = table.insert().values(**values)
+    return connection.execute(statement).rowcount == 1
+
+
+def _bump_rollup(connection, day, service_id, company_id, currency, amount):
+    table = RevenueRollup.__table__
+    values = {
+        'gross': max(amount, 0),
+        'refunds': max(-amount, 0),
+        'charges': 1 if amount >= 0 else 0,
+    }
+    dialect = connection.dialect.name
+    if dialect in _UPSERT:
+        statement = _UPSERT[dialect](table).values(
+            day=day, service_id=service_id, currency=currency, company_id=company_id, **values
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=['day', 'service_id', 'currency'],
+            set_={name: table.c[name] + statement.excluded[name] for name in values},
+        )
+        connection.execute(statement)
+        return
+
+    result = connection.execute(
+        table.update()
+        .where(table.c.day == day, table.c.service_id == service_id, table.c.currency == currency)
+        .values({name: table.c[name] + value for name, value in values.items()})
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(
+            day=day, service_id=service_id, currency=currency, company_id=company_id, **values
+        ))
+
+
+def post(transaction, kind='charge', amount=None, at=None):
+    """
+    Posts a settled transaction to the ledger and its daily rollup.
+
+    Runs on the current session's connection, so the entry, the rollup and the
+    caller's own changes commit together. Posting the same (transaction, kind,
+    time) twice is a no-op, which makes task retries safe.
+
+    Args:
+        transaction: The Transaction being settled.
+        kind: 'charge' or 'refund'.
+        amount: Defaults to the transaction amount (negated for refunds).
+        at: When the money moved; defaults to the transaction's created_at.
+
+    Returns:
+        bool: True if a new entry was written.
+    """
+    connection = db.session.connection()
+    at = at or transaction.created_at or datetime.utcnow()
+    if amount is None:
+        amount = -transaction.amount if kind == 'refund' else transaction.amount
+    company_id = connection.execute(
+        select(Service.company_id).where(Service.id == transaction.service_id)
+    ).scalar()
+
+    # Also on Postgres: a charge may arrive before maintain_partitions has created its month
+    ensure_partition(connection, at)
+    table = LedgerEntry.__table__ if _native(connection) else partition_table(at)
+
+    written = _insert_ignore(connection, table, {
+        'created_at': at,
+        'transaction_id': transaction.id,
+        'kind': kind,
+        'service_id': transaction.service_id,
+        'company_id': company_id,
+        'amount': amount,
+        'currency': transaction.currency,
+    })
+    if written:
+        _bump_rollup(connection, at.date(), transaction.service_id, company_id, transaction.currency, amount)
+        inc('ledger_entries_posted_total', kind=kind)
+    return written
+
+
+def backfill(since=None, batch_size=1000):
+    """Posts every successful transaction missing from the ledger; months already archived are skipped."""
+    archived = {month for (month,) in db.session.query(LedgerArchive.month)}
+    return sum(sharding.scatter(_backfill_shard, archived, since, batch_size).values())
+
+
+def _backfill_shard(archived, since, batch_size):
+    query = Transaction.query.filter(Transaction.status == 'success')
+    if since:
+        query = query.filter(Transaction.created_at >= since)
+
+    posted, last_id = 0, 0
+    while True:
+        batch = query.filter(Transaction.id > last_id).order_by(Transaction.id).limit(batch_size).all()
+        if not batch:
+            break
+        for transaction in batch:
+            created_at = transaction.created_at or datetime.utcnow()
+            if f"{created_at:%Y%m}" not in archived:
+                posted += post(transaction, at=created_at)
+        db.session.commit()
+        last_id = batch[-1].id
+    return posted
+
+
+#--------------------- Reports (rollups only)
+def revenue_by_day(date_from, date_to, company_id=None, service_id=None):
+    """Daily gross/refunds/net between two dates (inclusive)."""
+    query = db.session.query(
+        RevenueRollup.day, RevenueRollup.currency,
+        func.sum(RevenueRollup.gross), func.sum(RevenueRollup.refunds), func.sum(RevenueRollup.charges),
+    ).filter(RevenueRollup.day >= date_from, RevenueRollup.day <= date_to)
+    if company_id is not None:
+        query = query.filter(RevenueRollup.company_id == company_id)
+    if service_id is not None:
+        query = query.filter(RevenueRollup.service_id == service_id)
+    rows = query.group_by(RevenueRollup.day, RevenueRollup.currency).order_by(RevenueRollup.day)
+    return [
+        {"day": day.isoformat(), "currency": currency, "gross": gross, "refunds": refunds,
+         "net": gross - refunds, "charges": charges}
+        for day, currency, gross, refunds, charges in rows
+    ]
+
+
+def payout_report(date_from, date_to, company_id=None):
+    """What each company is owed for a period (inclusive), per currency."""
+    query = db.session.query(
+        RevenueRollup.company_id, RevenueRollup.currency,
+        func.sum(RevenueRollup.gross), func.sum(RevenueRollup.refunds), func.sum(RevenueRollup.charges),
+    ).filter(RevenueRollup.day >= date_from, RevenueRollup.day <= date_to)
+    if company_id is not None:
+        query = query.filter(RevenueRollup.company_id == company_id)
+    rows = query.group_by(RevenueRollup.company_id, RevenueRollup.currency).order_by(RevenueRollup.company_id)
+    return [
+        {"company_id": company, "currency": currency, "gross": gross, "refunds": refunds,
+         "net": gross - refunds, "charges": charges}
+        for company, currency, gross, refunds, charges in rows
+    ]
+
+
+def total_revenue():
+    net = db.session.query(func.sum(RevenueRollup.gross - RevenueRollup.refunds)).scalar()
+    return net or 0
+
+
+#--------------------- Archival
+def _write_parquet(rows, path):
+    writer = None
+    count = 0
+    try:
+        for batch in rows.partitions(ARCHIVE_BATCH):
+            data = pyarrow.Table.from_pylist([dict(row._mapping) for row in batch])
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, data.schema, compression='zstd')
+            writer.write_table(data)
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def _write_csv(rows, path):
+    count = 0
+    with gzip.open(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(rows.keys())
+        for batch in rows.partitions(ARCHIVE_BATCH):
+            writer.writerows(batch)
+            count += len(batch)
+    return count
+
+
+def archive_month(month, directory=None):
+    """
+    Moves one month (YYYYMM) of ledger entries to a compressed file and drops its table.
+
+    The partition is detached (Postgres) before export and only dropped once
+    the file is complete, all in one transaction, so a failure leaves it in place.
+    """
+    start = datetime.strptime(month, '%Y%m')
+    name = partition_name(start)
+    table = partition_table(start)
+    directory = directory or current_app.config['LEDGER_ARCHIVE_DIR']
+    os.makedirs(directory, exist_ok=True)
+
+    connection = db.session.connection()
+    if _native(connection):
+        connection.execute(text(f"ALTER TABLE {LedgerEntry.__tablename__} DETACH PARTITION {name}"))
+
+    rows = connection.execute(
+        select(table).order_by(table.c.created_at, table.c.transaction_id),
+        execution_options={'stream_results': True},
+    )
+    extension = 'parquet' if pyarrow is not None else 'csv.gz'
+    path = os.path.join(directory, f"{name}.{extension}")
+    partial = path + '.partial'
+    try:
+        count = _write_parquet(rows, partial) if pyarrow is not None else _write_csv(rows, partial)
+        os.replace(partial, path)
+    except Exception:
+        db.session.rollback()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    table.drop(connection)
+    _partition_months.discard(start)
+    db.session.merge(LedgerArchive(month=month, path=path, row_count=count, archived_at=datetime.utcnow()))
+    db.session.commit()
+    inc('ledger_months_archived_total')
+    logger.info(f"Archived {count} ledger entries for {month} to {path}")
+    return path
+
+
+@periodic(MAINTENANCE_INTERVAL, name='ledger.maintain')
+def maintain_partitions(now=None):
+    """Creates the next months' partitions and archives months older than HOT_MONTHS."""
+    now = now or datetime.utcnow()
+    current = _month_start(now)
+    connection = db.session.connection()
+    for offset in range(MONTHS_AHEAD + 1):
+        ensure_partition(connection, _add_months(current, offset))
+    if _native(connection):
+        # Catches rows outside the pre-created range (e.g. backfills of old months)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {LedgerEntry.__tablename__}_default "
+            f"PARTITION OF {LedgerEntry.__tablename__} DEFAULT"
+        ))
+    db.session.commit()
+
+    cutoff = f"{_add_months(current, -HOT_MONTHS):%Y%m}"
+    for month in existing_months(db.session.connection()):
+        if month < cutoff:
+            archive_month(month)
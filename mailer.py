@@ -0,0 +1,327 @@
+# mailer.py
+"""
+Transactional email.
+
+Requests never talk to the mail provider. send() adds an EmailMessage to
+the caller's transaction, so a rolled-back booking sends nothing. The
+mail.flush job then delivers whatever is due, in batches:
+
+- Messages are grouped by template. Each group goes out as one SendGrid
+  request with up to 1,000 personalizations (one per recipient).
+- Templates in templates/email/ are rendered once per process. Values that
+  differ per recipient are left as substitution tags (-name-), so every
+  message in a batch shares one body.
+- Addresses on the suppression list are skipped. The list is fed by the
+  SendGrid event webhook: bounces, drops, spam reports and unsubscribes.
+- A failed batch is retried with backoff, up to MAX_ATTEMPTS. If SendGrid
+  rejects a whole batch, it is split in halves until the bad address is
+  isolated, so one bad address can't hold the rest back.
+
+MAIL_URL picks the transport:
+- sendgrid:// is the default and uses SENDGRID_API_KEY.
+- file:///path writes one .eml per message, for tests and development.
+- smtp://host:port sends to e.g. a local debugging SMTP server.
+
+The webhook only accepts events signed with SENDGRID_WEBHOOK_PUBLIC_KEY.
+Set SENDGRID_WEBHOOK_UNSIGNED=1 to accept unsigned events in development.
+"""
+import logging
+import os
+import smtplib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from email.message import EmailMessage as MIMEMessage
+
+from flask import Blueprint, jsonify, request
+from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup, escape
+from python_http_client.exceptions import HTTPError
+from sqlalchemy import select
+
+from extensions import db
+from jobs import periodic
+from metrics import inc
+from models import EmailMessage, EmailSuppression
+
+logger = logging.getLogger(__name__)
+
+mail_hooks = Blueprint("mail_hooks", __name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+FROM_EMAIL = os.getenv('MAIL_FROM', 'no-reply@tozalab.uz')
+FROM_NAME = os.getenv('MAIL_FROM_NAME', 'TozaLab')
+SITE_URL = os.getenv('SITE_URL', 'https://tozalab.uz')
+
+# template -> subject; the body is templates/email/<template>.html and .txt
+TEMPLATES = {
+    'booking_confirmation': 'Your booking for -service- is confirmed',
+    'payment_receipt': 'Receipt for your payment of -amount-',
+    'appointment_reminder': 'Reminder: -service- on -date- at -time-',
+}
+
+FLUSH_INTERVAL = 5  # seconds
+OUTBOX_BATCH = 2000  # messages claimed per flush
+PERSONALIZATIONS_PER_REQUEST = 1000  # SendGrid's limit
+MAX_ATTEMPTS = 6
+RETRY_BACKOFF = 30  # seconds, doubled per attempt
+SUPPRESSING_EVENTS = {'bounce', 'dropped', 'spamreport', 'unsubscribe', 'group_unsubscribe'}
+
+
+class TransportError(Exception):
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+#--------------------- Templates
+def _environment(autoescape, tag):
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=autoescape, trim_blocks=True, lstrip_blocks=True)
+    env.globals.update(field=tag, site_url=SITE_URL)
+    return env
+
+
+# HTML bodies get an escaped copy of each value, subjects and text bodies the raw one
+_html_env = _environment(True, lambda name: Markup(f"-{name}:html-"))
+_text_env = _environment(False, lambda name: f"-{name}-")
+_compiled = {}
+
+
+def compiled(template):
+    """(subject, html, text) with substitution tags, rendered once per process."""
+    if template not in _compiled:
+        _compiled[template] = (
+            TEMPLATES[template],
+            _html_env.get_template(f"{template}.html").render(),
+            _text_env.get_template(f"{template}.txt").render(),
+        )
+    return _compiled[template]
+
+
+def substitutions(values):
+    tags = {}
+    for name, value in values.items():
+        tags[f"-{name}-"] = str(value)
+        tags[f"-{name}:html-"] = str(escape(value))
+    return tags
+
+
+def apply(content, tags):
+    """What SendGrid does with the tags; used by the local transports."""
+    for tag, value in tags.items():
+        content = content.replace(tag, value)
+    return content
+
+
+#--------------------- Queueing
+def send(template, to_email, **values):
+    """Adds a message to the current transaction; it goes out after commit, within FLUSH_INTERVAL."""
+    if template not in TEMPLATES:
+        raise ValueError(f"Unknown email template: {template}")
+    message = EmailMessage(template=template, to_email=to_email,
+                           substitutions={name: str(value) for name, value in values.items()})
+    db.session.add(message)
+    inc('mail_queued_total', template=template)
+    return message
+
+
+def suppress(email, reason):
+    email = email.strip().lower()
+    if not db.session.get(EmailSuppression, email):
+        db.session.add(EmailSuppression(email=email, reason=reason))
+
+
+#--------------------- Transports
+class SendGridTransport:
+    def __init__(self):
+        from sendgrid import SendGridAPIClient
+        self.client = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
+
+    def send(self, template, messages):
+        subject, html, text = compiled(template)
+        payload = {
+            'from': {'email': FROM_EMAIL, 'name': FROM_NAME},
+            'subject': subject,
+            'content': [{'type': 'text/plain', 'value': text}, {'type': 'text/html', 'value': html}],
+            'personalizations': [
+                {
+                    'to': [{'email': m.to_email}],
+                    'substitutions': substitutions(m.substitutions),
+                    'custom_args': {'email_message_id': str(m.id)},
+                }
+                for m in messages
+            ],
+        }
+        try:
+            self.client.send(payload)
+        except HTTPError as e:
+            # 4xx other than rate limiting won't succeed on a retry
+            permanent = 400 <= e.status_code < 500 and e.status_code != 429
+            raise TransportError(f"SendGrid {e.status_code}: {e.body}", permanent=permanent)
+
+
+def _mime(template, message):
+    subject, html, text = compiled(template)
+    tags = substitutions(message.substitutions)
+    mime = MIMEMessage()
+    mime['From'] = f"{FROM_NAME} <{FROM_EMAIL}>"
+    mime['To'] = message.to_email
+    mime['Subject'] = apply(subject, tags)
+    mime.set_content(apply(text, tags))
+    mime.add_alternative(apply(html, tags), subtype='html')
+    return mime
+
+
+class FileTransport:
+    """Writes <id>.eml files instead of sending; tests read them back."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, template, messages):
+        for message in messages:
+            with open(os.path.join(self.directory, f"{message.id}.eml"), 'wb') as f:
+                f.write(bytes(_mime(template, message)))
+
+
+class SMTPTransport:
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+
+    def send(self, template, messages):
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+                for message in messages:
+                    smtp.send_message(_mime(template, message))
+        except (OSError, smtplib.SMTPException) as e:
+            raise TransportError(f"SMTP: {e}")
+
+
+_transport = None
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        url = os.getenv('MAIL_URL', 'sendgrid://')
+        if url.startswith('file://'):
+            _transport = FileTransport(url[len('file://'):])
+        elif url.startswith('smtp://'):
+            host, _, port = url[len('smtp://'):].partition(':')
+            _transport = SMTPTransport(host or 'localhost', int(port or 25))
+        else:
+            _transport = SendGridTransport()
+    return _transport
+
+
+#--------------------- Delivery
+def _failed(messages, error, permanent):
+    now = datetime.utcnow()
+    for message in messages:
+        message.attempts += 1
+        message.last_error = str(error)[:255]
+        if permanent or message.attempts >= MAX_ATTEMPTS:
+            message.status = 'failed'
+            inc('mail_failed_total', template=message.template)
+        else:
+            message.send_after = now + timedelta(seconds=RETRY_BACKOFF * 2 ** (message.attempts - 1))
+
+
+def _deliver(transport, template, messages):
+    try:
+        transport.send(template, messages)
+    except TransportError as e:
+        logger.warning(f"Sending {len(messages)} {template} emails failed: {e}")
+        if e.permanent and len(messages) > 1:
+            # One bad personalization rejects the whole request; halve until it is isolated
+            middle = len(messages) // 2
+            _deliver(transport, template, messages[:middle])
+            _deliver(transport, template, messages[middle:])
+        else:
+            _failed(messages, e, e.permanent)
+        return
+    now = datetime.utcnow()
+    for message in messages:
+        message.status = 'sent'
+        message.sent_at = now
+    inc('mail_sent_total', len(messages), template=template)
+    inc('mail_requests_total', template=template)
+
+
+@periodic(FLUSH_INTERVAL, name='mail.flush', queue='notifications', max_retries=0)
+def flush_outbox():
+    """Claims due messages, drops suppressed ones and sends the rest, one request per template and 1,000 recipients."""
+    due = (
+        EmailMessage.query
+        .filter(EmailMessage.status == 'queued', EmailMessage.send_after <= datetime.utcnow())
+        .order_by(EmailMessage.send_after, EmailMessage.id)
+        .limit(OUTBOX_BATCH)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not due:
+        return 0
+
+    addresses = {m.to_email.strip().lower() for m in due}
+    suppressed = set(db.session.execute(
+        select(EmailSuppression.email).where(EmailSuppression.email.in_(addresses))
+    ).scalars())
+    groups = defaultdict(list)
+    for message in due:
+        if message.to_email.strip().lower() in suppressed:
+            message.status = 'suppressed'
+            inc('mail_suppressed_total', template=message.template)
+        else:
+            groups[message.template].append(message)
+
+    transport = get_transport()
+    for template, messages in groups.items():
+        for start in range(0, len(messages), PERSONALIZATIONS_PER_REQUEST):
+            _deliver(transport, template, messages[start:start + PERSONALIZATIONS_PER_REQUEST])
+    db.session.commit()
+
+    if len(due) == OUTBOX_BATCH:
+        flush_outbox.delay()  # more is waiting; don't wait for the next tick
+    return len(due)
+
+
+#--------------------- Event webhook
+def _verified(payload):
+    """Checks SendGrid's signature. Without a public key nothing is accepted, unless
+    SENDGRID_WEBHOOK_UNSIGNED=1 is set for local development."""
+    key = os.getenv('SENDGRID_WEBHOOK_PUBLIC_KEY')
+    if not key:
+        if os.getenv('SENDGRID_WEBHOOK_UNSIGNED') == '1':
+            return True
+        logger.warning("Rejected a SendGrid webhook: SENDGRID_WEBHOOK_PUBLIC_KEY is not set")
+        return False
+    from sendgrid.helpers.eventwebhook import EventWebhook, EventWebhookHeader
+    webhook = EventWebhook(key)
+    return webhook.verify_signature(
+        payload,
+        request.headers.get(EventWebhookHeader.SIGNATURE, ''),
+        request.headers.get(EventWebhookHeader.TIMESTAMP, ''),
+    )
+
+
+@mail_hooks.route('/webhooks/sendgrid', methods=['POST'])
+def sendgrid_events():
+    """Adds bounced, dropped, spam-reporting and unsubscribed addresses to the suppression list."""
+    payload = request.get_data(as_text=True)
+    try:
+        if not _verified(payload):
+            return jsonify({"message": "Invalid signature"}), 403
+    except Exception:
+        return jsonify({"message": "Invalid signature"}), 403
+
+    events = request.get_json(silent=True)
+    if not isinstance(events, list):
+        return jsonify({"message": "Expected a list of events"}), 400
+    added = 0
+    for event in events:
+        if isinstance(event, dict) and event.get('event') in SUPPRESSING_EVENTS and event.get('email'):
+            suppress(event['email'], event['event'])
+            added += 1
+    db.session.commit()
+    inc('mail_webhook_events_total', len(events))
+    return jsonify({"suppressed": added}), 200
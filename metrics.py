@@ -0,0 +1,74 @@
+# metrics.py
+import logging
+import threading
+from collections import defaultdict
+
+from flask import Blueprint, Response
+
+logger = logging.getLogger(__name__)
+
+metrics = Blueprint("metrics", __name__)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_summaries = defaultdict(lambda: [0, 0.0])
+_collectors = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Records one sample of a duration or size (exported as _count and _sum)."""
+    with _lock:
+        summary = _summaries[_key(name, labels)]
+        summary[0] += 1
+        summary[1] += value
+
+
+def register_collector(fn):
+    """Registers a callable yielding (name, labels, value) tuples, evaluated on every scrape."""
+    _collectors.append(fn)
+    return fn
+
+
+def _format(name, labels, value):
+    if labels:
+        label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+        return f"{name}{{{label_str}}} {value}"
+    return f"{name} {value}"
+
+
+def render():
+    """Renders every metric in the Prometheus text exposition format."""
+    with _lock:
+        lines = [_format(n, l, v) for (n, l), v in sorted(_counters.items())]
+        lines += [_format(n, l, v) for (n, l), v in sorted(_gauges.items())]
+        for (n, l), (count, total) in sorted(_summaries.items()):
+            lines.append(_format(f"{n}_count", l, count))
+            lines.append(_format(f"{n}_sum", l, total))
+
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                lines.append(_format(name, tuple(sorted(labels.items())), value))
+        except Exception as e:
+            logger.error(f"Metrics collector {collector.__name__} failed: {e}")
+    return '\n'.join(lines) + '\n'
+
+
+@metrics.route('/metrics')
+def metrics_endpoint():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -1,22 +1,43 @@
 from extensions import db
 from datetime import datetime
 
+
+# Rows the analytics export (cdc.py) picks up by change time. Every UPDATE, ORM
+# or Core, bumps updated_at and version through onupdate; deletes leave a
+# CdcTombstone.
+class ChangeTracked:
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1, onupdate=db.literal_column('version') + 1)
+
+
 class Admin(db.Model):
     __tablename__ = 'admins'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password_hash = db.Column(db.LargeBinary(128), nullable=False)
 
+# Categories form a tree. `path` is the materialized chain of ids from the root
+# ("/1/4/9/"), so a subtree is one `path LIKE '/1/4/%'` prefix scan. The counts
+# are kept by categories.py in the same transaction as the Service write:
+# service_count is the category's own services, total_services includes descendants.
 class Category(db.Model):
     __tablename__ = 'categories'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('categories.id'), index=True)
+    path = db.Column(db.String(255), index=True)
+    depth = db.Column(db.Integer, nullable=False, default=0)
+    service_count = db.Column(db.Integer, nullable=False, default=0)
+    total_services = db.Column(db.Integer, nullable=False, default=0)
     services = db.relationship('Service', back_populates='category', lazy=True)
+    parent = db.relationship('Category', remote_side=[id], backref='children')
 
     def to_dict(self):
         return {
             "id": self.id,
-            "name": self.name
+            "name": self.name,
+            "parent_id": self.parent_id,
+            "total_services": self.total_services,
         }
 
 
@@ -37,7 +58,7 @@ class Service(db.Model):
     disputes = db.relationship('Dispute', backref='service', lazy=True)
     bookings = db.relationship('Booking', backref='service', lazy=True)
 
-class Transaction(db.Model):
+class Transaction(ChangeTracked, db.Model):
     __tablename__ = 'transactions'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -45,14 +66,54 @@ class Transaction(db.Model):
     booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'), nullable=False)
     amount = db.Column(db.Integer, nullable=False)
     currency = db.Column(db.String(3), nullable=False)
-    status = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # 'pending', 'requires_action', 'success', 'failed'
+    charge_id = db.Column(db.String(64))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = {'sqlite_autoincrement': True}
+
     def __repr__(self):
         return f"<Transaction {self.id} - User {self.user_id} - Service {self.service_id}>"
 
+# Append-only ledger of settled money movements, partitioned by month on created_at.
+# On Postgres this is a natively partitioned table; elsewhere ledger.py writes to
+# monthly ledger_entries_YYYYMM tables with the same columns.
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+    created_at = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)  # partition key
+    transaction_id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)  # 'charge', 'refund'
+    service_id = db.Column(db.Integer, nullable=False)
+    company_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # minor units; negative for refunds
+    currency = db.Column(db.String(3), nullable=False)
+
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
+
+# Daily revenue per service, kept up to date as ledger entries are posted
+class RevenueRollup(db.Model):
+    __tablename__ = 'revenue_rollups'
+    day = db.Column(db.Date, primary_key=True)
+    service_id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    company_id = db.Column(db.Integer, nullable=False)
+    gross = db.Column(db.BigInteger, nullable=False, default=0)
+    refunds = db.Column(db.BigInteger, nullable=False, default=0)
+    charges = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_revenue_rollups_company_day', 'company_id', 'day'),
+    )
+
+class LedgerArchive(db.Model):
+    __tablename__ = 'ledger_archives'
+    month = db.Column(db.String(6), primary_key=True)  # YYYYMM
+    path = db.Column(db.String(300), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # Booking Model
-class Booking(db.Model):
+class Booking(ChangeTracked, db.Model):
     __tablename__ = 'bookings'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -65,8 +126,11 @@ class Booking(db.Model):
     # Relationships
     transactions = db.relationship('Transaction', backref='booking', lazy=True)
 
+    # Shards hand out ids from disjoint ranges (see sharding.py); SQLite needs AUTOINCREMENT for that
+    __table_args__ = {'sqlite_autoincrement': True}
+
 
-class Review(db.Model):
+class Review(ChangeTracked, db.Model):
     __tablename__ = 'reviews'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -76,13 +140,14 @@ class Review(db.Model):
     status = db.Column(db.Enum('pending', 'approved', 'rejected', name='review_status'), default='pending')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-class User(db.Model):
+class User(ChangeTracked, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password_hash = db.Column(db.LargeBinary(128), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     phone_number = db.Column(db.String(20), unique=True, nullable=False)
+    stripe_customer_id = db.Column(db.String(64), unique=True)
     addresses = db.relationship('Address', backref='user', lazy=True)
     payment_methods = db.relationship('PaymentMethod', backref='user', lazy=True)
     transactions = db.relationship('Transaction', backref='user', lazy=True)
@@ -97,7 +162,24 @@ class Dispute(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     service_id = db.Column(db.Integer, db.ForeignKey('services.id'), nullable=False)
     description = db.Column(db.Text, nullable=False)
-    status = db.Column(db.String(20), default="Open")
+    status = db.Column(db.String(20), default="Open")  # 'Open', 'In Progress', 'Resolved'
+    priority = db.Column(db.SmallInteger, nullable=False, default=2)  # 1 = high, 3 = low
+    assignee_id = db.Column(db.Integer, db.ForeignKey('admins.id'))
+    claimed_at = db.Column(db.DateTime)
+    sla_due_at = db.Column(db.DateTime)
+    sla_breached = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Partial indexes: only unresolved rows are indexed, so they stay small
+    __table_args__ = (
+        db.Index('ix_disputes_open_queue', 'priority', 'sla_due_at', 'id',
+                 postgresql_where=db.text("status = 'Open'"), sqlite_where=db.text("status = 'Open'")),
+        db.Index('ix_disputes_assignee_active', 'assignee_id',
+                 postgresql_where=db.text("status = 'In Progress'"), sqlite_where=db.text("status = 'In Progress'")),
+        db.Index('ix_disputes_sla_pending', 'sla_due_at',
+                 postgresql_where=db.text("status != 'Resolved' AND NOT sla_breached"),
+                 sqlite_where=db.text("status != 'Resolved' AND NOT sla_breached")),
+    )
 
 class Address(db.Model):
     __tablename__ = 'addresses'
@@ -109,12 +191,31 @@ class Address(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
 # PaymentMethod Model
+# A saved card is a Stripe PaymentMethod attached to the user's Stripe customer;
+# only its id and display details are stored here, never the card number.
 class PaymentMethod(db.Model):
     __tablename__ = 'payment_methods'
     id = db.Column(db.Integer, primary_key=True)
-    card_number = db.Column(db.String(16), nullable=False)
-    expiration_date = db.Column(db.String(7), nullable=False)  # Format: MM/YYYY
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    stripe_payment_method_id = db.Column(db.String(64), unique=True)  # NULL for scrubbed legacy cards
+    brand = db.Column(db.String(20))
+    last4 = db.Column(db.String(4))
+    exp_month = db.Column(db.Integer)
+    exp_year = db.Column(db.Integer)
+    is_default = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Legacy raw values; wallet.scrub_card_numbers empties them
+    card_number = db.Column(db.String(16))
+    expiration_date = db.Column(db.String(7))  # Format: MM/YYYY
+
+    __table_args__ = (
+        # At most one default card per user
+        db.Index('uq_payment_methods_default', 'user_id', unique=True,
+                 postgresql_where=db.text('is_default'), sqlite_where=db.text('is_default')),
+        db.Index('ix_payment_methods_unscrubbed', 'id',
+                 postgresql_where=db.text('card_number IS NOT NULL'),
+                 sqlite_where=db.text('card_number IS NOT NULL')),
+    )
 
 
 class Notification(db.Model):
@@ -126,14 +227,89 @@ class Notification(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+# Outbox of transactional email. A message is written in the same transaction as
+# the booking or payment it describes and delivered in batches by mailer.flush_outbox.
+class EmailMessage(db.Model):
+    __tablename__ = 'email_messages'
+    id = db.Column(db.Integer, primary_key=True)
+    template = db.Column(db.String(50), nullable=False)
+    to_email = db.Column(db.String(120), nullable=False)
+    substitutions = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(12), nullable=False, default='queued')  # queued, sent, suppressed, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    send_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_email_messages_due', 'send_after', 'id',
+                 postgresql_where=db.text("status = 'queued'"), sqlite_where=db.text("status = 'queued'")),
+    )
+
+
+# Addresses that must not be mailed again (bounced, reported spam, unsubscribed)
+class EmailSuppression(db.Model):
+    __tablename__ = 'email_suppressions'
+    email = db.Column(db.String(120), primary_key=True)  # lower-cased
+    reason = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# FCM registration token of one app install. A token belongs to one user at a
+# time (re-registering from another account moves it) and is deleted as soon
+# as FCM reports it unregistered.
+class DeviceToken(db.Model):
+    __tablename__ = 'device_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    token = db.Column(db.String(255), nullable=False, unique=True)
+    platform = db.Column(db.String(10), nullable=False, default='android')  # 'android', 'ios' or 'web'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    user = db.relationship('User', backref=db.backref('device_tokens', lazy=True))
+    topics = db.relationship('DeviceTopic', backref='device', lazy=True, cascade='all, delete-orphan')
+
+
+# FCM topics a token is subscribed to, so topic changes only send the difference
+class DeviceTopic(db.Model):
+    __tablename__ = 'device_topics'
+    device_id = db.Column(db.Integer, db.ForeignKey('device_tokens.id', ondelete='CASCADE'), primary_key=True)
+    topic = db.Column(db.String(100), primary_key=True, index=True)
+
+
 # SupportTicket Model
 class SupportTicket(db.Model):
     __tablename__ = 'support_tickets'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))  # Optional (for guest users)
     message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="Open")  # 'Open', 'In Progress', 'Resolved'
+    priority = db.Column(db.SmallInteger, nullable=False, default=2)  # 1 = high, 3 = low
+    assignee_id = db.Column(db.Integer, db.ForeignKey('admins.id'))
+    claimed_at = db.Column(db.DateTime)
+    sla_due_at = db.Column(db.DateTime)
+    sla_breached = db.Column(db.Boolean, nullable=False, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_support_tickets_open_queue', 'priority', 'sla_due_at', 'id',
+                 postgresql_where=db.text("status = 'Open'"), sqlite_where=db.text("status = 'Open'")),
+        db.Index('ix_support_tickets_assignee_active', 'assignee_id',
+                 postgresql_where=db.text("status = 'In Progress'"), sqlite_where=db.text("status = 'In Progress'")),
+        db.Index('ix_support_tickets_sla_pending', 'sla_due_at',
+                 postgresql_where=db.text("status != 'Resolved' AND NOT sla_breached"),
+                 sqlite_where=db.text("status != 'Resolved' AND NOT sla_breached")),
+    )
+
+
+# Per-queue, per-status item counts kept in step with SupportTicket/Dispute writes
+class TriageCounter(db.Model):
+    __tablename__ = 'triage_counters'
+    queue = db.Column(db.String(20), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
 class Company(db.Model):
     __tablename__ = 'companies'
     email = db.Column(db.String(120), unique=True, nullable=True)
@@ -144,4 +320,57 @@ class Company(db.Model):
     license_pdf = db.Column(db.String(255)) 
     logo = db.Column(db.String(255)) 
     date = db.Column(db.DateTime, default=datetime.utcnow)
-    service=db.relationship('Service', backref='company', lazy=True) 
\ No newline at end of file
+    service=db.relationship('Service', backref='company', lazy=True) 
+
+# A reminder due at fire_at (UTC) for one occurrence of a booking. Rows are
+# written by reminders.py in the same transaction as the booking; the dispatcher
+# only ever reads the pending rows that are due, through ix_reminders_due.
+class Reminder(db.Model):
+    __tablename__ = 'reminders'
+    id = db.Column(db.Integer, primary_key=True)
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'day_before', 'hour_before'
+    occurs_at = db.Column(db.DateTime, nullable=False)  # the appointment, UTC
+    fire_at = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(12), nullable=False, default='pending')  # pending, sent, expired, cancelled
+    channel = db.Column(db.String(10))  # 'push' or 'email', once sent
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('booking_id', 'occurs_at', 'kind', name='uq_reminders_occurrence'),
+        db.Index('ix_reminders_due', 'fire_at', 'id',
+                 postgresql_where=db.text("status = 'pending'"), sqlite_where=db.text("status = 'pending'")),
+        {'sqlite_autoincrement': True},
+    )
+
+
+# A deleted row of a ChangeTracked table, exported by cdc.py as a delete record
+class CdcTombstone(db.Model):
+    __tablename__ = 'cdc_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer)  # the row's version + 1
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_cdc_tombstones_table', 'table_name', 'id'), {'sqlite_autoincrement': True})
+
+
+# How far the export of one table has got: the last (updated_at, id) and tombstone written
+class CdcWatermark(db.Model):
+    __tablename__ = 'cdc_watermarks'
+    table_name = db.Column(db.String(50), primary_key=True)
+    updated_at = db.Column(db.DateTime)
+    row_id = db.Column(db.Integer, nullable=False, default=0)
+    tombstone_id = db.Column(db.Integer, nullable=False, default=0)
+    exported_at = db.Column(db.DateTime)
+
+
+# The shard holding a company's bookings and transactions (see sharding.py).
+# Companies without a row stay on the primary database.
+class ShardAssignment(db.Model):
+    __tablename__ = 'shard_assignments'
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), primary_key=True)
+    shard = db.Column(db.String(20), nullable=False)
+    assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
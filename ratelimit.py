@@ -0,0 +1,152 @@
+# ratelimit.py
+import logging
+import math
+import threading
+import time
+from functools import wraps
+
+import redis
+from flask import request, session, jsonify, render_template
+
+from application import redis_client
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# Token bucket: refills `rate` tokens per second up to `capacity`.
+# Runs atomically in Redis so concurrent workers share one budget per key.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+REDIS_RETRY_AFTER = 30  # seconds to stay on the in-process fallback after a Redis error
+
+
+class MemoryLimiter:
+    """In-process token buckets, used when Redis is unavailable or in tests."""
+
+    SWEEP_INTERVAL = 60  # seconds between sweeps of buckets that have refilled
+
+    def __init__(self):
+        self.buckets = {}  # key -> (tokens, ts, full_at)
+        self.lock = threading.Lock()
+        self.swept_at = time.monotonic()
+
+    def _sweep(self, now):
+        # A full bucket is the same as no bucket, so drop it
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        self.swept_at = now
+
+    def hit(self, key, capacity, rate, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.swept_at >= self.SWEEP_INTERVAL:
+                self._sweep(now)
+            tokens, ts, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - ts) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return (True, 0) if allowed else (False, (cost - tokens) / rate)
+
+
+class RedisLimiter:
+    def __init__(self, client):
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def hit(self, key, capacity, rate, cost=1):
+        allowed, retry_after = self.script(keys=[f"ratelimit:{key}"], args=[capacity, rate, time.time(), cost])
+        return bool(int(allowed)), float(retry_after)
+
+
+class Limiter:
+    def __init__(self, client=None):
+        self.redis = RedisLimiter(client) if client is not None else None
+        self.memory = MemoryLimiter()
+        self.redis_down_until = 0
+
+    def hit(self, key, capacity, rate, cost=1):
+        """Takes `cost` tokens from the bucket. Returns (allowed, retry_after_seconds)."""
+        if self.redis is not None and time.monotonic() >= self.redis_down_until:
+            try:
+                return self.redis.hit(key, capacity, rate, cost)
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Rate limiter falling back to in-process buckets: {e}")
+                self.redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+        return self.memory.hit(key, capacity, rate, cost)
+
+
+limiter = Limiter(redis_client)
+
+
+#--------------------- Key functions
+def by_ip():
+    # remote_addr is the client's, not the balancer's: application.py applies ProxyFix for trusted hops
+    return request.remote_addr or 'unknown'
+
+
+def by_user():
+    user_id = session.get('user_id')
+    return f"user:{user_id}" if user_id else f"ip:{by_ip()}"
+
+
+def by_form_field(name):
+    """Keys on a submitted field, e.g. the username targeted by a login attempt."""
+    def key():
+        value = request.form.get(name) or (request.get_json(silent=True) or {}).get(name)
+        return f"{name}:{str(value).strip().lower()}" if value else f"ip:{by_ip()}"
+    return key
+
+
+def _too_many_requests(retry_after):
+    retry_after = max(int(math.ceil(retry_after)), 1)
+    message = "Too many requests. Please try again later."
+    if request.is_json or request.path.startswith('/api'):
+        response = jsonify({"message": message, "retry_after": retry_after})
+    else:
+        response = render_template("error.html", error=message)
+    return response, 429, {'Retry-After': str(retry_after)}
+
+
+def rate_limit(limit, period, key=by_ip, scope=None, methods=('POST',)):
+    """
+    Decorator allowing `limit` requests per `period` seconds for each key.
+
+    The check runs before the view body, so rejected requests never reach
+    password hashing or the database. Stack several decorators to limit by
+    IP and by user/account at the same time.
+    """
+    def decorator(f):
+        name = scope or f.__name__
+        capacity = float(limit)
+        rate = limit / float(period)
+
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method in methods:
+                allowed, retry_after = limiter.hit(f"{name}:{key()}", capacity, rate)
+                if not allowed:
+                    inc('rate_limited_total', scope=name)
+                    return _too_many_requests(retry_after)
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
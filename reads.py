@@ -0,0 +1,65 @@
+# reads.py
+"""
+Read-only fast path for the hot JSON endpoints.
+
+The statements are lambda_stmt()s: SQLAlchemy compiles each one once per
+process, caches it under the lambda's code location, and afterwards only
+swaps in the new parameter values. Results are plain Row tuples and never
+go through the ORM (no identity map, no instance state), and the serializers
+read them directly, since a Row exposes its columns as attributes.
+
+Use this module only for responses built straight from columns. Anything
+that modifies objects or follows relationships still loads models.
+
+    python bench_reads.py   # per-request CPU and allocations against the ORM path
+"""
+from sqlalchemy import lambda_stmt, select
+
+from extensions import db
+from models import Category, Review, Service
+
+SERVICE_COLUMNS = (
+    Service.id, Service.name, Service.price, Service.category_id, Service.company_id,
+    Service.description, Service.location, Service.image_url,
+)
+CATEGORY_COLUMNS = (Category.id, Category.name, Category.parent_id, Category.total_services)
+REVIEW_COLUMNS = (
+    Review.id, Review.user_id, Review.service_id, Review.content, Review.rating, Review.status, Review.created_at,
+)
+
+
+def _rows(stmt):
+    return db.session.execute(stmt).all()
+
+
+def _row(stmt):
+    return db.session.execute(stmt).first()
+
+
+#--------------------- Services
+def service_summary(service_id):
+    """id, name, price, description and the category name, or None."""
+    return _row(lambda_stmt(lambda: (
+        select(Service.id, Service.name, Service.price, Service.description, Category.name.label('category'))
+        .outerjoin(Category, Category.id == Service.category_id)
+        .where(Service.id == service_id)
+    )))
+
+
+def services(ids):
+    return _rows(lambda_stmt(lambda: select(*SERVICE_COLUMNS).where(Service.id.in_(ids))))
+
+
+#--------------------- Categories
+def categories():
+    return _rows(lambda_stmt(lambda: select(*CATEGORY_COLUMNS).order_by(Category.name)))
+
+
+#--------------------- Reviews
+def review(review_id):
+    return _row(lambda_stmt(lambda: select(*REVIEW_COLUMNS).where(Review.id == review_id)))
+
+
+def reviews(after=0, limit=50):
+    """One page of reviews in id order, starting after the review id `after`."""
+    return _rows(lambda_stmt(lambda: select(*REVIEW_COLUMNS).where(Review.id > after).order_by(Review.id).limit(limit)))
@@ -0,0 +1,209 @@
+# recommendations.py
+"""
+Precomputed "popular", "trending" and "people also booked" lists.
+
+A periodic job aggregates Bookings, Transactions and approved Reviews,
+scores services with NumPy and writes the top entries to Redis sorted sets:
+
+    rank:popular:all / rank:popular:<category_id>
+    rank:trending:all / rank:trending:<category_id>
+    rank:also:<service_id>
+
+The names of the sets written are kept in rank:keys, so a recompute also
+drops the sets of services and categories that no longer exist.
+
+Pages read a top-N list with one ZREVRANGE and one IN query.
+"""
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+import redis
+from scipy import sparse
+from sqlalchemy import func
+
+from application import redis_client
+from extensions import db
+from jobs import periodic
+from models import Service, Category, Booking, Transaction, Review
+import sharding
+
+logger = logging.getLogger(__name__)
+
+TOP_N = 50
+RECOMPUTE_INTERVAL = 15 * 60
+TRENDING_WINDOW_DAYS = 28
+TRENDING_HALF_LIFE_DAYS = 7
+RATING_PRIOR_WEIGHT = 5  # reviews needed before a service's own average dominates
+
+
+KEY_INDEX = 'rank:keys'  # set of the ranking keys written by the last recompute
+
+
+def _key(kind, scope='all'):
+    return f"rank:{kind}:{scope}"
+
+
+def _top(scores, ids, mask=None, n=TOP_N):
+    """Returns {service_id: score} for the n highest positive scores (optionally within mask)."""
+    if mask is not None:
+        scores = np.where(mask, scores, 0)
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > n:
+        candidates = candidates[np.argpartition(-scores[candidates], n)[:n]]
+    return {int(ids[i]): float(scores[i]) for i in candidates}
+
+
+def _grouped(query, index, n):
+    """Scatters (service_id, value) rows into an array aligned with `index`."""
+    values = np.zeros(n)
+    for service_id, value in query:
+        if service_id in index:
+            values[index[service_id]] = value or 0
+    return values
+
+
+def _from_shards(query):
+    """The rows of `query` on every shard (see sharding.scatter)."""
+    return sharding.gather(sharding.scatter(lambda: [tuple(row) for row in query]))
+
+
+def compute_scores(now=None):
+    """
+    Runs the aggregate queries and returns the score arrays.
+
+    Returns:
+        dict with 'ids', 'category_ids', 'popular', 'trending' arrays and the
+        sparse service x service 'similarity' matrix.
+    """
+    now = now or datetime.utcnow()
+    services = db.session.query(Service.id, Service.category_id).order_by(Service.id).all()
+    ids = np.array([s.id for s in services], dtype=np.int64)
+    category_ids = np.array([s.category_id for s in services], dtype=np.int64)
+    index = {int(sid): i for i, sid in enumerate(ids)}
+    n = len(ids)
+
+    # A company's bookings and transactions all sit on one shard, so per-service counts don't overlap
+    bookings = _grouped(_from_shards(
+        db.session.query(Booking.service_id, func.count(Booking.id)).group_by(Booking.service_id)
+    ), index, n)
+    payments = _grouped(_from_shards(
+        db.session.query(Transaction.service_id, func.count(Transaction.id))
+        .filter(Transaction.status == 'success')
+        .group_by(Transaction.service_id)
+    ), index, n)
+    review_rows = (
+        db.session.query(Review.service_id, func.count(Review.id), func.sum(Review.rating))
+        .filter(Review.status == 'approved')
+        .group_by(Review.service_id)
+        .all()
+    )
+    review_counts = _grouped(((r[0], r[1]) for r in review_rows), index, n)
+    rating_sums = _grouped(((r[0], r[2]) for r in review_rows), index, n)
+
+    # Bayesian average so one 5-star review doesn't outrank fifty 4.8s
+    global_mean = rating_sums.sum() / review_counts.sum() if review_counts.sum() else 0
+    ratings = (RATING_PRIOR_WEIGHT * global_mean + rating_sums) / (RATING_PRIOR_WEIGHT + review_counts)
+    popular = np.log1p(bookings) + np.log1p(payments) + 0.5 * ratings * np.log1p(review_counts)
+
+    # Trending: bookings per day over the window, exponentially decayed by age
+    since = now - timedelta(days=TRENDING_WINDOW_DAYS)
+    day = func.date(Booking.created_at)
+    trending = np.zeros(n)
+    for service_id, booked_on, count in _from_shards(
+        db.session.query(Booking.service_id, day, func.count(Booking.id))
+        .filter(Booking.created_at >= since)
+        .group_by(Booking.service_id, day)
+    ):
+        if service_id not in index:
+            continue
+        if isinstance(booked_on, str):
+            booked_on = datetime.strptime(booked_on, '%Y-%m-%d').date()
+        age = (now.date() - booked_on).days
+        trending[index[service_id]] += count * 0.5 ** (age / TRENDING_HALF_LIFE_DAYS)
+
+    # Item-to-item cosine similarity from the user x service booking matrix
+    pairs = set(_from_shards(db.session.query(Booking.user_id, Booking.service_id).distinct()))
+    pairs = [(u, index[s]) for u, s in pairs if s in index]
+    similarity = sparse.csr_matrix((n, n))
+    if pairs:
+        users = {u: i for i, u in enumerate({u for u, _ in pairs})}
+        rows = np.array([users[u] for u, _ in pairs])
+        cols = np.array([s for _, s in pairs])
+        matrix = sparse.csr_matrix((np.ones(len(pairs)), (rows, cols)), shape=(len(users), n))
+        co = (matrix.T @ matrix).tocsr()
+        counts = co.diagonal()
+        co.setdiag(0)
+        co.eliminate_zeros()
+        norms = np.sqrt(np.maximum(counts, 1))
+        similarity = sparse.diags(1 / norms) @ co @ sparse.diags(1 / norms)
+        similarity = similarity.tocsr()
+
+    return {
+        'ids': ids,
+        'category_ids': category_ids,
+        'popular': popular,
+        'trending': trending,
+        'similarity': similarity,
+    }
+
+
+@periodic(RECOMPUTE_INTERVAL, name='recommendations.recompute')
+def recompute_rankings():
+    """Recomputes every ranking and swaps the sorted sets (dropping stale ones) in one MULTI/EXEC."""
+    scores = compute_scores()
+    ids, category_ids = scores['ids'], scores['category_ids']
+    lists = {}
+
+    for kind in ('popular', 'trending'):
+        lists[_key(kind)] = _top(scores[kind], ids)
+        for (category_id,) in db.session.query(Category.id):
+            lists[_key(kind, category_id)] = _top(scores[kind], ids, mask=category_ids == category_id)
+
+    similarity = scores['similarity']
+    for i, service_id in enumerate(ids):
+        start, end = similarity.indptr[i], similarity.indptr[i + 1]
+        cols, values = similarity.indices[start:end], similarity.data[start:end]
+        best = np.argsort(-values)[:20]
+        lists[_key('also', int(service_id))] = {int(ids[cols[j]]): float(values[j]) for j in best}
+
+    written = {key for key, members in lists.items() if members}
+    stale = redis_client.smembers(KEY_INDEX) - written
+    pipe = redis_client.pipeline(transaction=True)
+    for key, members in lists.items():
+        pipe.delete(key)
+        if members:
+            pipe.zadd(key, members)
+    if stale:
+        pipe.delete(*stale)
+    pipe.delete(KEY_INDEX)
+    if written:
+        pipe.sadd(KEY_INDEX, *written)
+    pipe.execute()
+    logger.info(f"Recomputed {len(lists)} ranking lists for {len(ids)} services, dropped {len(stale)} stale")
+
+
+#--------------------- Readers
+def top_service_ids(kind, scope='all', n=10):
+    try:
+        return [int(i) for i in redis_client.zrevrange(_key(kind, scope), 0, n - 1)]
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Rankings unavailable: {e}")
+        return []
+
+
+def _services_in_order(ids):
+    if not ids:
+        return []
+    by_id = {s.id: s for s in Service.query.filter(Service.id.in_(ids))}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def top_services(kind, category_id=None, n=10):
+    """Top-N 'popular' or 'trending' services, overall or within a category."""
+    return _services_in_order(top_service_ids(kind, category_id or 'all', n))
+
+
+def also_booked(service_id, n=6):
+    """Services most often booked by the people who booked this one."""
+    return _services_in_order(top_service_ids('also', service_id, n))
@@ -0,0 +1,193 @@
+# reminders.py
+"""
+Appointment reminders.
+
+Every occurrence of a booking gets one Reminder row per REMINDER_OFFSETS
+entry that is still ahead: a day before and an hour before. The rows are
+written by mapper listeners in the same transaction as the booking. Moving
+or cancelling a booking replaces its pending rows.
+
+A weekly booking only ever has its next occurrence scheduled. When the last
+reminder of that occurrence fires, the dispatcher schedules the occurrence
+after it. The table therefore holds a few rows per booking, however long
+the booking recurs.
+
+reminders.dispatch claims due rows through the partial index on fire_at,
+REMINDER_BATCH at a time with FOR UPDATE SKIP LOCKED, so several workers
+can share the load. Its cost grows with what is due, not with the number
+of bookings. With sharding on, each shard is dispatched in turn. A
+reminder goes out as a push if the user has a registered device
+(devices.send_to_user), and through the mail outbox otherwise.
+
+Booking dates and times are local to APP_TIMEZONE; fire_at and occurs_at
+are stored in UTC like every other timestamp here.
+"""
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import event, insert, inspect, select
+
+import mailer
+from devices import send_to_user
+from extensions import db
+from jobs import periodic
+from metrics import inc, observe
+from models import Booking, DeviceToken, Reminder, Service, User
+import sharding
+
+logger = logging.getLogger(__name__)
+
+TIMEZONE = ZoneInfo(os.getenv('APP_TIMEZONE', 'Asia/Tashkent'))
+# kind -> how long before the appointment it fires
+REMINDER_OFFSETS = {
+    'day_before': timedelta(days=1),
+    'hour_before': timedelta(hours=1),
+}
+# The last reminder of an occurrence; firing it schedules the next occurrence
+LAST_KIND = min(REMINDER_OFFSETS, key=REMINDER_OFFSETS.get)
+RECURRENCE_STEPS = {'weekly': timedelta(weeks=1)}
+INACTIVE_STATUSES = {'cancelled', 'canceled', 'completed'}
+SCHEDULE_FIELDS = ('date', 'time', 'recurrence', 'status', 'user_id')
+
+DISPATCH_INTERVAL = 30  # seconds
+REMINDER_BATCH = 500
+
+
+def occurrence_utc(date, time):
+    """A booking's local date and time as naive UTC."""
+    return datetime.combine(date, time, tzinfo=TIMEZONE).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def local_time(occurs_at):
+    return occurs_at.replace(tzinfo=timezone.utc).astimezone(TIMEZONE)
+
+
+#--------------------- Scheduling
+def _schedule(connection, booking_id, user_id, occurs_at, recurrence, now):
+    """
+    Inserts the reminders still ahead for the occurrence at occurs_at.
+
+    For a recurring booking with none left (it is in the past, or less than
+    an hour away) the next occurrence that has some is used instead.
+    """
+    step = RECURRENCE_STEPS.get(recurrence)
+    if step and occurs_at < now:
+        occurs_at += step * -((occurs_at - now) // step)  # first occurrence from now on
+    while True:
+        rows = [
+            {'booking_id': booking_id, 'user_id': user_id, 'kind': kind,
+             'occurs_at': occurs_at, 'fire_at': occurs_at - offset, 'status': 'pending'}
+            for kind, offset in REMINDER_OFFSETS.items()
+            if occurs_at - offset > now
+        ]
+        if rows or not step:
+            break
+        occurs_at += step
+    if rows:
+        connection.execute(insert(Reminder.__table__), rows)
+        inc('reminders_scheduled_total', len(rows))
+    return len(rows)
+
+
+def _booking_inserted(mapper, connection, target):
+    if target.status not in INACTIVE_STATUSES:
+        _schedule(connection, target.id, target.user_id, occurrence_utc(target.date, target.time),
+                  target.recurrence, datetime.utcnow())
+
+
+def _booking_updated(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in SCHEDULE_FIELDS):
+        return
+    table = Reminder.__table__
+    connection.execute(table.delete().where(table.c.booking_id == target.id, table.c.status == 'pending'))
+    _booking_inserted(mapper, connection, target)
+
+
+event.listen(Booking, 'after_insert', _booking_inserted)
+event.listen(Booking, 'after_update', _booking_updated)
+
+
+#--------------------- Dispatching
+def _message(reminder, service):
+    when = local_time(reminder.occurs_at)
+    lead = 'Tomorrow' if reminder.kind == 'day_before' else 'In an hour'
+    return f"Reminder: {service}", f"{lead} at {when:%H:%M}", when
+
+
+@periodic(DISPATCH_INTERVAL, name='reminders.dispatch', queue='notifications', max_retries=0)
+def dispatch_due():
+    """Sends the reminders that are due, REMINDER_BATCH per shard and run; pushes are queued after each commit."""
+    counts = sharding.scatter(_dispatch_shard, datetime.utcnow())
+    if REMINDER_BATCH in counts.values():
+        dispatch_due.delay()  # more is due; don't wait for the next tick
+    return sum(counts.values())
+
+
+def _dispatch_shard(now):
+    due = (
+        Reminder.query
+        .filter(Reminder.status == 'pending', Reminder.fire_at <= now)
+        .order_by(Reminder.fire_at, Reminder.id)
+        .limit(REMINDER_BATCH)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not due:
+        return 0
+
+    # Bookings live on the shard, services and users on the primary: no join across the two
+    bookings = {row.id: row for row in db.session.execute(
+        select(Booking.id, Booking.user_id, Booking.service_id, Booking.recurrence, Booking.status)
+        .where(Booking.id.in_({r.booking_id for r in due}))
+    )}
+    services = dict(db.session.execute(
+        select(Service.id, Service.name).where(Service.id.in_({b.service_id for b in bookings.values()}))
+    ).all())
+    users = {row.id: row for row in db.session.execute(
+        select(User.id, User.email, User.username).where(User.id.in_({b.user_id for b in bookings.values()}))
+    )}
+    with_devices = set(db.session.execute(
+        select(DeviceToken.user_id).where(DeviceToken.user_id.in_({r.user_id for r in due})).distinct()
+    ).scalars())
+
+    pushes = []
+    for reminder in due:
+        observe('reminder_lag_seconds', (now - reminder.fire_at).total_seconds())
+        booking = bookings.get(reminder.booking_id)
+        user = users.get(booking.user_id) if booking else None
+        if booking is None or user is None or booking.status in INACTIVE_STATUSES:
+            reminder.status = 'cancelled'
+            inc('reminders_cancelled_total')
+            continue
+
+        if reminder.occurs_at <= now:
+            # The dispatcher was down past the appointment itself
+            reminder.status = 'expired'
+            inc('reminders_expired_total', kind=reminder.kind)
+        else:
+            service = services.get(booking.service_id)
+            title, body, when = _message(reminder, service)
+            if reminder.user_id in with_devices:
+                reminder.channel = 'push'
+                pushes.append((reminder.user_id, title, body,
+                               {'type': 'reminder', 'booking_id': str(booking.id)}))
+            else:
+                reminder.channel = 'email'
+                mailer.send('appointment_reminder', user.email, name=user.username,
+                            service=service, date=f"{when:%d %B %Y}", time=f"{when:%H:%M}")
+            reminder.status = 'sent'
+            reminder.sent_at = now
+            inc('reminders_sent_total', kind=reminder.kind, channel=reminder.channel)
+
+        step = RECURRENCE_STEPS.get(booking.recurrence)
+        if step and reminder.kind == LAST_KIND:
+            _schedule(db.session.connection(bind_arguments={'mapper': Reminder}), booking.id, booking.user_id,
+                      reminder.occurs_at + step, booking.recurrence, now)
+    db.session.commit()
+
+    for user_id, title, body, data in pushes:
+        send_to_user.delay(user_id, title, body, data)
+    return len(due)
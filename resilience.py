@@ -0,0 +1,232 @@
+# resilience.py
+"""
+Timeouts, circuit breakers and bulkheads for outbound calls.
+
+Each upstream (Stripe, Firebase Cloud Messaging, Sentry) is a Dependency.
+A call goes through it with e.g. stripe_api.call(stripe.Charge.create, ...):
+
+- Timeout: each client is configured with the dependency's timeout
+  (configure_stripe(), init_firebase(), SentryTransport), so a hung
+  upstream fails the call instead of pinning the worker.
+- Bulkhead: at most max_concurrent calls are in flight per process. Past
+  that, calls are rejected at once instead of queueing behind a slow
+  upstream.
+- Circuit breaker: after failure_threshold failures in a row, calls are
+  rejected without touching the network for reset_timeout seconds. Then
+  one trial call is let through (half-open). If it succeeds the circuit
+  closes, otherwise it opens again. Only connection errors, timeouts and
+  5xx/429 responses count as failures. A declined card is an answer.
+
+A rejected call raises Unavailable. It is a jobs.Defer, so a task that
+hits it runs again once the circuit may have closed, without using up a
+retry. Request handlers return 503 instead, and Sentry drops the event.
+
+State is per process, like the clients themselves: every worker finds
+out on its own that an upstream is down, after failure_threshold calls.
+"""
+import logging
+import os
+import threading
+import time
+
+import urllib3
+from firebase_admin import exceptions as firebase_exceptions
+from sentry_sdk.transport import HttpTransport
+
+from config import stripe
+from jobs import Defer
+from metrics import inc, observe, register_collector
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # circuit_breaker_state gauge
+BULKHEAD_RETRY = 1  # seconds before a job turned away by a full bulkhead runs again
+
+# name -> Dependency
+DEPENDENCIES = {}
+
+
+class Unavailable(Defer):
+    """The call was not made; try again in `retry_after` seconds."""
+
+    def __init__(self, dependency, message, retry_after):
+        super().__init__(f"{dependency}: {message}", countdown=retry_after)
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Unavailable):
+    pass
+
+
+class BulkheadFullError(Unavailable):
+    pass
+
+
+#--------------------- Circuit breaker
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False  # a half-open trial call is in flight
+        self._lock = threading.Lock()
+
+    def _set(self, state):
+        if state != self.state:
+            logger.warning(f"Circuit {self.name}: {self.state} -> {state}")
+            inc('circuit_breaker_transitions_total', dependency=self.name, state=state)
+            self.state = state
+
+    def allow(self):
+        """True if a call may go out now; in half-open state only one (the trial) may."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    return False
+                self._trial = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self._set(CLOSED)
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set(OPEN)
+
+    def retry_after(self):
+        """Seconds until the next trial call is allowed (at least 1)."""
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        return max(int(remaining + 0.999), 1)
+
+
+#--------------------- Dependencies
+class Dependency:
+    """One upstream: its client timeout, a bulkhead and a circuit breaker."""
+
+    def __init__(self, name, timeout, max_concurrent, failures, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.failures = failures  # exception types that count against the circuit
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.in_flight = 0
+        self._bulkhead = threading.BoundedSemaphore(max_concurrent)
+        self._count_lock = threading.Lock()
+        DEPENDENCIES[name] = self
+
+    def _enter(self):
+        if not self._bulkhead.acquire(blocking=False):
+            inc('upstream_calls_total', dependency=self.name, result='bulkhead_full')
+            raise BulkheadFullError(self.name, f"{self.max_concurrent} calls already in flight", BULKHEAD_RETRY)
+        if not self.breaker.allow():
+            self._bulkhead.release()
+            inc('upstream_calls_total', dependency=self.name, result='circuit_open')
+            raise CircuitOpenError(self.name, "circuit open", self.breaker.retry_after())
+        with self._count_lock:
+            self.in_flight += 1
+
+    def _exit(self):
+        with self._count_lock:
+            self.in_flight -= 1
+        self._bulkhead.release()
+
+    def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) through the bulkhead and breaker; raises Unavailable if it was not called."""
+        self._enter()
+        started = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except self.failures:
+            self.breaker.failed()
+            inc('upstream_calls_total', dependency=self.name, result='failure')
+            raise
+        except Exception:
+            # The upstream answered (a declined card, a bad token); it is up
+            self.breaker.succeeded()
+            inc('upstream_calls_total', dependency=self.name, result='error')
+            raise
+        else:
+            self.breaker.succeeded()
+            inc('upstream_calls_total', dependency=self.name, result='ok')
+            return result
+        finally:
+            observe('upstream_call_seconds', time.perf_counter() - started, dependency=self.name)
+            self._exit()
+
+
+def _env(name, default, cast=float):
+    return cast(os.getenv(name, default))
+
+
+stripe_api = Dependency(
+    'stripe',
+    timeout=_env('STRIPE_TIMEOUT', 10),
+    max_concurrent=_env('STRIPE_MAX_CONCURRENT', 10, int),
+    failures=(stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError),
+)
+
+firebase = Dependency(
+    'firebase',
+    timeout=_env('FCM_TIMEOUT', 10),
+    max_concurrent=_env('FCM_MAX_CONCURRENT', 10, int),
+    failures=(firebase_exceptions.UnavailableError, firebase_exceptions.DeadlineExceededError,
+              firebase_exceptions.InternalError, firebase_exceptions.UnknownError, OSError),
+)
+
+sentry = Dependency(
+    'sentry',
+    timeout=_env('SENTRY_TIMEOUT', 3),
+    max_concurrent=_env('SENTRY_MAX_CONCURRENT', 2, int),
+    failures=(urllib3.exceptions.HTTPError, OSError),
+    reset_timeout=60,
+)
+
+
+#--------------------- Client setup
+def configure_stripe():
+    """A fresh Stripe HTTP client (and session) with the dependency's timeout; forked workers call this too."""
+    stripe.default_http_client = stripe.RequestsClient(timeout=stripe_api.timeout)
+
+
+configure_stripe()
+
+
+class SentryTransport(HttpTransport):
+    """Sentry's HTTP transport with socket timeouts; envelopes are dropped while the circuit is open."""
+
+    def _get_pool_options(self):
+        options = super()._get_pool_options()
+        options['timeout'] = urllib3.Timeout(connect=sentry.timeout, read=sentry.timeout)
+        return options
+
+    def _send_request(self, *args, **kwargs):
+        try:
+            return sentry.call(super()._send_request, *args, **kwargs)
+        except Unavailable:
+            self.record_lost_event('network_error', data_category='error')
+
+
+@register_collector
+def _collect_dependency_metrics():
+    for name, dependency in sorted(DEPENDENCIES.items()):
+        labels = {'dependency': name}
+        yield 'circuit_breaker_state', labels, STATE_VALUES[dependency.breaker.state]
+        yield 'circuit_breaker_consecutive_failures', labels, dependency.breaker.failures
+        yield 'bulkhead_in_flight', labels, dependency.in_flight
+        yield 'bulkhead_capacity', labels, dependency.max_concurrent
@@ -4,27 +4,54 @@ from models import Admin, Service, Category, Transaction, Review, User, Company,
 from config import stripe
 from auth import hash_password, verify_password, create_jwt_token, role_required
 from firebase_setup import broadcast_to_topic
+from images import save_upload, ImageUploadError
+from ratelimit import rate_limit, by_ip, by_user, by_form_field
+from recommendations import top_services, also_booked
+import triage
+import ledger
+import wallet
+import facets
+import categories
+import reads
+import devices
+import mailer
+import reminders  # noqa: F401  (its listeners schedule reminders for new bookings)
+import resilience
+import sharding
+from serializers import category_serializer, review_serializer
+from sessions import login as login_principal, logout as logout_principal, revoke_sessions, current_principal, snapshot
 from flask import Blueprint
+from tasks import charge_transaction
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+from datetime import datetime
 import logging
+import queue
+from sqlalchemy import func, select
 
 routes = Blueprint("routes", __name__)
 
+# ✅ Log records are queued in-process and written to disk by a listener thread,
+# so requests never block on the log file
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.FileHandler("app.log"), logging.StreamHandler())
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 @routes.route('/')
 def home():
-    return render_template('home.html')
+    return render_template('home.html', popular=top_services('popular', n=6),
+                           trending=top_services('trending', n=6))
 
 #--------------------- Register endpoint
 @routes.route('/register', methods=['GET', 'POST'])
+@rate_limit(5, 600, key=by_ip)
 def register():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -90,34 +117,67 @@ def register():
 
 #     return render_template('provider/templates/login.html')
 
-@routes.route('/profile', methods=['GET'])
-def profile():
-    user_id = session.get('user_id')
+@routes.route('/login', methods=['GET', 'POST'])
+@rate_limit(20, 60, key=by_ip)
+@rate_limit(5, 300, key=by_form_field('email'))
+def login():
+    if request.method == 'POST':
+        email = request.form.get('email')
+        password = request.form.get('password')
 
-    if not user_id:
-        flash("Please login to view your profile.", "warning")
+        if not email or not password:
+            flash("Email and password are required.", "danger")
+            return redirect(url_for('routes.login'))
+
+        user = User.query.filter_by(email=email).first()
+        if user and verify_password(password, user.password_hash):
+            login_principal(user, 'user')
+            flash(f"Welcome back, {user.username}!", "success")
+            return redirect(url_for('routes.home'))
+
+        flash("Invalid email or password.", "danger")
         return redirect(url_for('routes.login'))
 
-    user = User.query.get(user_id)
-    if not user:
-        flash("User not found.", "danger")
+    return render_template('user/user_login.html')
+
+
+@routes.route('/logout', methods=['GET', 'POST'])
+def logout():
+    logout_principal()
+    flash("Logged out successfully.", "success")
+    return redirect(url_for('routes.home'))
+
+def _profile_principal():
+    """The signed-in user's principal snapshot, or None; sessions from before it carried contact fields get them once."""
+    principal = current_principal()
+    if not session.get('user_id') or not principal or principal.get('kind') != 'user':
+        return None
+    if 'email' not in principal:
+        user = db.session.get(User, principal['id'])
+        if not user:
+            return None
+        principal = session['principal'] = dict(principal, **snapshot(user))
+    return principal
+
+
+@routes.route('/profile', methods=['GET'])
+def profile():
+    # Rendered from the session's principal snapshot: no users query
+    principal = _profile_principal()
+    if not principal:
+        flash("Please login to view your profile.", "warning")
         return redirect(url_for('routes.login'))
 
-    return render_template('user/profile.html', current_user=user)
+    return render_template('user/profile.html', current_user=principal)
 
 
 @routes.route('/profile/edit', methods=['GET', 'POST'])
 def edit_profile():
-    user_id = session.get('user_id')
-    if not user_id:
+    principal = _profile_principal()
+    if not principal:
         flash("You must be logged in to edit your profile.", "warning")
         return redirect(url_for('routes.login'))
 
-    user = User.query.get(user_id)
-    if not user:
-        flash("User not found.", "danger")
-        return redirect(url_for('routes.login'))
-
     if request.method == 'POST':
         # Get updated form data
         email = request.form.get('email')
@@ -126,47 +186,62 @@ def edit_profile():
         # Basic validation
         if not email or not phone_number:
             flash("All fields are required.", "danger")
-            return redirect(url_for('edit_profile'))
+            return redirect(url_for('routes.edit_profile'))
 
-        # Update and commit
+        # Update and commit (the bus refreshes the user's other sessions)
+        user = db.session.get(User, principal['id'])
+        if not user:
+            flash("User not found.", "danger")
+            return redirect(url_for('routes.login'))
         user.email = email
         user.phone_number = phone_number
         db.session.commit()
+        session['principal'] = dict(principal, **snapshot(user))
 
         flash("Profile updated successfully!", "success")
         return redirect(url_for('routes.profile'))
 
     # GET request
-    return render_template('user/edit_profile.html', current_user=user)
+    return render_template('user/edit_profile.html', current_user=principal)
 
 @routes.route('/categories')
 def show_categories():
-    categories = Category.query.all()
-    return render_template('user/categories.html', categories=categories)
+    _, _, tree = categories.category_tree()
+    return render_template('user/categories.html', categories=tree['categories'])
 
 @routes.route('/categories/<int:category_id>/services')
 def services_by_category(category_id):
     category = Category.query.get_or_404(category_id)
-    services = Service.query.filter_by(category_id=category_id).all()
-    return render_template('user/services_by_category.html', services=services, category=category)
+    filters = facets.parse_filters(request.args)
+    filters['category'] = categories.subtree_ids(category)  # a parent lists its subcategories' services too
+    results = facets.search(filters, page=request.args.get('page', 1, type=int))
+    nav = facets.navigation(request.args, results, 'routes.services_by_category',
+                            skip=('category',), category_id=category_id)
+    return render_template('user/services_by_category.html', services=results['services'], category=category,
+                           results=results, nav=nav)
 
 
-# Service Search Route
+# Service Search Route (name substring plus facet filters)
 @routes.route('/search', methods=['GET'])
 def search():
-    query = request.args.get('query', '')
-    services = Service.query.filter(Service.name.contains(query)).all()
-    return render_template('user/search.html', services=services)
+    query = request.args.get('query', '').strip()
+    results = facets.search(facets.parse_filters(request.args), text=query or None,
+                            page=request.args.get('page', 1, type=int))
+    nav = facets.navigation(request.args, results, 'routes.search')
+    return render_template('user/search.html', services=results['services'], results=results, nav=nav)
 
 # Service Detail Route
 @routes.route('/service/<int:service_id>', methods=['GET'])
 def service_detail(service_id):
     service = Service.query.get_or_404(service_id)
     reviews = Review.query.filter_by(service_id=service_id).all()
-    return render_template('user/service_detail.html', service=service, reviews=reviews)
+    return render_template('user/service_detail.html', service=service, reviews=reviews,
+                           also_booked=also_booked(service_id))
 
 #--------------------- Admin endpoints
 @routes.route('/admin/login', methods=['GET', 'POST'])
+@rate_limit(20, 60, key=by_ip)
+@rate_limit(5, 300, key=by_form_field('username'))
 def admin_login():
     if request.method == 'POST':
         username = request.form.get('username') 
@@ -178,8 +253,7 @@ def admin_login():
 
         admin = Admin.query.filter_by(username=username).first()
         if admin and verify_password(password, admin.password_hash):
-            session['admin_id'] = admin.id
-            session['admin_name'] = admin.username
+            login_principal(admin, 'admin')
             flash(f"Welcome back, {admin.username}!", "success")
             return redirect(url_for('routes.admin_dashboard'))  
 
@@ -190,6 +264,7 @@ def admin_login():
 
 
 @routes.route('/admin/create', methods=['GET', 'POST'])
+@rate_limit(5, 600, key=by_ip)
 def create_admin():
     if request.method == 'POST':
         adminname = request.form.get('adminname')
@@ -330,6 +405,7 @@ def list_services():
 
 
 @routes.route('/book/<int:service_id>', methods=['GET', 'POST'])
+@rate_limit(10, 60, key=by_user)
 def booking(service_id):
     service = Service.query.get_or_404(service_id)
 
@@ -351,15 +427,20 @@ def booking(service_id):
             flash("Invalid date or time format.", "danger")
             return redirect(request.url)
 
-        new_booking = Booking(
-            user_id=user_id,
-            service_id=service_id,
-            date=date,
-            time=time,
-            recurrence='weekly' if recurring else None
-        )
-        db.session.add(new_booking)
-        db.session.commit()
+        user = db.session.get(User, user_id)
+        with sharding.use_company(service.company_id):
+            new_booking = Booking(
+                user_id=user_id,
+                service_id=service_id,
+                date=date,
+                time=time,
+                recurrence='weekly' if recurring else None
+            )
+            db.session.add(new_booking)
+            if user:
+                mailer.send('booking_confirmation', user.email, name=user.username, service=service.name,
+                            date=date.strftime('%d %B %Y'), time=time.strftime('%H:%M'))
+            db.session.commit()
         flash("Your booking has been confirmed!", "success")
         return redirect(url_for('routes.service_detail', service_id=service.id))
 
@@ -368,16 +449,10 @@ def booking(service_id):
 # Get a single service by ID
 @routes.route('/services/<int:service_id>', methods=['GET'])
 def get_service(service_id):
-    service = db.session.query(Service).filter_by(id=service_id).first()
+    service = reads.service_summary(service_id)
     if not service:
         return jsonify({"message": "Service not found"}), 404
-    return jsonify({
-        "id": service.id,
-        "name": service.name,
-        "price": service.price,
-        "category": service.category,
-        "description": service.description
-    }), 200
+    return jsonify(service._asdict()), 200
 
 # Update a service
 @routes.route('/services/<int:service_id>', methods=['PUT'])
@@ -404,16 +479,42 @@ def delete_service(service_id):
     db.session.commit()
     return jsonify({"message": "Service deleted successfully"}), 200
 
+# Upload or replace a service image (Admins, or the provider that owns the service)
+@routes.route('/services/<int:service_id>/image', methods=['POST'])
+@rate_limit(10, 60, key=by_user)
+def upload_service_image(service_id):
+    if not session.get('admin_id') and not session.get('company_id'):
+        return jsonify({"message": "Login required"}), 401
+    service = db.session.query(Service).filter_by(id=service_id).first()
+    if not service:
+        return jsonify({"message": "Service not found"}), 404
+    if not session.get('admin_id') and session['company_id'] != service.company_id:
+        return jsonify({"message": "You can only change your own services"}), 403
+
+    image = request.files.get('image')
+    if not image or not image.filename:
+        return jsonify({"message": "Image file is required"}), 400
+
+    try:
+        service.image_url = save_upload(image)
+    except ImageUploadError as e:
+        return jsonify({"message": str(e)}), 400
+    db.session.commit()
+    return jsonify({"message": "Image uploaded successfully", "image_url": service.image_url}), 200
+
 #--------------------- Category endpoints
 @routes.route('/categories', methods=['POST'])
  # Only Admins 
 def create_category():
     data = request.get_json()
     name = data.get('name')
+    parent_id = data.get('parent_id')
     if not name:
         return jsonify({"message": "Category name is required"}), 400
+    if parent_id is not None and not db.session.get(Category, parent_id):
+        return jsonify({"message": "Parent category not found"}), 404
 
-    new_category = Category(name=name)
+    new_category = Category(name=name, parent_id=parent_id)
     db.session.add(new_category)
     db.session.commit()
     return jsonify({"message": "Category created successfully", "category_id": new_category.id}), 201
@@ -421,9 +522,7 @@ def create_category():
 # List all categories
 @routes.route('/categories', methods=['GET'])
 def list_categories():
-    categories = db.session.query(Category).all()
-    category_list = [{"id": category.id, "name": category.name} for category in categories]
-    return jsonify(category_list), 200
+    return jsonify(category_serializer.dump_many(reads.categories())), 200
 
 # Delete a category (Admin only)
 @routes.route('/categories/<int:category_id>', methods=['DELETE'])
@@ -432,12 +531,18 @@ def delete_category(category_id):
     category = db.session.query(Category).get(category_id)
     if not category:
         return jsonify({"message": "Category not found"}), 404
-    db.session.delete(category)
-    db.session.commit()
+    try:
+        db.session.delete(category)
+        db.session.commit()
+    except categories.CategoryTreeError as e:
+        db.session.rollback()
+        return jsonify({"message": str(e)}), 409
     return jsonify({"message": "Category deleted successfully"}), 200
 
 #--------------------- Payment endpoint
 @routes.route('/payment', methods=['POST'])
+@rate_limit(10, 60, key=by_ip)
+@rate_limit(5, 60, key=by_user)
 def process_payment():
     try:
         # Get payment details from the request body
@@ -445,79 +550,187 @@ def process_payment():
         amount = data.get('amount')
         currency = data.get('currency', 'usd')
         token = data.get('token')
-        Admin_id = data.get('Admin_id')
         service_id = data.get('service_id')
+        booking_id = data.get('booking_id')
 
-        if not amount or not token or not Admin_id or not service_id:
-            return jsonify({'error': 'Missing required fields'}), 400
+        # Payments are always made by (and recorded against) the signed-in user
+        user_id = session.get('user_id')
+        if not user_id:
+            return jsonify({'error': 'Login required'}), 401
 
-        # Create a charge using Stripe's API
-        charge = stripe.Charge.create(
-            amount=amount,
-            currency=currency,
-            source=token,
-            description='Payment for service'
-        )
+        if not amount or not service_id or not booking_id:
+            return jsonify({'error': 'Missing required fields'}), 400
 
-        # Log the transaction in the database
-        transaction = Transaction(
-            Admin_id=Admin_id,
-            service_id=service_id,
-            amount=amount,
-            currency=currency,
-            status='success'
-        )
-        db.session.add(transaction)
-        db.session.commit()
+        if token:
+            charge = {'token': token}
+        else:
+            # One-click checkout with a saved card from the user's own wallet
+            try:
+                method = wallet.method_for_checkout(user_id, data.get('payment_method_id'))
+            except wallet.WalletError as e:
+                return jsonify({'error': str(e)}), 400
+            charge = {'payment_method': method['payment_method'], 'customer': method['customer']}
+
+        service = db.session.get(Service, service_id)
+        if not service:
+            return jsonify({'error': 'Service not found'}), 404
+
+        # Record the transaction as pending (on the company's shard); the charge runs in the payments worker
+        with sharding.use_company(service.company_id):
+            transaction = Transaction(
+                user_id=user_id,
+                service_id=service_id,
+                booking_id=booking_id,
+                amount=amount,
+                currency=currency,
+                status='pending'
+            )
+            db.session.add(transaction)
+            db.session.commit()
+            # The commit expired it: read it back from its shard, not the primary
+            transaction_id, status = transaction.id, transaction.status
+        charge_transaction.delay(transaction_id, **charge)
 
-        # Return success response
         return jsonify({
-            'message': 'Payment successful',
-            'charge_id': charge.id,
-            'transaction_id': transaction.id
-        }), 200
-    except stripe.error.CardError as e:
-        # Handle card errors (e.g., insufficient funds)
-        return jsonify({'error': str(e)}), 400
+            'message': 'Payment is being processed',
+            'transaction_id': transaction_id,
+            'status': status
+        }), 202
     except Exception as e:
         # Log the full error for debugging
-        routes.logger.error(f"An error occurred: {str(e)}")
+        logger.error(f"An error occurred: {str(e)}")
         return jsonify({'error': 'An error occurred while processing the payment'}), 500
 
+# Poll the status of a payment started with /payment
+@routes.route('/payment/<int:transaction_id>', methods=['GET'])
+def payment_status(transaction_id):
+    try:
+        with sharding.use_shard_of(transaction_id):
+            transaction = db.session.get(Transaction, transaction_id)
+    except sharding.ShardingError:
+        transaction = None
+    if not transaction or str(transaction.user_id) != str(session.get('user_id')):
+        return jsonify({'error': 'Transaction not found'}), 404
+    return jsonify({
+        'transaction_id': transaction.id,
+        'status': transaction.status,
+        'charge_id': transaction.charge_id
+    }), 200
+
+#--------------------- Wallet endpoints
+@routes.route('/wallet', methods=['GET'])
+def list_payment_methods():
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"message": "Login required"}), 401
+    return jsonify(wallet.payment_method_serializer.dump_many(wallet.methods_for(user_id)))
+
+
+@routes.route('/wallet', methods=['POST'])
+@rate_limit(10, 60, key=by_user)
+def add_payment_method():
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"message": "Login required"}), 401
+    data = request.get_json(silent=True) or {}
+    payment_method_id = data.get('payment_method_id')
+    if not payment_method_id or not str(payment_method_id).startswith('pm_'):
+        return jsonify({"message": "A Stripe payment_method_id (pm_...) is required"}), 400
+    try:
+        method = wallet.add_method(db.session.get(User, user_id), payment_method_id, bool(data.get('default')))
+    except wallet.WalletError as e:
+        return jsonify({"message": str(e)}), 400
+    except resilience.Unavailable as e:
+        return _payments_unavailable(e)
+    return jsonify(wallet.payment_method_serializer.dump(method)), 201
+
+
+def _payments_unavailable(error):
+    # Stripe is down or saturated; the card can be saved again in a moment
+    return jsonify({"message": "Payments are temporarily unavailable, please try again shortly"}), 503, \
+        {'Retry-After': str(error.retry_after)}
+
+
+@routes.route('/wallet/<int:method_id>/default', methods=['POST'])
+def set_default_payment_method(method_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"message": "Login required"}), 401
+    try:
+        method = wallet.set_default(user_id, method_id)
+    except wallet.WalletError as e:
+        return jsonify({"message": str(e)}), 404
+    return jsonify(wallet.payment_method_serializer.dump(method)), 200
+
+
+@routes.route('/wallet/<int:method_id>', methods=['DELETE'])
+def remove_payment_method(method_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({"message": "Login required"}), 401
+    try:
+        wallet.remove_method(user_id, method_id)
+    except wallet.WalletError as e:
+        return jsonify({"message": str(e)}), 404
+    except resilience.Unavailable as e:
+        return _payments_unavailable(e)
+    return jsonify({"message": "Payment method removed"}), 200
+
+
+# Payouts per company for a period, read from the daily revenue rollups
+@routes.route('/admin/reports/payouts', methods=['GET'])
+def payout_report():
+    if not session.get('admin_id'):
+        return jsonify({"message": "Admin login required"}), 401
+    try:
+        date_to = datetime.utcnow().date()
+        if request.args.get('date_to'):
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date()
+        date_from = date_to.replace(day=1)
+        if request.args.get('date_from'):
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({"message": "Dates must be YYYY-MM-DD"}), 400
+
+    company_id = request.args.get('company_id', type=int)
+    return jsonify({
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "payouts": ledger.payout_report(date_from, date_to, company_id),
+        "daily": ledger.revenue_by_day(date_from, date_to, company_id) if company_id else None,
+    }), 200
+
 #--------------------- Review endpoints
+REVIEWS_PAGE_SIZE = 50
+MAX_REVIEWS_PAGE_SIZE = 200
+
+# List reviews (Admin only), a page at a time: ?after=<last review id>&limit=
 @routes.route('/reviews', methods=['GET'])
- # Only admins 
 def get_reviews():
-    reviews = db.session.query(Review).all()
-    review_list = [
-        {
-            "id": review.id,
-            "Admin_id": review.Admin_id,
-            "service_id": review.service_id,
-            "content": review.content,
-            "status": review.status
-        }
-        for review in reviews
-    ]
-    return jsonify(review_list), 200
+    if not session.get('admin_id'):
+        return jsonify({"message": "Admin login required"}), 401
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', REVIEWS_PAGE_SIZE, type=int), 1), MAX_REVIEWS_PAGE_SIZE)
+    rows = reads.reviews(after, limit + 1)
+    page = rows[:limit]
+    return jsonify({
+        "reviews": review_serializer.dump_many(page),
+        "next_after": page[-1].id if len(rows) > limit else None,
+    }), 200
 
 # Get a single review by ID (Admin only)
 @routes.route('/reviews/<int:review_id>', methods=['GET'])
- # Only admins 
 def get_review(review_id):
-    review = db.session.query(Review).get(review_id)
+    if not session.get('admin_id'):
+        return jsonify({"message": "Admin login required"}), 401
+    review = reads.review(review_id)
     if not review:
         return jsonify({"message": "Review not found"}), 404
-    return jsonify({
-        "id": review.id,
-        "Admin_id": review.Admin_id,
-        "service_id": review.service_id,
-        "content": review.content,
-        "status": review.status
-    }), 200
+    return jsonify(review_serializer.dump(review)), 200
 
 # Create a new review
 @routes.route('/reviews', methods=['POST'])
+@rate_limit(10, 60, key=by_ip)
 def create_review():
     data = request.get_json()
     Admin_id = data.get('Admin_id')
@@ -575,7 +788,30 @@ def delete_review(review_id):
 @routes.route('/admin/dashboard', methods=['GET'])
  # Only Admins and Super Admins 
 def admin_dashboard():
-    return render_template('admin/admin_dashboard.html', logout_url=url_for('routes.admin_logout'))
+    return render_template('admin/admin_dashboard.html', logout_url=url_for('routes.admin_logout'),
+                           stats=_activity_stats())
+
+
+@routes.route('/admin/reports/activity', methods=['GET'])
+def activity_report():
+    if not session.get('admin_id'):
+        return jsonify({"message": "Admin login required"}), 401
+    return jsonify(_activity_stats()), 200
+
+
+def _activity_stats():
+    """Booking and transaction totals, summed over every shard."""
+    by_status = {}
+    for rows in sharding.scatter(lambda: db.session.execute(
+        select(Transaction.status, func.count(Transaction.id)).group_by(Transaction.status)
+    ).all()).values():
+        for status, total in rows:
+            by_status[status] = by_status.get(status, 0) + total
+    return {
+        'bookings': sharding.count(select(func.count(Booking.id))),
+        'transactions': by_status,
+        'shards': len(sharding.shard_names()),
+    }
 
 
 # Task 1: Show HTML Admin Login Page (GET request)
@@ -611,9 +847,9 @@ def admin_dashboard():
 @routes.route('/admin/logout', methods=['GET', 'POST'])
 def admin_logout():
     if request.method == 'POST' or request.method == 'GET':
-        response = make_response(redirect(url_for('admin_login_page')))
+        response = make_response(redirect(url_for('routes.admin_login')))
         response.delete_cookie('admin_token')  # Clear token
-        session.clear()  # Clear session
+        logout_principal()  # Clear session and rotate its id
         flash('Logged out successfully', 'success')
         return response
     
@@ -636,14 +872,80 @@ def admin_logout():
 #     return render_template('admin_reviews.html', reviews=reviews)
 
 
+#--------------------- Triage endpoints
+def _triage_item(item):
+    return {
+        "id": item.id,
+        "status": item.status,
+        "priority": item.priority,
+        "assignee_id": item.assignee_id,
+        "claimed_at": item.claimed_at.isoformat() if item.claimed_at else None,
+        "sla_due_at": item.sla_due_at.isoformat() if item.sla_due_at else None,
+        "sla_breached": item.sla_breached,
+        "text": getattr(item, 'message', None) or getattr(item, 'description', None),
+    }
+
+
+@routes.route('/admin/triage/<queue_name>/claim', methods=['POST'])
+def triage_claim(queue_name):
+    admin_id = session.get('admin_id')
+    if not admin_id:
+        return jsonify({"message": "Admin login required"}), 401
+    try:
+        item = triage.claim_next(queue_name, admin_id, priority=request.args.get('priority', type=int))
+    except triage.TriageError as e:
+        return jsonify({"message": str(e)}), 404
+    if item is None:
+        return '', 204
+    return jsonify(_triage_item(item)), 200
+
+
+@routes.route('/admin/triage/<queue_name>/<int:item_id>/<action>', methods=['POST'])
+def triage_update(queue_name, item_id, action):
+    admin_id = session.get('admin_id')
+    if not admin_id:
+        return jsonify({"message": "Admin login required"}), 401
+    if action not in ('resolve', 'release'):
+        return jsonify({"message": "Unknown action"}), 404
+    try:
+        item = getattr(triage, action)(queue_name, item_id, admin_id)
+    except triage.TriageError as e:
+        return jsonify({"message": str(e)}), 409
+    return jsonify(_triage_item(item)), 200
+
+
+@routes.route('/admin/triage/counters', methods=['GET'])
+def triage_counters():
+    if not session.get('admin_id'):
+        return jsonify({"message": "Admin login required"}), 401
+    return jsonify(triage.counters()), 200
+
+
+# Sign a user out of every device
+@routes.route('/admin/users/<int:user_id>/sessions/revoke', methods=['POST'])
+def revoke_user_sessions(user_id):
+    if not session.get('admin_id'):
+        return jsonify({"message": "Admin login required"}), 401
+    revoked = revoke_sessions('user', user_id)
+    logger.info(f"Admin {session['admin_id']} revoked {revoked} sessions of user {user_id}")
+    return jsonify({"message": "Sessions revoked", "revoked": revoked}), 200
+
+
 #----------Broadcast Notification
 @routes.route('/admin/broadcast', methods=['POST'])
 def broadcast_notification():
     title = request.form.get('title')
     body = request.form.get('body')
-    broadcast_to_topic(title, body)
-    flash('Announcement sent to all Admins!', 'success')
-    return redirect(url_for('admin_dashboard'))
+    # Optional segment: users who booked in a category and/or live in a city
+    category_id = request.form.get('category_id', type=int)
+    city = request.form.get('city') or None
+    if category_id or city:
+        devices.broadcast_to_segment.delay(title, body, category_id, city)
+        flash('Announcement sent to the selected segment!', 'success')
+    else:
+        broadcast_to_topic.delay(title, body)
+        flash('Announcement sent to all Admins!', 'success')
+    return redirect(url_for('routes.admin_dashboard'))
 
 #--------------------- Provider endpoints
     return render_template('provider/login.html')
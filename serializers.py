@@ -0,0 +1,94 @@
+# serializers.py
+import json
+from datetime import date, datetime, time
+from operator import attrgetter
+
+from flask import Response
+
+# ✅ Use orjson when it is installed, fall back to the standard library otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(payload):
+    """Serializes a payload to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+class FieldError(ValueError):
+    """Raised when a sparse fieldset asks for a field the serializer does not expose."""
+
+
+class Serializer:
+    """
+    Declarative serializer for a model.
+
+    Attribute getters are compiled once per distinct fieldset and reused, so
+    serializing a row is a single attrgetter call plus a zip.
+    """
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self._compiled = {}
+
+    def _compile(self, names):
+        compiled = self._compiled.get(names)
+        if compiled is None:
+            getter = attrgetter(*names)
+            if len(names) == 1:
+                compiled = lambda obj: {names[0]: getter(obj)}
+            else:
+                compiled = lambda obj: dict(zip(names, getter(obj)))
+            self._compiled[names] = compiled
+        return compiled
+
+    def parse_fields(self, fields_param):
+        """
+        Turns a '?fields=id,name' value into a validated tuple of field names.
+
+        The tuple is canonical (no duplicates, in declaration order), so
+        '?fields=name,id,id' reuses the getter compiled for 'id,name'.
+        """
+        if not fields_param:
+            return self.fields
+        if not isinstance(fields_param, str):
+            raise FieldError("fields must be a comma-separated string")
+        requested = {f.strip() for f in fields_param.split(',') if f.strip()}
+        unknown = sorted(requested.difference(self.fields))
+        if unknown or not requested:
+            raise FieldError(f"Unknown fields: {', '.join(unknown) or fields_param}")
+        return tuple(f for f in self.fields if f in requested)
+
+    def dump(self, obj, fields=None):
+        return self._compile(fields or self.fields)(obj)
+
+    def dump_many(self, objs, fields=None):
+        compiled = self._compile(fields or self.fields)
+        return [compiled(obj) for obj in objs]
+
+
+category_serializer = Serializer('id', 'name', 'parent_id', 'total_services')
+
+service_serializer = Serializer(
+    'id', 'name', 'price', 'category_id', 'company_id', 'description', 'location', 'image_url'
+)
+
+review_serializer = Serializer(
+    'id', 'user_id', 'service_id', 'content', 'rating', 'status', 'created_at'
+)
+
+company_serializer = Serializer('id', 'name', 'email', 'phone', 'location', 'logo')
@@ -0,0 +1,110 @@
+# serving.py
+"""
+Health checks and per-process setup for running under gunicorn.
+
+gunicorn.conf.py preloads the app in the master and forks workers from it.
+Anything holding a socket or a thread at import time - the SQLAlchemy pool,
+the Redis pool, the log listener, the SDK clients - is shared by that fork,
+so init_worker() rebuilds it in each worker before it serves a request.
+"""
+import atexit
+import logging
+import sys
+import time
+from logging.handlers import QueueListener
+
+from flask import Blueprint, current_app, jsonify
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+health = Blueprint("health", __name__)
+
+
+#--------------------- Health checks
+def check_database():
+    engine = current_app.extensions['sqlalchemy'].engine
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+
+
+def check_redis():
+    from application import redis_client
+    redis_client.ping()
+
+
+READINESS_CHECKS = {
+    'database': check_database,
+    'redis': check_redis,
+}
+
+
+@health.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving; no dependencies touched."""
+    return jsonify({"status": "ok"})
+
+
+@health.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 503 until the database and Redis both answer, so the balancer skips this instance."""
+    checks = {}
+    ready = True
+    for name, check in READINESS_CHECKS.items():
+        started = time.perf_counter()
+        try:
+            check()
+            checks[name] = {"ok": True}
+        except Exception as e:
+            logger.warning(f"Readiness check {name} failed: {e}")
+            checks[name] = {"ok": False, "error": str(e)}
+            ready = False
+        checks[name]["ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    return jsonify({"status": "ok" if ready else "unavailable", "checks": checks}), 200 if ready else 503
+
+
+#--------------------- After fork
+def init_worker(app):
+    """
+    Gives a freshly forked worker its own connections and clients.
+
+    Only modules the app actually imported are touched, so the provider
+    portal (Asliddin/app.py) can use the same hook.
+    """
+    # Pooled connections belong to the master; drop them without closing its sockets
+    with app.app_context():
+        for engine in app.extensions['sqlalchemy'].engines.values():
+            engine.dispose(close=False)
+
+    modules = sys.modules
+    if 'application' in modules:
+        modules['application'].redis_client.connection_pool.reset()
+        modules['application'].init_sentry()
+
+    # Process singletons are rebuilt lazily on first use
+    if 'jobs' in modules:
+        modules['jobs'].set_queue(None)
+    if 'events' in modules:
+        modules['events']._broker = None
+    if 'sessions' in modules:
+        modules['sessions']._store = None
+    if 'cache' in modules:
+        modules['cache'].reset()
+
+    green = 'gevent.monkey' in modules and modules['gevent.monkey'].is_module_patched('threading')
+    if 'routes' in modules and not green:
+        # The log listener thread stayed behind in the master (a gevent greenlet survives the fork):
+        # start a new listener on the same queue and handlers
+        routes = modules['routes']
+        old = routes.log_listener
+        listener = QueueListener(old.queue, *old.handlers, respect_handler_level=old.respect_handler_level)
+        listener.start()
+        atexit.unregister(old.stop)
+        atexit.register(listener.stop)
+        routes.log_listener = listener
+
+    if 'firebase_setup' in modules:
+        modules['firebase_setup'].init_firebase()
+    if 'resilience' in modules:
+        modules['resilience'].configure_stripe()  # a new HTTP session, with the timeout
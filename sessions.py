@@ -0,0 +1,290 @@
+# sessions.py
+"""
+Server-side sessions.
+
+The cookie only carries a random session id. The session itself lives in
+Redis (or in memory for development) under session:<sid>, and reading it
+slides its expiry in the same round trip (GETEX). Logging in stores a small
+principal snapshot - kind, id, role, display name and the contact fields
+shown on the profile - so views and templates can tell who is asking
+without querying the users table, and
+every session id is indexed per principal so all of someone's sessions can
+be revoked at once.
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import timedelta
+
+import redis
+from flask import session
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+from bus import UPDATED, on_commit
+from models import User, Admin
+
+logger = logging.getLogger(__name__)
+
+SESSION_PREFIX = 'session:'
+INDEX_PREFIX = 'sessions:'
+DEFAULT_IDLE_TIMEOUT = timedelta(days=7)
+MAX_INDEXED = 20  # prune dead ids from a principal's index past this many
+# Account columns copied into the principal snapshot (when the account has them) -> snapshot key
+SNAPSHOT_FIELDS = {'username': 'name', 'email': 'email', 'phone_number': 'phone_number'}
+
+
+def principal_key(kind, principal_id):
+    return f"{kind}:{principal_id}"
+
+
+#--------------------- Stores
+class RedisSessionStore:
+    def __init__(self, client):
+        self.redis = client
+
+    def load(self, sid, ttl):
+        raw = self.redis.getex(SESSION_PREFIX + sid, ex=ttl)
+        return session_json_serializer.loads(raw) if raw else None
+
+    def save(self, sid, data, ttl, owner=None):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(SESSION_PREFIX + sid, session_json_serializer.dumps(data), ex=ttl)
+        if owner:
+            pipe.sadd(INDEX_PREFIX + owner, sid)
+            pipe.scard(INDEX_PREFIX + owner)
+        result = pipe.execute()
+        if owner and result[-1] > MAX_INDEXED:
+            self._prune(owner)
+
+    def replace(self, sid, data):
+        """Rewrites a session in place without touching its expiry; no-op if it is gone."""
+        self.redis.set(SESSION_PREFIX + sid, session_json_serializer.dumps(data), keepttl=True, xx=True)
+
+    def delete(self, sid):
+        self.redis.delete(SESSION_PREFIX + sid)
+
+    def sessions_for(self, owner):
+        return self.redis.smembers(INDEX_PREFIX + owner)
+
+    def revoke(self, owner):
+        sids = self.sessions_for(owner)
+        self.redis.delete(INDEX_PREFIX + owner, *(SESSION_PREFIX + sid for sid in sids))
+        return len(sids)
+
+    def peek(self, sid):
+        raw = self.redis.get(SESSION_PREFIX + sid)
+        return session_json_serializer.loads(raw) if raw else None
+
+    def _prune(self, owner):
+        sids = list(self.sessions_for(owner))
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.exists(SESSION_PREFIX + sid)
+        dead = [sid for sid, alive in zip(sids, pipe.execute()) if not alive]
+        if dead:
+            self.redis.srem(INDEX_PREFIX + owner, *dead)
+
+
+class MemorySessionStore:
+    """Process-local stand-in for development and tests."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid, ttl):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None or entry[0] < time.monotonic():
+                self._sessions.pop(sid, None)
+                return None
+            self._sessions[sid] = (time.monotonic() + ttl, entry[1])
+        return session_json_serializer.loads(entry[1])
+
+    def save(self, sid, data, ttl, owner=None):
+        with self._lock:
+            self._sessions[sid] = (time.monotonic() + ttl, session_json_serializer.dumps(data))
+            if owner:
+                self._index.setdefault(owner, set()).add(sid)
+
+    def replace(self, sid, data):
+        with self._lock:
+            if sid in self._sessions:
+                self._sessions[sid] = (self._sessions[sid][0], session_json_serializer.dumps(data))
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def sessions_for(self, owner):
+        with self._lock:
+            return set(self._index.get(owner, ()))
+
+    def revoke(self, owner):
+        with self._lock:
+            sids = self._index.pop(owner, set())
+            for sid in sids:
+                self._sessions.pop(sid, None)
+        return len(sids)
+
+    def peek(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+        return session_json_serializer.loads(entry[1]) if entry else None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide store; SESSION_STORE_URL=memory:// selects the in-memory one."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if os.getenv('SESSION_STORE_URL', '').startswith('memory://'):
+                    _store = MemorySessionStore()
+                else:
+                    from application import redis_client
+                    _store = RedisSessionStore(redis_client)
+    return _store
+
+
+#--------------------- Session interface
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Moves the session to a fresh id (call on login to prevent fixation)."""
+        if not self.new:
+            self.previous_sid = self.sid
+        self.sid = _new_sid()
+        self.modified = True
+
+
+def _new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class ServerSessionInterface(SessionInterface):
+    def _ttl(self, app):
+        timeout = app.config.get('SESSION_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT)
+        return int(timeout.total_seconds() if isinstance(timeout, timedelta) else timeout)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            try:
+                data = get_store().load(sid, self._ttl(app))
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Session store unavailable: {e}")
+                data = None
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=_new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        store = get_store()
+
+        try:
+            if session.previous_sid:
+                store.delete(session.previous_sid)
+            if not session:
+                # Anonymous visitors get no cookie and no stored session
+                if session.modified and not session.new:
+                    store.delete(session.sid)
+                    response.delete_cookie(name, domain=domain, path=path)
+                return
+
+            if session.modified or session.new:
+                principal = session.get('principal')
+                owner = principal_key(principal['kind'], principal['id']) if principal else None
+                store.save(session.sid, dict(session), self._ttl(app), owner)
+        except redis.exceptions.RedisError as e:
+            logger.error(f"Session store unavailable, session not saved: {e}")
+            return
+
+        response.vary.add('Cookie')
+        if session.modified or session.new or self.should_set_cookie(app, session):
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+                domain=domain,
+                path=path,
+            )
+
+
+#--------------------- Principals
+def login(account, kind):
+    """
+    Starts an authenticated session for a User or Admin.
+
+    session['<kind>_id'] is kept for the views that already read it; the
+    principal snapshot is what new code should use.
+    """
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+    session[f'{kind}_id'] = account.id
+    session['principal'] = {'kind': kind, 'id': account.id, 'role': kind, **snapshot(account)}
+
+
+def snapshot(account):
+    """The SNAPSHOT_FIELDS of a User or Admin, keyed as in the principal."""
+    return {key: getattr(account, column) for column, key in SNAPSHOT_FIELDS.items() if hasattr(account, column)}
+
+
+def logout():
+    session.clear()
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+
+
+def current_principal():
+    """The signed-in principal ({'kind', 'id', 'role', 'name'}) or None, without a query."""
+    return session.get('principal')
+
+
+def revoke_sessions(kind, principal_id):
+    """Signs a user or admin out everywhere; returns how many sessions were dropped."""
+    return get_store().revoke(principal_key(kind, principal_id))
+
+
+def refresh_principal(kind, principal_id, **fields):
+    """Rewrites snapshot fields in every live session of a user or admin (e.g. after a rename)."""
+    store = get_store()
+    for sid in store.sessions_for(principal_key(kind, principal_id)):
+        data = store.peek(sid)
+        if data and data.get('principal'):
+            data['principal'] = dict(data['principal'], **fields)
+            store.replace(sid, data)
+
+
+# Keep snapshots in step with profile edits made anywhere (routes, Flask-Admin)
+@on_commit(User, Admin, fields=set(SNAPSHOT_FIELDS), kinds=(UPDATED,))
+def _refresh_renamed(changes):
+    for change in changes:
+        kind = 'admin' if change.model is Admin else 'user'
+        fields = {key: change.values[column] for column, key in SNAPSHOT_FIELDS.items() if column in change.values}
+        try:
+            refresh_principal(kind, change.id, **fields)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not refresh sessions for {kind} {change.id}: {e}")
@@ -0,0 +1,256 @@
+# sharding.py
+"""
+Optional sharding of bookings and transactions by company.
+
+Nothing changes unless SHARD_URLS is set, e.g.
+
+    SHARD_URLS="1=postgresql://db1/tozalab,2=sqlite:////var/lib/tozalab/shard2.db"
+
+Then:
+- Shard '0' is the primary database (DATABASE_URL). It keeps every other
+  table, the shard map, and the bookings and transactions of companies
+  that existed before sharding. Shards 1..N only hold SHARDED_TABLES:
+  bookings, transactions, and the reminders and CDC tombstones that go
+  with them.
+- The shard map (shard_assignments) places each company on a shard. New
+  companies are spread over shards 1..N by id when they are inserted.
+  A company without a row stays on the primary.
+- db.session is a RoutingSession (extensions.py). Statements on
+  SHARDED_TABLES go to the shard in context, set with use_company() or
+  use_shard(). Everything else goes to the primary. Without a context,
+  that is the primary too.
+- Ids stay unique across shards. Shard n hands out ids from
+  n * SHARD_ID_SPAN up, so shard_of_id() finds a booking or transaction
+  from its id alone. A booking or transaction whose id would leave its
+  shard's span (the primary's included) is refused.
+- scatter() runs a function once per shard, for admin-wide reads like the
+  dashboard, recommendations and reminders; the caller merges the results.
+
+Queries cannot join a sharded table with a primary-only one (services,
+users ...). Read the sharded rows first, then look the rest up by id.
+Routing looks at the tables of a statement, so raw text() SQL always goes
+to the primary.
+A session that writes to the primary and a shard commits each in turn,
+not atomically. Run create_shards() once per new shard, as db.create_all()
+is run for the primary.
+"""
+import logging
+import os
+from contextlib import contextmanager
+
+from cachetools import TTLCache
+from sqlalchemy import MetaData, event, insert, inspect, select, text
+from sqlalchemy.orm import Session
+
+from extensions import SHARDED_TABLES, current_shard_bind, db
+from models import Booking, CdcTombstone, Company, Reminder, ShardAssignment, Transaction
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = '0'
+SHARD_ID_SPAN = 100_000_000  # ids per shard; fits 21 shards in a 32-bit integer
+
+
+class ShardingError(RuntimeError):
+    pass
+
+
+def _parse(value):
+    shards = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, url = item.partition('=')
+        if not name.isdigit() or name == PRIMARY or not url:
+            raise ShardingError(f"SHARD_URLS entries look like 1=postgresql://...; got {item!r}")
+        shards[str(int(name))] = url
+    return shards
+
+
+SHARD_URLS = _parse(os.getenv('SHARD_URLS', ''))
+
+
+def enabled():
+    return bool(SHARD_URLS)
+
+
+def bind_key(shard):
+    return f"shard_{shard}"
+
+
+def binds():
+    """SQLALCHEMY_BINDS entries for the shards."""
+    return {bind_key(name): url for name, url in SHARD_URLS.items()}
+
+
+def shard_names():
+    return [PRIMARY] + sorted(SHARD_URLS, key=int)
+
+
+#--------------------- Context
+def current_shard():
+    key = current_shard_bind.get()
+    return PRIMARY if key is None else key[len('shard_'):]
+
+
+@contextmanager
+def use_shard(shard):
+    """Routes the sharded tables to `shard` inside the block."""
+    shard = str(shard)
+    if shard not in shard_names():
+        raise ShardingError(f"Unknown shard {shard}")
+    token = current_shard_bind.set(None if shard == PRIMARY else bind_key(shard))
+    try:
+        yield shard
+    finally:
+        current_shard_bind.reset(token)
+
+
+def use_company(company_id):
+    return use_shard(shard_for_company(company_id))
+
+
+def shard_of_id(row_id):
+    """The shard a booking, transaction or reminder id was handed out by."""
+    shard = str(int(row_id) // SHARD_ID_SPAN)
+    if shard not in shard_names():
+        raise ShardingError(f"Id {row_id} belongs to shard {shard}, which is not configured")
+    return shard
+
+
+def use_shard_of(row_id):
+    return use_shard(shard_of_id(row_id))
+
+
+#--------------------- Shard map
+# company id -> shard; moves are rare, so a minute of staleness is fine
+_map = TTLCache(maxsize=10000, ttl=60)
+
+
+def shard_for_company(company_id):
+    if not enabled() or company_id is None:
+        return PRIMARY
+    shard = _map.get(company_id)
+    if shard is None:
+        shard = db.session.execute(
+            select(ShardAssignment.shard).where(ShardAssignment.company_id == company_id)
+        ).scalar() or PRIMARY
+        _map[company_id] = shard
+    return shard
+
+
+def _assign_company(mapper, connection, target):
+    if enabled():
+        shards = shard_names()[1:]
+        connection.execute(insert(ShardAssignment.__table__).values(
+            company_id=target.id, shard=shards[target.id % len(shards)],
+        ))
+
+
+event.listen(Company, 'after_insert', _assign_company)
+
+
+#--------------------- Shard setup
+def _shard_metadata():
+    """Copies of SHARDED_TABLES without foreign keys to tables that stay on the primary."""
+    metadata = MetaData()
+    for name in sorted(SHARDED_TABLES):
+        table = db.metadata.tables[name].to_metadata(metadata)
+        for fk in list(table.foreign_keys):
+            if fk.target_fullname.split('.')[0] not in SHARDED_TABLES:
+                fk.parent.foreign_keys.discard(fk)
+                table.foreign_keys.discard(fk)
+                table.constraints.discard(fk.constraint)
+    return metadata
+
+
+def _start_ids(connection, table, start):
+    """Makes the next id handed out for `table` start + 1, unless it is already past that."""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"GREATEST(:start, (SELECT COALESCE(MAX(id), 0) FROM {table})))"
+        ), {'start': start})
+    elif connection.dialect.name == 'sqlite':
+        connection.execute(text("DELETE FROM sqlite_sequence WHERE name = :table AND seq < :start"),
+                           {'table': table, 'start': start})
+        connection.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT :table, :start "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :table)"
+        ), {'table': table, 'start': start})
+    else:
+        raise ShardingError(f"Don't know how to start ids on {connection.dialect.name}")
+
+
+def create_shards():
+    """Creates the sharded tables on every shard and starts their ids in the shard's range; idempotent."""
+    metadata = _shard_metadata()
+    for shard in shard_names()[1:]:
+        engine = db.engines[bind_key(shard)]
+        with engine.begin() as connection:
+            metadata.create_all(connection)
+            for table in metadata.tables:
+                _start_ids(connection, table, int(shard) * SHARD_ID_SPAN)
+        logger.info(f"Shard {shard} ready")
+
+
+#--------------------- Guard
+def _mark_loaded(target, context):
+    inspect(target).info['shard'] = current_shard()
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_shard(session, flush_context, instances):
+    # A flush writes each sharded table through one connection: the shard in context
+    if not enabled():
+        return
+    shard = current_shard()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        state = inspect(obj)
+        if state.mapper.local_table.name not in SHARDED_TABLES:
+            continue
+        home = state.info.setdefault('shard', shard)
+        if home != shard:
+            raise ShardingError(f"{obj!r} belongs to shard {home} but is being written in shard {shard}")
+
+
+def _check_id_range(mapper, connection, target):
+    # shard_of_id() only works while every shard's ids stay in its own span. The primary's
+    # sequence is never capped, so a row past it is refused (the flush rolls back).
+    if not enabled():
+        return
+    shard = current_shard()
+    if target.id // SHARD_ID_SPAN != int(shard):
+        logger.error(f"Shard {shard} has run out of {mapper.local_table.name} ids (span {SHARD_ID_SPAN})")
+        raise ShardingError(f"{mapper.local_table.name} id {target.id} is outside shard {shard}'s id range")
+
+
+for _model in (Booking, Transaction, Reminder, CdcTombstone):
+    event.listen(_model, 'load', _mark_loaded)
+for _model in (Booking, Transaction):
+    event.listen(_model, 'after_insert', _check_id_range)
+
+
+#--------------------- Scatter-gather
+def scatter(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) once per shard, primary first, in that shard's context.
+
+    Returns {shard: result}. Shards are visited one after the other on the
+    current session, so fn may also write (and commit) on its shard.
+    """
+    return {shard: _on(shard, fn, args, kwargs) for shard in shard_names()}
+
+
+def _on(shard, fn, args, kwargs):
+    with use_shard(shard):
+        return fn(*args, **kwargs)
+
+
+def gather(results):
+    """Concatenates per-shard lists from scatter()."""
+    return [item for shard in shard_names() for item in results.get(shard) or ()]
+
+
+def count(statement):
+    """Sum of a count query over every shard."""
+    return sum(scatter(lambda: db.session.execute(statement).scalar() or 0).values())
+
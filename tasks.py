@@ -0,0 +1,112 @@
+# tasks.py
+import logging
+
+from extensions import db
+from models import Service, Transaction, User
+from config import stripe
+from jobs import task
+from resilience import stripe_api
+import ledger
+import mailer
+import sharding
+
+# Imported so their tasks are registered in every worker process
+import bus  # noqa: F401
+import cdc  # noqa: F401
+import categories  # noqa: F401
+import devices  # noqa: F401
+import firebase_setup  # noqa: F401
+import images  # noqa: F401
+import recommendations  # noqa: F401
+import reminders  # noqa: F401
+import triage  # noqa: F401
+import wallet  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+
+@task('payments.charge', queue='payments', max_retries=5)
+def charge_transaction(transaction_id, token=None, description='Payment for service',
+                       payment_method=None, customer=None):
+    """
+    Charges a pending transaction through Stripe.
+
+    Pays with a one-off card `token`, or with a saved card (`payment_method`
+    of Stripe `customer`) confirmed off-session without the user present.
+    The idempotency key is derived from the transaction id, so a retry after
+    a timeout can never charge the card twice. While Stripe's circuit is
+    open the job is deferred rather than failed (see resilience.py).
+    """
+    with sharding.use_shard_of(transaction_id):
+        _charge(transaction_id, token, description, payment_method, customer)
+
+
+def _charge(transaction_id, token, description, payment_method, customer):
+    transaction = db.session.get(Transaction, transaction_id)
+    if not transaction or transaction.status != 'pending':
+        return
+
+    try:
+        if payment_method:
+            intent = stripe_api.call(
+                stripe.PaymentIntent.create,
+                amount=transaction.amount,
+                currency=transaction.currency,
+                customer=customer,
+                payment_method=payment_method,
+                off_session=True,
+                confirm=True,
+                description=description,
+                idempotency_key=f"transaction-{transaction.id}",
+            )
+            if intent.status == 'requires_action':
+                _needs_customer(transaction, intent.id)
+                return
+            if intent.status != 'succeeded':
+                raise stripe.error.CardError(f"Payment intent {intent.id} is {intent.status}", None, None)
+            charge_id = intent.latest_charge or intent.id
+        else:
+            charge = stripe_api.call(
+                stripe.Charge.create,
+                amount=transaction.amount,
+                currency=transaction.currency,
+                source=token,
+                description=description,
+                idempotency_key=f"transaction-{transaction.id}",
+            )
+            charge_id = charge.id
+    except stripe.error.CardError as e:
+        # Off-session, Stripe reports a card that needs 3-D Secure as an authentication_required decline
+        intent = getattr(e.error, 'payment_intent', None) if e.error else None
+        if payment_method and e.code == 'authentication_required' and intent:
+            _needs_customer(transaction, intent['id'])
+            return
+        # Other declines are final
+        logger.warning(f"Card declined for transaction {transaction.id}: {e}")
+        transaction.status = 'failed'
+        db.session.commit()
+        return
+
+    transaction.status = 'success'
+    transaction.charge_id = charge_id
+    ledger.post(transaction)
+    _queue_receipt(transaction)
+    db.session.commit()
+
+
+def _needs_customer(transaction, intent_id):
+    """Parks a saved-card payment until the customer authenticates it; the intent id lets the client confirm it."""
+    logger.info(f"Transaction {transaction.id} needs customer action on {intent_id}")
+    transaction.status = 'requires_action'
+    transaction.charge_id = intent_id
+    db.session.commit()
+
+
+def _queue_receipt(transaction):
+    user = db.session.get(User, transaction.user_id)
+    service = db.session.get(Service, transaction.service_id)
+    if user:
+        mailer.send('payment_receipt', user.email, name=user.username,
+                    amount=f"{transaction.amount / 100:,.2f} {transaction.currency.upper()}",
+                    service=service.name if service else 'your booking',
+                    transaction_id=transaction.id, booking_id=transaction.booking_id)
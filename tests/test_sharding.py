@@ -0,0 +1,207 @@
+# tests/test_sharding.py
+"""
+Bookings and payments with sharding on, over a primary and two SQLite shards.
+
+    python -m pytest tests/
+
+Run it from where the app runs (firebase_setup.py loads firebase_config/).
+SHARD_URLS is read when sharding.py is imported, so the databases are set up
+here before the app is. Redis is optional: without it the cache, rate limiter
+and event bus log a warning and carry on.
+"""
+import os
+import re
+import sys
+import tempfile
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = tempfile.mkdtemp(prefix='tozalab-shards-')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{ROOT}/primary.db",
+    'SHARD_URLS': f"1=sqlite:///{ROOT}/shard1.db,2=sqlite:///{ROOT}/shard2.db",
+    'SECRET_KEY': 'test',
+    'JOB_QUEUE_URL': 'memory://',
+    'SESSION_STORE_URL': 'memory://',
+    'UPLOAD_FOLDER': os.path.join(ROOT, 'uploads'),
+    'CDC_EXPORT_DIR': os.path.join(ROOT, 'cdc'),
+    'LEDGER_ARCHIVE_DIR': os.path.join(ROOT, 'ledger'),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as _app  # noqa: E402,F401  registers the blueprints
+from application import app as flask_app  # noqa: E402
+from auth import hash_password  # noqa: E402
+from config import stripe  # noqa: E402
+from extensions import admin as admin_views, db  # noqa: E402
+from models import Admin, Booking, Category, Company, Service, ShardAssignment, Transaction, User  # noqa: E402
+from sqlalchemy import delete, func, select, text  # noqa: E402
+import jobs  # noqa: E402
+import sharding  # noqa: E402
+import tasks  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        sharding.create_shards()
+        db.session.add(User(username='ali', password_hash=hash_password('pw'), email='ali@x.uz', phone_number='1'))
+        db.session.add(Admin(username='root', password_hash=hash_password('pw')))
+        db.session.add(Category(name='Cleaning'))
+        db.session.flush()
+        for i in range(3):
+            db.session.add(Company(name=f"Company {i}", phone=str(i), location='Tashkent'))
+            db.session.flush()
+        # Company 3 predates sharding: without a shard map row it stays on the primary
+        db.session.execute(delete(ShardAssignment).where(ShardAssignment.company_id == 3))
+        for company_id in (1, 2, 3):
+            db.session.add(Service(name=f"Service {company_id}", price=50, category_id=1, location='Tashkent',
+                                   company_id=company_id))
+        db.session.commit()
+        sharding._map.clear()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture(scope='module')
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'email': 'ali@x.uz', 'password': 'pw'})
+    return client
+
+
+def _on_shard(shard, statement):
+    with sharding.use_shard(shard):
+        return db.session.execute(statement).scalars().all()
+
+
+def _pay(client, service_id):
+    response = client.post('/payment', json={'amount': 5000, 'token': 'tok_visa', 'service_id': service_id,
+                                             'booking_id': 1})
+    assert response.status_code == 202, response.get_json()
+    return response.get_json()['transaction_id']
+
+
+def _queued_charges():
+    backend = jobs.get_queue()
+    charges = []
+    job, _ = backend.pop(['payments'], 'test')
+    while job:
+        charges.append(job.args[0])
+        job, _ = backend.pop(['payments'], 'test')
+    return charges
+
+
+def test_companies_are_spread_over_shards(app):
+    assert sharding.shard_names() == ['0', '1', '2']
+    assert [sharding.shard_for_company(c) for c in (1, 2, 3)] == ['2', '1', '0']
+
+
+def test_booking_is_written_to_the_company_shard(app, client):
+    day = (date.today() + timedelta(days=3)).isoformat()
+    for service_id in (1, 2, 3):
+        assert client.post(f"/book/{service_id}", data={'date': day, 'time': '10:00'}).status_code == 302
+
+    assert _on_shard('1', select(Booking.service_id)) == [2]
+    assert _on_shard('2', select(Booking.service_id)) == [1]
+    assert _on_shard('0', select(Booking.service_id)) == [3]
+    assert [b // sharding.SHARD_ID_SPAN for b in _on_shard('2', select(Booking.id))] == [2]
+
+
+def test_payment_and_status_on_a_shard(app, client):
+    _queued_charges()
+    transaction_id = _pay(client, 1)
+
+    assert sharding.shard_of_id(transaction_id) == '2'
+    assert _on_shard('2', select(Transaction.status).where(Transaction.id == transaction_id)) == ['pending']
+    assert _on_shard('0', select(Transaction.id)) == []
+    assert _queued_charges() == [transaction_id]
+
+    status = client.get(f"/payment/{transaction_id}")
+    assert status.status_code == 200
+    assert status.get_json()['status'] == 'pending'
+
+
+def test_charge_transaction_runs_on_the_shard(app, client, monkeypatch):
+    monkeypatch.setattr(stripe.Charge, 'create', lambda **kwargs: SimpleNamespace(id='ch_test'))
+    transaction_id = _pay(client, 2)
+    db.session.remove()
+
+    tasks.charge_transaction(transaction_id, token='tok_visa')
+    db.session.remove()
+
+    with sharding.use_shard_of(transaction_id):
+        transaction = db.session.get(Transaction, transaction_id)
+        assert (transaction.status, transaction.charge_id) == ('success', 'ch_test')
+    assert client.get(f"/payment/{transaction_id}").get_json()['status'] == 'success'
+
+
+def test_scatter_and_count(app):
+    per_shard = sharding.scatter(lambda: db.session.execute(select(func.count(Booking.id))).scalar())
+    assert per_shard == {'0': 1, '1': 1, '2': 1}
+    assert sharding.count(select(func.count(Booking.id))) == 3
+    assert sorted(sharding.gather(sharding.scatter(
+        lambda: db.session.execute(select(Booking.service_id)).scalars().all()
+    ))) == [1, 2, 3]
+
+
+def test_guard_refuses_a_write_in_another_shard(app):
+    booking_id = _on_shard('1', select(Booking.id))[0]
+    with sharding.use_shard_of(booking_id):
+        booking = db.session.get(Booking, booking_id)
+    booking.status = 'cancelled'
+    with pytest.raises(sharding.ShardingError):
+        db.session.commit()
+    db.session.rollback()
+
+    with sharding.use_shard_of(booking_id):
+        db.session.get(Booking, booking_id).status = 'cancelled'
+        db.session.commit()
+    assert _on_shard('1', select(Booking.status)) == ['cancelled']
+
+
+def test_primary_ids_stop_at_the_shard_span(app, client):
+    db.session.execute(text("DELETE FROM sqlite_sequence WHERE name = 'transactions'"))
+    db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', :seq)"),
+                       {'seq': sharding.SHARD_ID_SPAN - 1})
+    db.session.commit()
+
+    response = client.post('/payment', json={'amount': 5000, 'token': 'tok_visa', 'service_id': 3, 'booking_id': 1})
+    assert response.status_code == 500
+    db.session.rollback()
+    assert _on_shard('0', select(Transaction.id)) == []
+
+
+def test_admin_lists_transactions_from_every_shard(app):
+    admin = app.test_client()
+    admin.post('/admin/login', data={'username': 'root', 'password': 'pw'})
+    expected = sharding.gather(sharding.scatter(lambda: db.session.execute(select(Transaction.id)).scalars().all()))
+    assert {sharding.shard_of_id(i) for i in expected} == {'1', '2'}
+
+    page = admin.get('/admin_dashboard/transactions_admin/').get_data(as_text=True)
+    for transaction_id in expected:
+        assert f"id={transaction_id}" in page
+    assert admin.get(f"/admin_dashboard/transactions_admin/details/?id={expected[0]}").status_code == 200
+
+
+def test_admin_pages_through_every_shard(app, monkeypatch):
+    view = next(v for v in admin_views._views if v.endpoint == 'transactions_admin')
+    monkeypatch.setattr(view, 'page_size', 1)
+    admin = app.test_client()
+    admin.post('/admin/login', data={'username': 'root', 'password': 'pw'})
+    expected = sorted(sharding.gather(sharding.scatter(
+        lambda: db.session.execute(select(Transaction.id)).scalars().all()
+    )), reverse=True)
+
+    seen, url = [], '/admin_dashboard/transactions_admin/'
+    while url and len(seen) <= len(expected):
+        page = admin.get(url).get_data(as_text=True)
+        seen += [int(i) for i in re.findall(r"details/\?id=(\d+)", page)][:1]
+        next_url = re.search(r'href="([^"]*)">&gt;', page)
+        url = next_url.group(1).replace('&amp;', '&') if next_url and 'after=' in next_url.group(1) else None
+    assert seen == expected
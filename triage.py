@@ -0,0 +1,224 @@
+# triage.py
+"""
+Support ticket and dispute triage.
+
+Agents pull work with claim_next(), which locks the next open item with
+SELECT ... FOR UPDATE SKIP LOCKED so concurrent agents never collide.
+Per-queue counts live in triage_counters and are updated in the same
+transaction as the item, and SLA breaches are flagged by a periodic job.
+Unresolved breached items are counted there too, under BREACHED, so the
+dashboard never counts the item tables.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from jobs import periodic
+from metrics import inc
+from models import SupportTicket, Dispute, TriageCounter
+
+logger = logging.getLogger(__name__)
+
+OPEN, IN_PROGRESS, RESOLVED = 'Open', 'In Progress', 'Resolved'
+STATUSES = (OPEN, IN_PROGRESS, RESOLVED)
+BREACHED = 'breached'  # counter row: unresolved items past their SLA
+
+QUEUES = {
+    'support': SupportTicket,
+    'disputes': Dispute,
+}
+_QUEUE_BY_MODEL = {model: name for name, model in QUEUES.items()}
+
+SLA_BY_PRIORITY = {
+    1: timedelta(hours=4),
+    2: timedelta(hours=24),
+    3: timedelta(hours=72),
+}
+SLA_SCAN_INTERVAL = 60
+
+_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+class TriageError(ValueError):
+    pass
+
+
+def _model(queue):
+    if queue not in QUEUES:
+        raise TriageError(f"Unknown queue: {queue}")
+    return QUEUES[queue]
+
+
+#--------------------- Counters
+def _bump(connection, queue, status, delta):
+    table = TriageCounter.__table__
+    if connection.dialect.name in _UPSERT:
+        # One statement, so two transactions bumping a new (queue, status) can't both insert it
+        statement = _UPSERT[connection.dialect.name](table).values(queue=queue, status=status, count=delta)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['queue', 'status'], set_={'count': table.c.count + statement.excluded.count},
+        ))
+        return
+    result = connection.execute(
+        table.update()
+        .where(table.c.queue == queue, table.c.status == status)
+        .values(count=table.c.count + delta)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(queue=queue, status=status, count=delta))
+
+
+def _before_insert(mapper, connection, target):
+    target.status = target.status or OPEN
+    target.priority = target.priority or 2
+    if target.sla_due_at is None:
+        opened_at = target.created_at or datetime.utcnow()
+        target.sla_due_at = opened_at + SLA_BY_PRIORITY.get(target.priority, SLA_BY_PRIORITY[2])
+
+
+def _breached(status, sla_breached):
+    return bool(sla_breached) and status != RESOLVED
+
+
+def _after_insert(mapper, connection, target):
+    queue = _QUEUE_BY_MODEL[mapper.class_]
+    _bump(connection, queue, target.status, 1)
+    if _breached(target.status, target.sla_breached):
+        _bump(connection, queue, BREACHED, 1)
+
+
+def _previous(state, name):
+    history = state.attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(state.object, name)
+
+
+def _after_update(mapper, connection, target):
+    state = inspect(target)
+    queue = _QUEUE_BY_MODEL[mapper.class_]
+    old_status = _previous(state, 'status')
+    if old_status != target.status:
+        _bump(connection, queue, old_status, -1)
+        _bump(connection, queue, target.status, 1)
+    was = _breached(old_status, _previous(state, 'sla_breached'))
+    now = _breached(target.status, target.sla_breached)
+    if was != now:
+        _bump(connection, queue, BREACHED, 1 if now else -1)
+
+
+def _after_delete(mapper, connection, target):
+    queue = _QUEUE_BY_MODEL[mapper.class_]
+    _bump(connection, queue, target.status, -1)
+    if _breached(target.status, target.sla_breached):
+        _bump(connection, queue, BREACHED, -1)
+
+
+for _model_class in QUEUES.values():
+    event.listen(_model_class, 'before_insert', _before_insert)
+    event.listen(_model_class, 'after_insert', _after_insert)
+    event.listen(_model_class, 'after_update', _after_update)
+    event.listen(_model_class, 'after_delete', _after_delete)
+
+
+def counters():
+    """Returns {queue: {status: count, 'breached': count}} without scanning the item tables."""
+    result = {queue: {status: 0 for status in (*STATUSES, BREACHED)} for queue in QUEUES}
+    for row in db.session.query(TriageCounter):
+        result.setdefault(row.queue, {})[row.status] = row.count
+    return result
+
+
+def rebuild_counters():
+    """Recomputes triage_counters from the item tables (for repairs, not the hot path)."""
+    db.session.query(TriageCounter).delete()
+    for queue, model in QUEUES.items():
+        for status, count in db.session.query(model.status, func.count(model.id)).group_by(model.status):
+            db.session.add(TriageCounter(queue=queue, status=status, count=count))
+        breached = db.session.query(func.count(model.id)).filter(model.status != RESOLVED, model.sla_breached).scalar()
+        db.session.add(TriageCounter(queue=queue, status=BREACHED, count=breached))
+    db.session.commit()
+
+
+#--------------------- Workflow
+def claim_next(queue, admin_id, priority=None):
+    """
+    Assigns the most urgent open item in `queue` to `admin_id`.
+
+    Returns:
+        The claimed item, or None if the queue is empty.
+    """
+    model = _model(queue)
+    for _ in range(3):
+        candidate = db.session.query(model.id).filter(model.status == OPEN)
+        if priority is not None:
+            candidate = candidate.filter(model.priority == priority)
+        row = (
+            candidate.order_by(model.priority, model.sla_due_at, model.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if row is None:
+            db.session.rollback()
+            return None
+
+        # The status guard keeps this correct on databases without SKIP LOCKED (e.g. SQLite)
+        claimed = db.session.execute(
+            update(model)
+            .where(model.id == row.id, model.status == OPEN)
+            .values(status=IN_PROGRESS, assignee_id=admin_id, claimed_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        if claimed.rowcount == 1:
+            connection = db.session.connection()
+            _bump(connection, queue, OPEN, -1)
+            _bump(connection, queue, IN_PROGRESS, 1)
+            db.session.commit()
+            return db.session.get(model, row.id)
+        db.session.rollback()
+    return None
+
+
+def _owned_item(queue, item_id, admin_id):
+    item = db.session.get(_model(queue), item_id)
+    if item is None:
+        raise TriageError("Item not found")
+    if item.status != IN_PROGRESS or item.assignee_id != admin_id:
+        raise TriageError("Item is not claimed by you")
+    return item
+
+
+def resolve(queue, item_id, admin_id):
+    item = _owned_item(queue, item_id, admin_id)
+    item.status = RESOLVED
+    db.session.commit()
+    return item
+
+
+def release(queue, item_id, admin_id):
+    """Puts a claimed item back at its place in the open queue."""
+    item = _owned_item(queue, item_id, admin_id)
+    item.status = OPEN
+    item.assignee_id = None
+    item.claimed_at = None
+    db.session.commit()
+    return item
+
+
+@periodic(SLA_SCAN_INTERVAL, name='triage.scan_sla')
+def scan_sla_breaches():
+    """Flags unresolved items past their SLA and escalates them to priority 1."""
+    now = datetime.utcnow()
+    for queue, model in QUEUES.items():
+        result = db.session.execute(
+            update(model)
+            .where(model.status != RESOLVED, ~model.sla_breached, model.sla_due_at < now)
+            .values(sla_breached=True, priority=1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            _bump(db.session.connection(), queue, BREACHED, result.rowcount)
+            logger.warning(f"{result.rowcount} {queue} items breached their SLA")
+            inc('triage_sla_breaches_total', result.rowcount, queue=queue)
+    db.session.commit()
@@ -3,7 +3,8 @@ from flask_admin.contrib.sqla import ModelView
 from models import Review
 from extensions import db
 from flask_admin import BaseView, expose
-from models import User, Service, Transaction
+from models import User, Service
+import ledger
 
 class ReviewView(ModelView):
     column_list = ('id', 'user_id', 'service_id', 'content', 'status')
@@ -33,7 +34,7 @@ class DashboardView(BaseView):
         total_users = db.session.query(User).count()
         active_users = db.session.query(User).filter_by(role='user').count()
         total_services = db.session.query(Service).count()
-        total_revenue = sum(t.amount for t in db.session.query(Transaction).filter_by(status='success'))
+        total_revenue = ledger.total_revenue()
 
         # Render the dashboard with metrics
         return self.render('admin/dashboard.html',
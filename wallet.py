@@ -0,0 +1,270 @@
+# wallet.py
+"""
+Saved cards.
+
+Cards are tokenized in the browser by Stripe.js; the server only ever sees a
+PaymentMethod id (pm_...), attaches it to the user's Stripe customer and keeps
+brand, last4 and expiry for display. Paying with a saved card hands that id
+to the payments worker instead of a fresh token, so a returning customer
+checks out without another tokenization round trip.
+
+The default card is cached in Redis under wallet:default:<user_id> and the
+entry is dropped by a commit handler whenever that user's cards change.
+"""
+import json
+import logging
+import re
+
+import redis
+from sqlalchemy import select
+
+from application import redis_client
+from bus import on_commit
+from config import stripe
+from extensions import db
+from jobs import task
+from metrics import inc
+from models import PaymentMethod, User
+from resilience import stripe_api
+from serializers import Serializer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_TTL = 24 * 3600
+SCRUB_BATCH = 500
+
+# Longest prefix first; local Uzcard/Humo cards included
+CARD_PREFIXES = (
+    ('8600', 'uzcard'), ('9860', 'humo'), ('6011', 'discover'), ('65', 'discover'),
+    ('34', 'amex'), ('37', 'amex'), ('4', 'visa'),
+)
+
+payment_method_serializer = Serializer('id', 'brand', 'last4', 'exp_month', 'exp_year', 'is_default')
+
+
+class WalletError(ValueError):
+    """Raised when a card can't be saved or used (unknown, someone else's, or refused by Stripe)."""
+
+
+def _cache_key(user_id):
+    return f"wallet:default:{user_id}"
+
+
+#--------------------- Managing cards
+def get_or_create_customer(user):
+    """The user's Stripe customer id, creating the customer on first use (the caller commits)."""
+    if not user.stripe_customer_id:
+        customer = stripe_api.call(
+            stripe.Customer.create,
+            email=user.email,
+            metadata={'user_id': user.id},
+            idempotency_key=f"customer-user-{user.id}",
+        )
+        user.stripe_customer_id = customer.id
+    return user.stripe_customer_id
+
+
+def methods_for(user_id):
+    return (
+        PaymentMethod.query
+        .filter(PaymentMethod.user_id == user_id, PaymentMethod.stripe_payment_method_id.isnot(None))
+        .order_by(PaymentMethod.is_default.desc(), PaymentMethod.id.desc())
+        .all()
+    )
+
+
+def _make_default(user_id, method):
+    for other in PaymentMethod.query.filter_by(user_id=user_id, is_default=True):
+        if other.id != method.id:
+            other.is_default = False
+    db.session.flush()  # clear the old default before the unique index sees a second one
+    method.is_default = True
+
+
+def add_method(user, payment_method_id, make_default=False):
+    """Attaches a Stripe.js PaymentMethod to the user and saves it; the first card becomes the default."""
+    existing = PaymentMethod.query.filter_by(stripe_payment_method_id=payment_method_id).first()
+    if existing:
+        if existing.user_id != user.id:
+            raise WalletError("Unknown payment method")
+        return existing
+
+    customer_id = get_or_create_customer(user)
+    try:
+        attached = stripe_api.call(stripe.PaymentMethod.attach, payment_method_id, customer=customer_id)
+    except (stripe.error.CardError, stripe.error.InvalidRequestError) as e:
+        raise WalletError(e.user_message or "Card could not be saved") from e
+
+    card = attached.card
+    method = PaymentMethod(
+        user_id=user.id,
+        stripe_payment_method_id=attached.id,
+        brand=card.brand,
+        last4=card.last4,
+        exp_month=card.exp_month,
+        exp_year=card.exp_year,
+    )
+    db.session.add(method)
+    has_default = db.session.query(PaymentMethod.id).filter_by(user_id=user.id, is_default=True).first()
+    if make_default or not has_default:
+        _make_default(user.id, method)
+    db.session.commit()
+    inc('wallet_methods_added_total')
+    return method
+
+
+def _owned(user_id, method_id):
+    method = db.session.get(PaymentMethod, method_id)
+    if not method or method.user_id != user_id or not method.stripe_payment_method_id:
+        raise WalletError("Unknown payment method")
+    return method
+
+
+def set_default(user_id, method_id):
+    method = _owned(user_id, method_id)
+    _make_default(user_id, method)
+    db.session.commit()
+    return method
+
+
+def remove_method(user_id, method_id):
+    """Detaches the card at Stripe and deletes it; the newest remaining card becomes the default."""
+    method = _owned(user_id, method_id)
+    try:
+        stripe_api.call(stripe.PaymentMethod.detach, method.stripe_payment_method_id)
+    except stripe.error.InvalidRequestError as e:
+        # Already detached (e.g. removed from the Stripe dashboard); just forget it
+        logger.warning(f"Detaching payment method {method.id}: {e}")
+
+    was_default = method.is_default
+    db.session.delete(method)
+    db.session.flush()
+    if was_default:
+        remaining = methods_for(user_id)
+        if remaining:
+            remaining[0].is_default = True
+    db.session.commit()
+
+
+#--------------------- Checkout
+def _checkout_query():
+    return (
+        select(
+            PaymentMethod.id,
+            PaymentMethod.stripe_payment_method_id.label('payment_method'),
+            User.stripe_customer_id.label('customer'),
+            PaymentMethod.brand,
+            PaymentMethod.last4,
+        )
+        .join(User, User.id == PaymentMethod.user_id)
+        .where(PaymentMethod.stripe_payment_method_id.isnot(None))
+    )
+
+
+def default_method(user_id):
+    """
+    The user's default card for checkout, or None.
+
+    Returns a dict with the row id, the Stripe payment method and customer
+    ids, brand and last4. Cached, including "no default", so a repeat
+    checkout costs one Redis GET.
+    """
+    key = _cache_key(user_id)
+    try:
+        raw = redis_client.get(key)
+        if raw is not None:
+            inc('wallet_default_cache_total', result='hit')
+            return json.loads(raw) or None
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Wallet cache unavailable: {e}")
+    inc('wallet_default_cache_total', result='miss')
+
+    row = db.session.execute(
+        _checkout_query().where(PaymentMethod.user_id == user_id, PaymentMethod.is_default)
+    ).first()
+    method = dict(row._mapping) if row else {}
+    try:
+        redis_client.set(key, json.dumps(method), ex=DEFAULT_CACHE_TTL)
+    except redis.exceptions.RedisError:
+        pass
+    return method or None
+
+
+def method_for_checkout(user_id, method_id=None):
+    """A specific saved card of the user's, or their default; raises WalletError if there is none."""
+    if method_id is None:
+        method = default_method(user_id)
+    else:
+        row = db.session.execute(
+            _checkout_query().where(PaymentMethod.user_id == user_id, PaymentMethod.id == method_id)
+        ).first()
+        method = dict(row._mapping) if row else None
+    if not method or not method['customer']:
+        raise WalletError("No saved payment method")
+    return method
+
+
+@on_commit(PaymentMethod)
+def _drop_cached_defaults(changes):
+    user_ids = {v for c in changes for v in (c.values.get('user_id'), c.previous.get('user_id')) if v}
+    if user_ids:
+        try:
+            redis_client.delete(*(_cache_key(user_id) for user_id in user_ids))
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not drop cached wallet defaults: {e}")
+
+
+#--------------------- Scrubbing legacy card numbers
+def card_brand(digits):
+    for prefix, brand in CARD_PREFIXES:
+        if digits.startswith(prefix):
+            return brand
+    if digits[:2] in ('51', '52', '53', '54', '55') or '2221' <= digits[:4] <= '2720':
+        return 'mastercard'
+    return 'unknown'
+
+
+def _parse_expiry(value):
+    match = re.match(r'^\s*(\d{1,2})\s*/\s*(\d{2}|\d{4})\s*$', value or '')
+    if not match:
+        return None, None
+    month, year = int(match.group(1)), int(match.group(2))
+    return month, year + 2000 if year < 100 else year
+
+
+@task('wallet.scrub_card_numbers')
+def scrub_card_numbers(batch_size=SCRUB_BATCH, after_id=0):
+    """
+    Replaces stored card numbers with brand and last4, one batch per job.
+
+    Re-enqueues itself until none are left, so it can run against the live
+    table without long locks: scrub_card_numbers.delay(). Scrubbed cards keep
+    no Stripe id, so they are not offered at checkout; users add them again.
+    """
+    methods = (
+        PaymentMethod.query
+        .filter(PaymentMethod.card_number.isnot(None), PaymentMethod.id > after_id)
+        .order_by(PaymentMethod.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not methods:
+        return 0
+
+    for method in methods:
+        digits = re.sub(r'\D', '', method.card_number)
+        month, year = _parse_expiry(method.expiration_date)
+        method.brand = method.brand or card_brand(digits)
+        method.last4 = method.last4 or digits[-4:]
+        method.exp_month = method.exp_month or month
+        method.exp_year = method.exp_year or year
+        method.card_number = None
+        method.expiration_date = None
+    last_id = methods[-1].id
+    db.session.commit()
+    inc('wallet_cards_scrubbed_total', len(methods))
+
+    if len(methods) == batch_size:
+        scrub_card_numbers.delay(batch_size, last_id)
+    return len(methods)
@@ -0,0 +1,85 @@
+# worker.py
+"""
+Background job worker.
+
+    python worker.py --processes 4 --queues default,notifications,payments,media
+
+Each process gets a stable slot name (<host>-<n>) so that, after a crash or
+restart, it re-queues the jobs it was holding. An extra scheduler process
+enqueues @periodic tasks.
+"""
+import argparse
+import importlib
+import logging
+import multiprocessing
+import signal
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+def _load(path):
+    module_name, _, attr = path.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attr) if attr else module
+
+
+def _work(app_path, task_modules, queues, worker, stop_event):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from jobs import run_worker
+
+    app = _load(app_path)
+    for module in task_modules:
+        importlib.import_module(module)
+    run_worker(app, queues, worker, stop_event)
+
+
+def _schedule(task_modules, stop_event):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from jobs import run_scheduler
+
+    for module in task_modules:
+        importlib.import_module(module)
+    run_scheduler(stop_event)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background job workers.")
+    parser.add_argument('--processes', '-n', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--queues', '-q', default='default,notifications,payments,media')
+    parser.add_argument('--app', default='application:app', help="module:attribute of the Flask app")
+    parser.add_argument('--tasks', action='append', default=None,
+                        help="module(s) defining tasks; may be given several times")
+    parser.add_argument('--no-scheduler', action='store_true', help="don't enqueue periodic tasks from this host")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+    queues = [q.strip() for q in args.queues.split(',') if q.strip()]
+    task_modules = args.tasks or ['tasks']
+    stop_event = multiprocessing.Event()
+
+    processes = []
+    for i in range(args.processes):
+        worker = f"{socket.gethostname()}-{i}"
+        p = multiprocessing.Process(target=_work, name=worker,
+                                    args=(args.app, task_modules, queues, worker, stop_event))
+        p.start()
+        processes.append(p)
+
+    if not args.no_scheduler:
+        p = multiprocessing.Process(target=_schedule, name='scheduler', args=(task_modules, stop_event))
+        p.start()
+        processes.append(p)
+
+    def shutdown(signum, frame):
+        logger.info("Stopping workers after their current job...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()